@@ -0,0 +1,307 @@
+"""Bulk screening of uploaded customer name lists.
+
+Names arrive as JSON Lines or CSV and are screened in chunks.  With more than
+one process the chunks are fanned out to a pool of workers and results are
+streamed back in input order as NDJSON while later chunks are still running.
+The workers are started fresh (``forkserver``, or ``spawn``), never forked
+from the threaded server where another thread may hold a lock; they load a
+ScreeningTarget, the snapshot's screening index and the fields results use,
+from a file the parent writes once per snapshot version.
+Rows are read from the upload in the request's thread and only a few chunks
+are in flight at a time, so a slow client slows the read of its upload
+instead of having it queued in full.
+"""
+import csv
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from screening import match_summary
+
+CHUNK_SIZE = 256
+# Chunks of one batch queued on the pool per worker process
+CHUNKS_PER_PROCESS = 2
+
+# Fields of the matched entities that batch results report or filter on
+TARGET_FIELDS = ('name', 'reference', 'slug', 'datasets', 'risk_level', 'countries')
+# Pool workers start from a fresh interpreter, not a fork of the server
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Set in each pool worker by _init_worker
+_pool_target = None
+_pool_country_resolver = None
+
+
+def iter_rows(stream, fmt):
+    """Yield ``(line_number, row)`` pairs from an uploaded binary stream.
+
+    ``fmt`` is ``'csv'`` (header row with at least a ``name`` column) or
+    ``'jsonl'`` (one object, or bare string, per line).  Lines that cannot be
+    parsed are yielded as rows with an ``error`` key.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        if reader.fieldnames:
+            reader.fieldnames = [field.strip().lower() for field in reader.fieldnames]
+        for row in reader:
+            # DictReader.line_num counts physical lines, including the header
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(text, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_num, {'error': f"Invalid JSON: {e}"}
+            continue
+        if isinstance(row, str):
+            row = {'name': row}
+        elif not isinstance(row, dict):
+            row = {'error': "Expected an object or a string"}
+        yield line_num, row
+
+
+def screen_row(snapshot, line_num, row, threshold, limit, country_resolver=None):
+    """Screen one input row and return its NDJSON result object"""
+    result = {'line': line_num}
+    if row.get('error'):
+        result['error'] = row['error']
+        return result
+
+    name = str(row.get('name') or '').strip()
+    if not name:
+        result['error'] = "Missing name"
+        return result
+    result['name'] = name
+
+    dataset = str(row.get('dataset') or '').strip()
+    country = str(row.get('country') or '').strip()
+    countries = set()
+    if country:
+        countries.add(country.lower())
+        code = country_resolver(country) if country_resolver else None
+        if code:
+            countries.add(code.lower())
+
+    matches = []
+    for score, entity, matched_name in snapshot.screen(name, threshold, None):
+        if dataset and dataset not in entity['datasets']:
+            continue
+        if countries and countries.isdisjoint(entity['countries']):
+            continue
+        matches.append(match_summary(score, entity, matched_name))
+        if len(matches) == limit:
+            break
+    result['matches'] = matches
+    return result
+
+
+class ScreeningTarget:
+    """What pool workers screen against: a snapshot's screening index and, per entity id, TARGET_FIELDS"""
+
+    def __init__(self, snapshot):
+        self.version = snapshot.version
+        self.index = snapshot.screening_index
+        self.dead = snapshot.dead
+        self.entities = [None if entity_id in self.dead else {field: entity[field] for field in TARGET_FIELDS}
+                         for entity_id, entity in enumerate(snapshot.entities)]
+
+    def screen(self, name, threshold, limit):
+        """Return ``(score, entity fields, matched_name)`` tuples for ``name``, like EntitySnapshot.screen"""
+        entities = self.entities
+        return [(score, entities[entity_id], matched_name)
+                for score, entity_id, matched_name
+                in self.index.screen(name, threshold=threshold, limit=limit, exclude=self.dead)]
+
+
+def _init_worker(path, country_resolver):
+    global _pool_target, _pool_country_resolver
+    with open(path, 'rb') as f:
+        _pool_target = pickle.load(f)
+    _pool_country_resolver = country_resolver
+
+
+def _screen_chunk(task):
+    chunk, threshold, limit = task
+    return [screen_row(_pool_target, line_num, row, threshold, limit, _pool_country_resolver)
+            for line_num, row in chunk]
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchScreener:
+    """Runs batch screens, optionally on a process pool bound to one snapshot.
+
+    The pool is started lazily and replaced when the snapshot version
+    changes; a pool whose snapshot was superseded is retired, letting running
+    batches finish on it, and closed and joined (and its target file removed)
+    once the last of them is done.  A batch abandoned by its client stops
+    submitting chunks, and terminates the pool when nothing else is running on
+    it.  ``processes <= 1`` screens in the calling process.
+    ``country_resolver`` is sent to the workers, so it must be picklable (a
+    module-level function).
+    """
+
+    def __init__(self, processes, country_resolver=None):
+        self.processes = processes
+        self.country_resolver = country_resolver
+        self._pool = None
+        self._pool_version = None
+        # Running batches per pool, current or retired, and each pool's target file
+        self._pool_users = {}
+        self._pool_files = {}
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'batches': 0,
+            'active_batches': 0,
+            'names': 0,
+            'matched_names': 0,
+            'errors': 0,
+            'seconds': 0.0,
+        }
+
+    def _start_pool(self, snapshot):
+        """Write the snapshot's ScreeningTarget for the workers and start a pool on it"""
+        fd, path = tempfile.mkstemp(prefix='batch-screening-', suffix='.pickle')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(ScreeningTarget(snapshot), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pool = multiprocessing.get_context(START_METHOD).Pool(
+                self.processes, initializer=_init_worker, initargs=(path, self.country_resolver))
+        except BaseException:
+            os.unlink(path)
+            raise
+        self._pool_files[pool] = path
+        return pool
+
+    def _stop_pool(self, pool, terminate=False):
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+        with self._lock:
+            path = self._pool_files.pop(pool)
+        os.unlink(path)
+
+    def _acquire_pool(self, snapshot):
+        if self.processes <= 1:
+            return None
+        retired = None
+        with self._lock:
+            if self._pool is None or self._pool_version != snapshot.version:
+                if self._pool is not None and not self._pool_users.get(self._pool):
+                    retired = self._pool
+                    self._pool_users.pop(retired, None)
+                self._pool = self._start_pool(snapshot)
+                self._pool_version = snapshot.version
+            pool = self._pool
+            self._pool_users[pool] = self._pool_users.get(pool, 0) + 1
+        if retired is not None:
+            self._stop_pool(retired)
+        return pool
+
+    def _release_pool(self, pool, abandoned):
+        with self._lock:
+            self._pool_users[pool] -= 1
+            idle = not self._pool_users[pool]
+            if idle and abandoned and pool is self._pool:
+                # Nothing else runs on it: drop the abandoned chunks with the workers
+                self._pool = None
+                self._pool_version = None
+            stop = idle and pool is not self._pool
+            if stop:
+                del self._pool_users[pool]
+        if stop:
+            self._stop_pool(pool, terminate=abandoned)
+
+    def _results(self, snapshot, rows, threshold, limit):
+        pool = self._acquire_pool(snapshot)
+        if pool is None:
+            for line_num, row in rows:
+                yield screen_row(snapshot, line_num, row, threshold, limit, self.country_resolver)
+            return
+        # Results come back in input order while a bounded number of chunks
+        # run ahead; the next chunk is only read once one has been sent
+        pending = deque()
+        window = max(1, self.processes * CHUNKS_PER_PROCESS)
+        try:
+            for chunk in _chunks(rows, CHUNK_SIZE):
+                pending.append(pool.apply_async(_screen_chunk, ((chunk, threshold, limit),)))
+                if len(pending) >= window:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+        finally:
+            self._release_pool(pool, abandoned=bool(pending))
+
+    def screen(self, snapshot, rows, threshold, limit):
+        """Yield one result dict per input row, then a ``summary`` dict"""
+        counts = {'names': 0, 'matched_names': 0, 'errors': 0}
+        started = time.perf_counter()
+        with self._stats_lock:
+            self.stats['batches'] += 1
+            self.stats['active_batches'] += 1
+        results = self._results(snapshot, rows, threshold, limit)
+        try:
+            for result in results:
+                if 'error' in result:
+                    key = 'errors'
+                elif result['matches']:
+                    key = 'matched_names'
+                else:
+                    key = None
+                if key:
+                    counts[key] += 1
+                if key != 'errors':
+                    counts['names'] += 1
+                # Counters are updated per row so /stats shows live progress
+                with self._stats_lock:
+                    if key:
+                        self.stats[key] += 1
+                    if key != 'errors':
+                        self.stats['names'] += 1
+                yield result
+        finally:
+            # Stops the batch's pool work when the client goes away
+            results.close()
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                self.stats['active_batches'] -= 1
+                self.stats['seconds'] += elapsed
+
+        screened = counts['names'] + counts['errors']
+        yield {'summary': dict(
+            counts,
+            seconds=round(elapsed, 3),
+            names_per_second=round(screened / elapsed, 1) if elapsed else None,
+            snapshot=snapshot.version,
+        )}
+
+    def get_stats(self):
+        """Return cumulative counters and overall throughput"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        screened = stats['names'] + stats['errors']
+        stats['names_per_second'] = round(screened / stats['seconds'], 1) if stats['seconds'] else None
+        stats['processes'] = self.processes
+        return stats
@@ -0,0 +1,386 @@
+"""Benchmarks for the entity viewer on synthetic feeds.
+
+``python benchmark.py generate`` writes a synthetic entities.csv in the real
+record shape (raw.datasets codes, aliases, addresses, notes, documents).
+``python benchmark.py run`` generates feeds of the requested sizes and, for
+each, starts a fresh process that imports the app against that feed (so cold
+start and peak RSS are measured cleanly), serves document downloads from a
+local stub upstream, drives the routes through the WSGI app and reports
+latency percentiles and throughput.  Results are written as JSON;
+``python benchmark.py compare old.json new.json`` shows the change between
+two runs.
+"""
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import click
+
+DEFAULT_SIZES = (1000, 100000)
+DEFAULT_REQUESTS = 200
+STUB_PORT = 18765
+DOCUMENT_BYTES = 64 * 1024
+LOCALES = ('en', 'it', 'mt', 'fr', 'de', 'sl', 'hr', 'nl', 'es', 'pt')
+
+FIRST_NAMES = ('John', 'Maria', 'José', 'Anna', 'Ivan', 'Mohammed', 'Li', 'Giorgio', 'Sophie', 'Hans',
+               'Olga', 'Pierre', 'Fatima', 'Luca', 'Zoë', 'Ahmed', 'Elena', 'Karl', 'Nadia', 'Tomás')
+LAST_NAMES = ('Smith', 'Müller', 'Borg', 'Rossi', 'Ivanov', 'García', 'Camilleri', 'Dubois', 'Schmidt',
+              'Novak', 'Al-Hassan', 'Wang', 'Horvat', 'de Vries', 'Silva', 'Kowalski', 'Farrugia')
+COMPANY_WORDS = ('Global', 'Atlantic', 'Trading', 'Holdings', 'Capital', 'Marine', 'Energy', 'Logistics',
+                 'Pharma', 'Gaming', 'Realisations', 'Properties', 'Ventures', 'Services', 'Mining',
+                 'Shipping', 'Finance', 'Investments', 'Construction', 'Textiles', 'Bank of Commerce')
+COMPANY_SUFFIXES = ('Limited', 'Ltd', 'Inc', 'PLC', 'GmbH', 'S.p.A.', 'LLC', 'S.A.', 'B.V.', 'Co.')
+COUNTRIES = ('United Kingdom', 'GB', 'Malta', 'MT', 'Italy', 'Germany', 'Deutschland', 'France',
+             'Russia', 'UAE', 'United States', 'USA', 'Cyprus', 'Netherlands', 'Spain', 'Brazil')
+CITIES = ('London', 'Valletta', 'Milan', 'Berlin', 'Paris', 'Moscow', 'Dubai', 'New York', 'Limassol')
+DATASET_CODES = (('RRE', 0.5), ('POI', 0.25), ('SAN', 0.1), ('INS', 0.1), ('REL', 0.05))
+CATEGORIES = ('PEP', 'Sanctions', 'Adverse Media', 'Insolvency', 'Law Enforcement')
+
+
+def _name(rng):
+    if rng.random() < 0.4:
+        return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    words = rng.sample(COMPANY_WORDS, rng.randint(1, 3))
+    return f"{rng.choice(LAST_NAMES)} {' '.join(words)} {rng.choice(COMPANY_SUFFIXES)}"
+
+
+def synthetic_record(rng, position, stub_url):
+    """One feed record (as a dict) in the entities.csv shape"""
+    name = _name(rng)
+    reference = str(100000 + position)
+    datasets = [code for code, share in DATASET_CODES if rng.random() < share] or ['RRE']
+    documents = []
+    for number in range(rng.choices((0, 1, 2, 3), (0.3, 0.4, 0.2, 0.1))[0]):
+        document_reference = f"{reference}{number}"
+        documents.append({
+            'reference': document_reference,
+            'url': f"{stub_url}/documents/{document_reference}.pdf",
+            'categories': rng.sample(CATEGORIES, rng.randint(1, 2)),
+            'extraData': {'title': f"Report on {name}", 'summary': "The source contains media information about the subject."},
+        })
+    addresses = []
+    for _ in range(rng.choices((0, 1, 2), (0.4, 0.45, 0.15))[0]):
+        address = {
+            'line1': f"{rng.randint(1, 200)} {rng.choice(LAST_NAMES)} Street",
+            'city': rng.choice(CITIES),
+            'postcode': f"{rng.randint(1000, 99999)}",
+        }
+        # The feed carries ISO codes in countryIsoCode; free-text countries come from older exports
+        country = rng.choice(COUNTRIES)
+        address['countryIsoCode' if len(country) == 2 else 'country'] = country
+        addresses.append(address)
+    return {
+        '_id': {'$oid': f"{position:024x}"},
+        'name': name,
+        'reference': reference,
+        'fullname': name,
+        'aliases': [{'type': 'Name Spelling Variation', 'name': _name(rng)}
+                    for _ in range(rng.choices((0, 1, 2, 3), (0.5, 0.3, 0.15, 0.05))[0])],
+        'notes': [{'text': 'Reputational Risk Exposure'}] if rng.random() < 0.5 else [],
+        'documents': documents,
+        'businesses': [{'name': _name(rng), 'position': 'Director', 'reference': str(rng.randint(1, 10 ** 6))}
+                       for _ in range(rng.choices((0, 1, 2), (0.6, 0.3, 0.1))[0])],
+        'insolvent': 'INS' in datasets,
+        'media': 'RRE' in datasets,
+        'financialRegulator': rng.random() < 0.05,
+        'raw': {
+            'name': name,
+            'version': 1652000000000 + rng.randint(0, 10 ** 10),
+            'datasets': datasets,
+            'addresses': addresses,
+            'isDeleted': False,
+        },
+    }
+
+
+def generate_feed(path, rows, seed=0, stub_url=f"http://127.0.0.1:{STUB_PORT}"):
+    """Write a synthetic feed of ``rows`` records to ``path``"""
+    rng = random.Random(seed)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for position in range(rows):
+            f.write('"' + json.dumps(synthetic_record(rng, position, stub_url), ensure_ascii=False) + '"\n')
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Upstream stand-in: every path is a DOCUMENT_BYTES document"""
+
+    body = bytes(range(256)) * (DOCUMENT_BYTES // 256)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.send_header('ETag', f'"{len(self.body)}"')
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=STUB_PORT):
+    """Serve stub documents on 127.0.0.1:``port`` from a daemon thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values`` (sorted in place)"""
+    values.sort()
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def call(app, environ):
+    """Run one request through the WSGI app; return ``(status, body bytes)``"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+
+    body = app(environ, start_response)
+    try:
+        size = sum(len(chunk) for chunk in body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return started['status'], size
+
+
+def time_route(app, requests):
+    """Time ``(path, query, headers)`` requests and summarize the latencies"""
+    from werkzeug.test import EnvironBuilder
+
+    latencies = []
+    errors = 0
+    size = 0
+    started = time.perf_counter()
+    for path, query, headers in requests:
+        environ = EnvironBuilder(path=path, query_string=query, headers=headers).get_environ()
+        began = time.perf_counter()
+        status, length = call(app, environ)
+        latencies.append(time.perf_counter() - began)
+        size += length
+        if status >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'bytes': size,
+    }
+
+
+def route_requests(snapshot, count, seed=0):
+    """Deterministic request mixes for each benchmarked route"""
+    rng = random.Random(seed)
+    live = [entity_id for entity_id in range(len(snapshot.entities)) if entity_id not in snapshot.dead]
+    sample = [snapshot.entities[rng.choice(live)] for _ in range(count)]
+    words = [word for entity in sample for word in entity.name.split() if len(word) > 2]
+    references = [document['reference'] for entity in sample for document in entity.documents
+                  if document.get('reference')]
+
+    entities = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            query = {'limit': 100}
+        elif kind == 1:
+            query = {'q': rng.choice(words).lower()}
+        elif kind == 2:
+            query = {'q': rng.choice(words)[:3].lower(), 'match': 'prefix'}
+        else:
+            query = {'dataset': 'sanctions', 'risk_level': 'HIGH'}
+        entities.append(('/api/entities', query, {}))
+    return {
+        'get_entities': entities,
+        'entity_detail': [(f"/entity/{entity.slug}", {'lang': rng.choice(LOCALES)}, {}) for entity in sample],
+        'sitemap_xml': [('/sitemap.xml' if i % 2 == 0 else '/sitemap-1.xml', {}, {}) for i in range(count)],
+        'proxy_document': [(f"/proxy/document/{rng.choice(references)}", {}, {})
+                           for _ in range(count if references else 0)],
+    }
+
+
+def run_one(requests_per_route, seed):
+    """Benchmark the app in this process (ENTITY_DATA_DIR must point at the feed)"""
+    started = time.perf_counter()
+    import app as viewer
+    imported = time.perf_counter()
+    snapshot = viewer.get_entities_snapshot()
+    loaded = time.perf_counter()
+    status, _size = call(viewer.app, _environ('/api/entities', {'limit': 1}))
+    first_request = time.perf_counter()
+
+    stub = start_stub()
+    try:
+        routes = {}
+        for route, requests in route_requests(snapshot, requests_per_route, seed).items():
+            if requests:
+                routes[route] = time_route(viewer.app, requests)
+    finally:
+        stub.shutdown()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'entities': len(snapshot),
+        'cold_start': {
+            'import_s': round(imported - started, 3),
+            'load_s': round(loaded - imported, 3),
+            'first_request_s': round(first_request - loaded, 3),
+            'total_s': round(first_request - started, 3),
+            'first_request_status': status,
+        },
+        'peak_rss_mb': round(usage.ru_maxrss * scale / 2 ** 20, 1),
+        'routes': routes,
+    }
+
+
+def _environ(path, query):
+    from werkzeug.test import EnvironBuilder
+    return EnvironBuilder(path=path, query_string=query).get_environ()
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'created': time.time(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+@click.group()
+def cli():
+    """Entity viewer benchmarks"""
+
+
+@cli.command()
+@click.option('--rows', type=int, default=1000, help='Number of records')
+@click.option('--output', type=click.Path(dir_okay=False), required=True, help='Feed file to write')
+@click.option('--seed', type=int, default=0)
+def generate(rows, output, seed):
+    """Write a synthetic entities.csv feed"""
+    started = time.perf_counter()
+    generate_feed(output, rows, seed)
+    click.echo(f"Wrote {rows} records to {output} ({time.perf_counter() - started:.1f}s)", err=True)
+
+
+@cli.command()
+@click.option('--rows', type=int, multiple=True, help='Feed sizes to benchmark (repeatable)')
+@click.option('--requests', 'requests_per_route', type=int, default=DEFAULT_REQUESTS, help='Requests per route')
+@click.option('--compiled', is_flag=True, help='Serve from a compiled snapshot instead of parsing the feed')
+@click.option('--workdir', type=click.Path(file_okay=False), default=None,
+              help='Where feeds are generated (and kept between runs)')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='JSON results file (default stdout)')
+@click.option('--seed', type=int, default=0)
+def run(rows, requests_per_route, compiled, workdir, output, seed):
+    """Benchmark cold start, memory and route latency for each feed size"""
+    workdir = Path(workdir or Path(tempfile.gettempdir()) / 'entity-viewer-bench')
+    results = []
+    for size in rows or DEFAULT_SIZES:
+        data_dir = workdir / str(size)
+        feed = data_dir / 'entities.csv'
+        if not feed.exists():
+            click.echo(f"Generating {size} records...", err=True)
+            generate_feed(feed, size, seed)
+        env = dict(os.environ, ENTITY_DATA_DIR=str(data_dir),
+                   DOCUMENT_CACHE_DIR=tempfile.mkdtemp(prefix='bench-documents-'))
+        env.setdefault('LOG_LEVEL', 'WARNING')
+        snapshot_path = data_dir / 'entities.snap'
+        if compiled:
+            subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'compile-snapshot',
+                            '--source', str(feed), '--output', str(snapshot_path)],
+                           cwd=Path(__file__).parent, env=env, check=True, stdout=subprocess.DEVNULL)
+        elif snapshot_path.exists():
+            snapshot_path.unlink()
+
+        click.echo(f"Benchmarking {size} records...", err=True)
+        with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+            subprocess.run([sys.executable, __file__, 'run-one', '--requests', str(requests_per_route),
+                            '--seed', str(seed), '--result', result_file.name],
+                           cwd=Path(__file__).parent, env=env, check=True)
+            with open(result_file.name, encoding='utf-8') as f:
+                result = json.load(f)
+        result.update(rows=size, compiled=compiled)
+        results.append(result)
+        for route, stats in result['routes'].items():
+            click.echo(f"  {route:15} p50 {stats['p50_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms  "
+                       f"{stats['requests_per_second']:9.1f} req/s", err=True)
+        click.echo(f"  cold start {result['cold_start']['total_s']:.2f}s, peak RSS {result['peak_rss_mb']} MB", err=True)
+
+    report = json.dumps({'meta': _metadata(), 'results': results}, indent=2)
+    if output:
+        Path(output).write_text(report + '\n', encoding='utf-8')
+    else:
+        click.echo(report)
+
+
+@cli.command('run-one', hidden=True)
+@click.option('--requests', 'requests_per_route', type=int, default=DEFAULT_REQUESTS)
+@click.option('--seed', type=int, default=0)
+@click.option('--result', type=click.Path(dir_okay=False), required=True)
+def run_one_command(requests_per_route, seed, result):
+    """Benchmark the app against ENTITY_DATA_DIR in this process"""
+    Path(result).write_text(json.dumps(run_one(requests_per_route, seed)), encoding='utf-8')
+
+
+@cli.command()
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+def compare(baseline, current):
+    """Show the change in latency, memory and cold start between two runs"""
+    def by_size(path):
+        with open(path, encoding='utf-8') as f:
+            results = json.load(f)['results']
+        return {(result['rows'], result.get('compiled')): result for result in results}
+
+    def change(old, new):
+        if not old:
+            return 'n/a'
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    before = by_size(baseline)
+    for key, new in by_size(current).items():
+        old = before.get(key)
+        if old is None:
+            continue
+        click.echo(f"{key[0]} records{' (compiled)' if key[1] else ''}:")
+        click.echo(f"  cold start {old['cold_start']['total_s']}s -> {new['cold_start']['total_s']}s "
+                   f"({change(old['cold_start']['total_s'], new['cold_start']['total_s'])}), "
+                   f"peak RSS {old['peak_rss_mb']} -> {new['peak_rss_mb']} MB "
+                   f"({change(old['peak_rss_mb'], new['peak_rss_mb'])})")
+        for route, stats in new['routes'].items():
+            previous = old['routes'].get(route)
+            if previous:
+                click.echo(f"  {route:15} p50 {change(previous['p50_ms'], stats['p50_ms']):>8}  "
+                           f"p99 {change(previous['p99_ms'], stats['p99_ms']):>8}  "
+                           f"req/s {change(previous['requests_per_second'], stats['requests_per_second']):>8}")
+
+
+if __name__ == '__main__':
+    cli()
@@ -4,17 +4,20 @@
 mkdir -p .output
 mkdir -p .output/functions
 
-# Copy application files
-cp -r app.py data static templates translations messages.pot babel.cfg requirements.txt .output/
+# Compile the entity feed into a memory-mappable snapshot (data/entities.snap)
+python -m flask --app app compile-snapshot
+
+# Copy application files (benchmark.py and its stub upstream stay out of the deploy)
+for module in *.py; do
+    [ "$module" = benchmark.py ] || cp "$module" .output/
+done
+# -p keeps the feed's mtime, which the store compares with the one in entities.snap
+cp -rp data static templates translations messages.pot babel.cfg requirements.txt .output/
 
 # Copy functions
 cp -r functions/* .output/functions/
 
-# Create _routes.json for static asset handling
-cat > .output/_routes.json << 'EOL'
-{
-  "version": 1,
-  "include": ["/*"],
-  "exclude": []
-}
-EOL
+# Pre-render entity pages, sitemaps and the search index as static files;
+# this also writes _routes.json so Pages serves them without the function.
+# Keep .output between builds to only re-render changed entities.
+python -m flask --app app export-static --output .output
@@ -0,0 +1,137 @@
+"""Country name and code resolution.
+
+Every name, official name and common name known to pycountry, plus
+COUNTRY_ALTERNATIVES, is folded into one normalized lookup table when the
+module is imported.  ISO codes (alpha-2, alpha-3, numeric) go in a separate
+table matched case-sensitively, so only upper-case input is taken for a code:
+otherwise common words in free text ("and", "can", "per") would resolve to
+countries.  Strings missing from both tables fall back to
+``pycountry.countries.search_fuzzy``, which scans every country and
+subdivision; its results are memoized in an LRU cache and names that resolve
+to nothing are counted for reporting.
+"""
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+
+import pycountry
+
+from search import fold
+
+FUZZY_CACHE_SIZE = 4096
+# Shorter strings are codes or nothing: search_fuzzy would match them as
+# substrings of names and case-insensitively as codes
+MIN_FUZZY_LENGTH = 4
+# Distinct unresolved names remembered for get_stats()
+MAX_TRACKED_UNRESOLVED = 1000
+
+# Generate country codes from pycountry
+COUNTRY_CODES = {country.alpha_2: country.name for country in pycountry.countries}
+
+# Add common alternative names and codes (all upper case)
+COUNTRY_ALTERNATIVES = {
+    'UK': 'GB',  # United Kingdom
+    'USA': 'US',  # United States
+    'UAE': 'AE',  # United Arab Emirates
+    'Russia': 'RU',
+    'Taiwan': 'TW',
+    'Iran': 'IR',
+    'North Korea': 'KP',
+    'South Korea': 'KR',
+    'Syria': 'SY',
+    'Venezuela': 'VE',
+}
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize(name):
+    """Fold case and accents and collapse whitespace"""
+    return _WHITESPACE_RE.sub(' ', fold(name)).strip()
+
+
+def _build_tables():
+    codes = {}
+    names = {}
+    for country in pycountry.countries:
+        for field in ('alpha_2', 'alpha_3', 'numeric'):
+            codes.setdefault(getattr(country, field), country.alpha_2)
+        for field in ('name', 'official_name', 'common_name'):
+            value = getattr(country, field, None)
+            if value:
+                names.setdefault(normalize(value), country.alpha_2)
+    for name, code in COUNTRY_ALTERNATIVES.items():
+        if name.isupper():
+            codes[name] = code
+        else:
+            names[normalize(name)] = code
+    return codes, names
+
+
+CODE_TABLE, COUNTRY_TABLE = _build_tables()
+
+
+@lru_cache(maxsize=FUZZY_CACHE_SIZE)
+def _fuzzy_lookup(name):
+    try:
+        countries = pycountry.countries.search_fuzzy(name)
+    except LookupError:
+        return None
+    return countries[0].alpha_2 if countries else None
+
+
+class CountryResolver:
+    """Resolves free-text country names and codes to alpha-2 codes"""
+
+    def __init__(self, table=COUNTRY_TABLE, codes=CODE_TABLE):
+        self.table = table
+        self.codes = codes
+        self._lock = threading.Lock()
+        self._unresolved = Counter()
+        self.stats = {'lookups': 0, 'table_hits': 0, 'fuzzy_lookups': 0, 'unresolved': 0}
+
+    def _count(self, key, name=None):
+        with self._lock:
+            self.stats['lookups'] += 1
+            self.stats[key] += 1
+            if name is not None and (name in self._unresolved
+                                     or len(self._unresolved) < MAX_TRACKED_UNRESOLVED):
+                self._unresolved[name] += 1
+
+    def lookup(self, name_or_code):
+        """Return the alpha-2 code for an exact (upper-case) code, name or alias, or None"""
+        code = self.codes.get(name_or_code.strip())
+        if code:
+            return code
+        return self.table.get(normalize(name_or_code))
+
+    def resolve(self, name_or_code):
+        """Return the alpha-2 code for ``name_or_code``, falling back to fuzzy search"""
+        code = self.lookup(name_or_code)
+        if code:
+            self._count('table_hits')
+            return code
+        code = _fuzzy_lookup(name_or_code) if len(normalize(name_or_code)) >= MIN_FUZZY_LENGTH else None
+        if code:
+            self._count('fuzzy_lookups')
+        else:
+            self._count('unresolved', name_or_code)
+        return code
+
+    def get_stats(self, top=20):
+        """Return lookup counters, fuzzy memo usage and the most common unresolved names"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['top_unresolved'] = self._unresolved.most_common(top)
+        info = _fuzzy_lookup.cache_info()
+        stats['fuzzy_cache'] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+        return stats
+
+
+country_resolver = CountryResolver()
+
+
+def get_country_code(name_or_code):
+    """Get standardized country code from name or code"""
+    return country_resolver.resolve(name_or_code)
@@ -0,0 +1,144 @@
+"""Building blocks for incremental (delta) updates of entity snapshots.
+
+A delta is a feed fragment in the entities.csv format: every record is an
+upsert keyed by its ``_id.$oid``, or a deletion when ``raw.isDeleted`` is
+set.  A change only applies when its ``raw.version`` is at least the version
+currently held for that id, so replaying old deltas is harmless.
+
+Applying a delta never rewrites the shared indexes of the previous snapshot:
+the new versions of changed entities are appended under fresh ids, the ids
+they replace become tombstones, and the containers below layer the (small)
+additions over the (large) unchanged base.
+"""
+from collections.abc import Sequence
+
+_MISSING = object()
+
+
+class Deletion:
+    """A feed record marking entity ``oid`` as deleted"""
+
+    __slots__ = ('oid', 'version')
+
+    def __init__(self, oid, version=None):
+        self.oid = oid
+        self.version = version
+
+    def __repr__(self):
+        return f"<Deletion {self.oid}>"
+
+
+def supersedes(change, current):
+    """Whether ``change`` (an entity or Deletion) may replace ``current``"""
+    if current is None or change.version is None or current.version is None:
+        return True
+    return change.version >= current.version
+
+
+def resolve_changes(records, deletions=None):
+    """Apply ``records`` in order to an empty feed and return the surviving entities.
+
+    An entity takes the position of the last record that upserted it, which
+    is where an incremental update appending the same records would put it.
+    Records without an id are always kept.  When a ``deletions`` dict is
+    given it receives ``oid -> Deletion`` for the ids that end up deleted.
+    """
+    latest = {}
+    for position, record in enumerate(records):
+        key = record.oid if record.oid else ('', position)
+        current = latest.get(key)
+        if current is not None and not supersedes(record, current):
+            continue
+        latest.pop(key, None)
+        latest[key] = record
+    if deletions is not None:
+        deletions.update((record.oid, record) for record in latest.values()
+                         if isinstance(record, Deletion) and record.oid)
+    return [record for record in latest.values() if not isinstance(record, Deletion)]
+
+
+class AppendedSequence(Sequence):
+    """Read-only concatenation of a base sequence and a list of appended items"""
+
+    def __init__(self, base, extra):
+        if isinstance(base, AppendedSequence):
+            base, extra = base.base, base.extra + list(extra)
+        self.base = base
+        self.extra = list(extra)
+        self._base_len = len(base)
+
+    def __len__(self):
+        return self._base_len + len(self.extra)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if position < self._base_len:
+            return self.base[position]
+        return self.extra[position - self._base_len]
+
+    def __iter__(self):
+        yield from self.base
+        yield from self.extra
+
+
+class PatchedSequence(AppendedSequence):
+    """AppendedSequence whose items can also be replaced by position"""
+
+    def __init__(self, base, extra=(), overrides=None):
+        if isinstance(base, PatchedSequence):
+            overrides = {**base.overrides, **(overrides or {})}
+        super().__init__(base, extra)
+        self.overrides = dict(overrides or {})
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        item = self.overrides.get(position, _MISSING)
+        return super().__getitem__(position) if item is _MISSING else item
+
+    def __iter__(self):
+        if not self.overrides:
+            return super().__iter__()
+        return (self[i] for i in range(len(self)))
+
+
+class OverlayMapping:
+    """Read-only mapping of ``changes`` layered over ``base``.
+
+    A None value in ``changes`` hides the base key.  ``base`` only needs
+    ``get``; stacking an overlay on an overlay flattens the changes.
+    """
+
+    def __init__(self, base, changes):
+        if isinstance(base, OverlayMapping):
+            base, changes = base.base, {**base.changes, **changes}
+        self.base = base
+        self.changes = changes
+
+    def get(self, key, default=None):
+        value = self.changes.get(key, _MISSING)
+        if value is _MISSING:
+            return self.base.get(key, default)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def items(self):
+        for key, value in self.base.items():
+            if key not in self.changes:
+                yield key, value
+        for key, value in self.changes.items():
+            if value is not None:
+                yield key, value
@@ -0,0 +1,219 @@
+"""Detail tier of the entity records: notes, documents, addresses, businesses.
+
+List and search views only need the fields entities keep in ``__slots__``,
+so the detail fields are not normalized while the feed loads.  An entity
+loaded from the main feed only remembers where its line is (a FeedLine in
+the FeedSource the feed was read from); the first time a detail page or the
+document proxy asks for it, the line is read back, parsed and normalized by
+``normalize_detail``.  Results are memoized in a bounded LRU (DetailCache),
+so popular entities are not re-parsed on every request.
+
+Records from delta files, and compiled snapshots, keep their detail
+normalized up front as a compressed blob (see ``entities.encode_detail``).
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from countries import country_resolver
+
+# Documents hosted here are only reachable through /proxy/document
+PROXIED_DOCUMENT_HOSTS = ('https://www.acurisriskintelligence.com/', 'https://secure.c6-intelligence.com/')
+PROXY_DOCUMENT_URL = 'https://localhost:5000/proxy/document/{reference}'
+# Private detail key mapping document references to their upstream URLs,
+# for documents whose public URL was rewritten to go through the proxy
+DOCUMENT_SOURCES = 'document_sources'
+DEFAULT_CACHE_ENTRIES = 10000
+# Populated fields of a raw address making up its text, country excluded
+ADDRESS_FIELDS = ('line1', 'line2', 'line3', 'line4', 'city', 'county', 'postcode')
+
+logger = logging.getLogger(__name__)
+
+
+def _raw_country(address):
+    """Country of a raw address: the feed's ISO code, or a free-text country"""
+    return address.get('countryIsoCode') or address.get('country') or ''
+
+
+def _address_parts(address):
+    parts = [address[field] for field in ADDRESS_FIELDS if address.get(field)]
+    country = _raw_country(address)
+    return parts + [country] if country else parts
+
+
+def _address_country(address):
+    """Lower-case country code of a raw address, or its country as typed"""
+    country = _raw_country(address)
+    if country:
+        # Exact name/code/alias lookup in the precomputed table
+        country_code = country_resolver.lookup(country)
+        if country_code:
+            return country_code.lower()
+    return country.lower()
+
+
+def address_countries(addresses):
+    """Countries of the raw ``raw.addresses`` entries, as the detail tier reports them"""
+    return sorted({country for country in (_address_country(address) for address in addresses
+                                           if isinstance(address, dict) and _address_parts(address))
+                   if country})
+
+
+def document_references(documents):
+    """References of the raw documents, in feed order"""
+    return [document['reference'] for document in documents
+            if isinstance(document, dict) and document.get('reference')]
+
+
+def normalize_detail(data):
+    """Normalized detail dict of a raw feed record"""
+    detail = {
+        'notes': [{'text': note.get('text', '')} for note in data.get('notes', [])
+                  if isinstance(note, dict) and note.get('text')],
+        'documents': [],
+        'addresses': [],
+        'businesses': [{
+            'name': business.get('name'),
+            'position': business.get('position'),
+            'reference': business.get('reference')
+        } for business in data.get('businesses', []) if isinstance(business, dict) and business.get('name')],
+    }
+
+    for address in data.get('raw', {}).get('addresses', []):
+        if isinstance(address, dict):
+            parts = _address_parts(address)
+            if parts:
+                detail['addresses'].append({'text': ', '.join(parts), 'country': _address_country(address)})
+
+    for document in data.get('documents', []):
+        if isinstance(document, dict):
+            url = document.get('url', '')
+            if url and url.startswith(PROXIED_DOCUMENT_HOSTS):
+                # Keep the upstream URL privately for the proxy
+                detail.setdefault(DOCUMENT_SOURCES, {})[document.get('reference')] = url
+                url = PROXY_DOCUMENT_URL.format(reference=document.get('reference'))
+            normalized = {
+                'reference': document.get('reference'),
+                'title': document.get('extraData', {}).get('title'),
+                'summary': document.get('extraData', {}).get('summary'),
+                'url': url,
+                'categories': document.get('categories', [])
+            }
+            if any(normalized.values()):
+                detail['documents'].append(normalized)
+    return detail
+
+
+def parse_line(line):
+    """Parse one feed line (bytes or str) into its raw record dict"""
+    line = line.strip()
+    if isinstance(line, bytes):
+        line = line.strip(b'"')
+    else:
+        line = line.strip('"')
+    return json.loads(line)
+
+
+class FeedSource:
+    """An open feed file that entity lines are read back from.
+
+    Holding the file open keeps reading the content that was parsed even if
+    the file is replaced (renamed over) afterwards; entities of a feed that
+    was rewritten in place are caught by the record id check in FeedLine.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+
+    def read_all(self):
+        """Read the whole file"""
+        with self._lock:
+            self._file.seek(0)
+            return self._file.read()
+
+    def read(self, offset, length):
+        """Read ``length`` bytes at ``offset``"""
+        if hasattr(os, 'pread'):
+            # No shared file position: safe across threads and forked workers
+            return os.pread(self._file.fileno(), length, offset)
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def same_file(self, other):
+        """Whether ``other`` has the same file open"""
+        return os.path.samestat(os.fstat(self._file.fileno()), os.fstat(other._file.fileno()))
+
+    def close(self):
+        self._file.close()
+
+
+class FeedLine:
+    """Where an entity's record sits in a FeedSource"""
+
+    __slots__ = ('source', 'offset', 'length')
+
+    def __init__(self, source, offset, length):
+        self.source = source
+        self.offset = offset
+        self.length = length
+
+    def load(self, oid=None):
+        """Read, parse and normalize the record; None if it is no longer there"""
+        try:
+            data = parse_line(self.source.read(self.offset, self.length))
+        except (OSError, ValueError) as e:
+            logger.warning("Error reading line at %d of %s: %s", self.offset, self.source.path, e)
+            return None
+        if oid is not None and (data.get('_id') or {}).get('$oid') != oid:
+            logger.warning("Record %s moved in %s, which changed in place", oid, self.source.path)
+            return None
+        return normalize_detail(data)
+
+
+class DetailCache:
+    """LRU of normalized detail dicts, keyed by the entity's detail source"""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def get(self, key):
+        with self._lock:
+            detail = self._entries.get(key)
+            if detail is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return detail
+
+    def put(self, key, detail):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = detail
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def discard_source(self, source):
+        """Drop the details read from the FeedSource ``source``"""
+        with self._lock:
+            for key in [key for key in self._entries if isinstance(key, FeedLine) and key.source is source]:
+                del self._entries[key]
+
+    def get_stats(self):
+        """Return hit/miss/eviction counters and the number of cached details"""
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), max_entries=self.max_entries)
+
+
+detail_cache = DetailCache()
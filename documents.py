@@ -0,0 +1,665 @@
+"""Streaming proxy and disk cache for evidence documents.
+
+Upstream documents are fetched through one pooled ``requests.Session`` with
+bounded timeouts and copied to the client chunk by chunk, so a large PDF never
+sits in worker memory.  Conditional and Range request headers are forwarded;
+when the upstream ignores a Range the requested slice is cut from the stream
+here, so PDF viewers can always load pages lazily.
+
+DocumentCache keeps fetched documents on local disk, content-addressed by
+SHA-256, evicts least recently used bodies beyond a size cap (shared by every
+process using the directory) and revalidates stale entries with the
+upstream's validators.  A miss downloads the document
+into the cache in a background thread, independent of any client: the
+request that missed and any concurrent requests for the same reference
+stream the partially written file as it grows, and Range requests are passed
+straight through to the upstream instead of waiting for the whole body.
+"""
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): evictions are only serialized within a process
+    fcntl = None
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_POOL_SIZE = 32
+
+# Client headers forwarded to the upstream server
+FORWARDED_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+# Upstream response headers copied to the client
+PASSTHROUGH_HEADERS = (
+    'Content-Length', 'Content-Range', 'Accept-Ranges', 'Content-Encoding',
+    'ETag', 'Last-Modified', 'Cache-Control',
+)
+
+logger = logging.getLogger(__name__)
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def build_document_index(entities, shared=None):
+    """Map every document reference to the id of the first entity listing it.
+
+    When a ``shared`` dict is given it receives ``reference -> ids``
+    (ascending) for the references listed by more than one entity.
+    """
+    index = {}
+    for entity_id, entity in enumerate(entities):
+        for reference in entity.references:
+            holder = index.setdefault(reference, entity_id)
+            if shared is not None and holder != entity_id:
+                holders = shared.setdefault(reference, [holder])
+                if holders[-1] != entity_id:
+                    holders.append(entity_id)
+    if shared:
+        for reference, holders in shared.items():
+            shared[reference] = tuple(holders)
+    return index
+
+
+def update_document_index(documents, shared, entities, gone, removed, added):
+    """Re-resolve the references listed by the ``removed`` and ``added`` entities.
+
+    ``documents`` and ``shared`` are the current index and shared references
+    (see build_document_index), ``entities`` the id-addressable entities
+    including the ``added`` ids and ``gone`` every tombstoned id, ``removed``
+    included.  Returns ``(document_changes, shared_changes)``: key changes to
+    layer over the two mappings (None removes a key).
+    """
+    references = {}
+    for entity_id in removed:
+        for reference in entities[entity_id].references:
+            references.setdefault(reference, [])
+    for entity_id in added:
+        for reference in entities[entity_id].references:
+            new_ids = references.setdefault(reference, [])
+            if not new_ids or new_ids[-1] != entity_id:
+                new_ids.append(entity_id)
+
+    document_changes = {}
+    shared_changes = {}
+    for reference, new_ids in references.items():
+        holders = shared.get(reference)
+        if holders is None:
+            holder = documents.get(reference)
+            holders = () if holder is None else (holder,)
+        # Added ids are above every existing id, so feed order is kept
+        holders = [entity_id for entity_id in holders if entity_id not in gone] + new_ids
+        document_changes[reference] = holders[0] if holders else None
+        shared_changes[reference] = tuple(holders) if len(holders) > 1 else None
+    return document_changes, shared_changes
+
+
+def parse_range(header, length):
+    """Return the ``(start, end)`` byte range (inclusive) of a Range header.
+
+    Only single ranges are supported; anything else returns None, meaning
+    the whole document should be sent.  Raises ValueError when the range
+    cannot be satisfied for a document of ``length`` bytes.
+    """
+    match = _RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        suffix = int(last)
+        if not suffix:
+            raise ValueError(header)
+        return max(length - suffix, 0), length - 1
+    start = int(first)
+    end = min(int(last), length - 1) if last else length - 1
+    if start >= length or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+def iter_body(upstream, start=0, end=None):
+    """Yield the raw upstream body, optionally sliced, then close the response"""
+    try:
+        position = 0
+        # decode_content=False keeps the bytes identical to Content-Length
+        for chunk in upstream.raw.stream(CHUNK_SIZE, decode_content=False):
+            chunk_end = position + len(chunk)
+            if chunk_end > start:
+                chunk = chunk[max(start - position, 0):]
+                if end is not None and chunk_end > end + 1:
+                    chunk = chunk[:len(chunk) - (chunk_end - end - 1)]
+                if chunk:
+                    yield chunk
+            position = chunk_end
+            if end is not None and position > end:
+                break
+    finally:
+        upstream.close()
+
+
+def weak_etag(reference, headers):
+    """Validator for upstreams that send no ETag of their own"""
+    length = headers.get('Content-Length')
+    modified = headers.get('Last-Modified')
+    if not length and not modified:
+        return None
+    return f'W/"{reference}-{length or ""}-{modified or ""}"'
+
+
+class ProxiedDocument:
+    """Status, headers and streamed body of a proxied document response"""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class DocumentProxy:
+    """Fetches upstream documents over a shared keep-alive connection pool"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def open(self, url, headers=None):
+        """Start a streamed upstream GET with the given request headers"""
+        return self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+
+    def fetch(self, reference, url, request_headers):
+        """Proxy ``url`` for the given client headers.
+
+        Returns a ProxiedDocument for 200, 206, 304 and 416 responses, or
+        the closed upstream response's status code as an int otherwise.
+        """
+        headers = {name: request_headers[name] for name in FORWARDED_HEADERS
+                   if request_headers.get(name)}
+        return self.respond(reference, self.open(url, headers), request_headers)
+
+    def respond(self, reference, upstream, request_headers):
+        """Turn an opened upstream response into a ProxiedDocument (see fetch)"""
+        status = upstream.status_code
+        if status not in (200, 206, 304):
+            upstream.close()
+            return status
+
+        headers = {name: upstream.headers[name] for name in PASSTHROUGH_HEADERS
+                   if name in upstream.headers}
+        if 'ETag' not in headers:
+            etag = weak_etag(reference, upstream.headers)
+            if etag:
+                headers['ETag'] = etag
+        if status == 304:
+            upstream.close()
+            return ProxiedDocument(304, headers, ())
+        headers['Content-Type'] = upstream.headers.get('Content-Type', '')
+
+        length = headers.get('Content-Length')
+        sliceable = length and 'Content-Encoding' not in headers
+        if sliceable:
+            # PDF viewers only issue Range requests when this is advertised
+            headers['Accept-Ranges'] = 'bytes'
+        range_header = request_headers.get('Range')
+        if status == 206 or not range_header or not sliceable:
+            return ProxiedDocument(status, headers, iter_body(upstream))
+
+        # The upstream ignored the Range; slice the full body ourselves
+        if_range = request_headers.get('If-Range')
+        validators = {headers.get('Last-Modified')}
+        if not headers.get('ETag', '').startswith('W/'):
+            validators.add(headers.get('ETag'))
+        if if_range and if_range not in validators:
+            return ProxiedDocument(status, headers, iter_body(upstream))
+        length = int(length)
+        try:
+            byte_range = parse_range(range_header, length)
+        except ValueError:
+            upstream.close()
+            headers['Content-Range'] = f'bytes */{length}'
+            headers['Content-Length'] = '0'
+            return ProxiedDocument(416, headers, ())
+        if byte_range is None:
+            return ProxiedDocument(status, headers, iter_body(upstream))
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+        headers['Content-Length'] = str(end - start + 1)
+        return ProxiedDocument(206, headers, iter_body(upstream, start, end))
+
+
+class CachedDocument:
+    """A document body held in the disk cache, with its upstream validators.
+
+    The entries DocumentCache.fetch returns hold their body open in ``file``,
+    so a response keeps reading it even if the body is evicted meanwhile.
+    """
+
+    def __init__(self, reference, url, digest, size, content_type=None, etag=None,
+                 last_modified=None, checked_at=0.0, path=None):
+        self.reference = reference
+        self.url = url
+        self.digest = digest
+        self.size = size
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = checked_at
+        self.path = path
+        self.file = None
+
+    def opened(self):
+        """A copy of this entry with its body open for reading; raises OSError once it is evicted"""
+        document = copy.copy(self)
+        document.file = open(self.path, 'rb')
+        return document
+
+    @property
+    def last_modified_at(self):
+        """Upstream Last-Modified as a datetime, or None"""
+        try:
+            return parsedate_to_datetime(self.last_modified) if self.last_modified else None
+        except (TypeError, ValueError):
+            return None
+
+    def to_json(self):
+        return {
+            'reference': self.reference, 'url': self.url, 'digest': self.digest,
+            'size': self.size, 'content_type': self.content_type, 'etag': self.etag,
+            'last_modified': self.last_modified, 'checked_at': self.checked_at,
+        }
+
+
+class _Flight:
+    """One in-progress upstream fetch that other requests can join"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        # The _CacheFill downloading the body, once the upstream answered 200
+        self.fill = None
+
+
+class _CacheFill:
+    """Background download of an upstream body into the cache.
+
+    The body is written to a temporary file by its own thread, so the
+    download does not depend on how fast (or whether) any client reads it;
+    clients stream the file as it grows through ``reader()``.  The body is
+    committed once fully read and discarded on error; either way the flight
+    is released.
+    """
+
+    def __init__(self, cache, reference, url, flight, upstream, body, headers):
+        self._cache = cache
+        self._reference = reference
+        self._url = url
+        self._flight = flight
+        self._upstream = upstream
+        self._body = body
+        # Response headers for the clients streaming the body
+        self.headers = headers
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.tmp_dir)
+        self._file = os.fdopen(fd, 'wb')
+        self._size = 0
+        self._condition = threading.Condition()
+        self.finished = False
+        self.entry = None
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'document-fill-{self._reference}', daemon=True).start()
+
+    def _run(self):
+        digest = hashlib.sha256()
+        entry = None
+        try:
+            with self._file:
+                for chunk in self._body:
+                    self._file.write(chunk)
+                    self._file.flush()
+                    digest.update(chunk)
+                    with self._condition:
+                        self._size += len(chunk)
+                        self._condition.notify_all()
+            with self._condition:
+                # Readers open the temporary file under the same lock, so it
+                # cannot be renamed between their check and their open
+                entry = self.entry = self._cache._commit(self._reference, self._url, self._tmp_path,
+                                                         digest.hexdigest(), self._size, self._upstream.headers)
+        except Exception as e:
+            logger.warning("Error caching document %s: %s", self._reference, e)
+            _unlink(self._tmp_path)
+        finally:
+            self._body.close()
+            with self._condition:
+                self.entry = entry
+                self.finished = True
+                self._condition.notify_all()
+            self._cache._land(self._reference, self._flight, entry)
+
+    def reader(self):
+        """Iterator over the body for one client, or None if the download failed"""
+        with self._condition:
+            if self.finished and self.entry is None:
+                return None
+            try:
+                # Committed bodies have moved out of the temporary file
+                body = open(self._tmp_path if self.entry is None else self.entry.path, 'rb')
+            except OSError:
+                return None
+        return self._follow(body)
+
+    def _follow(self, body):
+        position = 0
+        with body:
+            while True:
+                chunk = body.read(CHUNK_SIZE)
+                if chunk:
+                    position += len(chunk)
+                    yield chunk
+                    continue
+                with self._condition:
+                    while position >= self._size and not self.finished:
+                        if not self._condition.wait(self._cache.wait_timeout):
+                            logger.warning("Download of document %s stalled", self._reference)
+                            return
+                    if position >= self._size:
+                        if self.entry is None:
+                            logger.warning("Download of document %s failed mid-stream", self._reference)
+                        return
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class DocumentCache:
+    """Content-addressed on-disk cache of proxied documents.
+
+    Bodies live under ``objects/`` named by their SHA-256, so identical files
+    are stored once; every reference has a small JSON record under ``refs/``
+    with its body digest, content type and upstream validators.  Bodies are
+    evicted least recently used first once they exceed ``max_bytes`` in
+    total.  The worker processes sharing the directory share that cap:
+    every new body rescans ``objects/`` under a file lock and evicts by
+    mtime, which hits refresh.  Entries are served from a file opened before
+    they are returned, never by path, so evicting a body does not cut off
+    the responses still sending it.  Entries older than ``revalidate_after``
+    seconds are revalidated with If-None-Match / If-Modified-Since before
+    being served again, and a stale entry is still served when the upstream
+    is unreachable.
+
+    Only one upstream fetch per reference runs at a time in a process.
+    Requests arriving meanwhile never wait for it: they stream the body being
+    downloaded, serve the stale entry being revalidated, or go to the
+    upstream directly.  Streams of a download in progress give up when it
+    makes no progress for ``wait_timeout`` seconds.
+    """
+
+    def __init__(self, directory, max_bytes, revalidate_after=3600, wait_timeout=60):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.wait_timeout = wait_timeout
+        self.objects_dir = self.directory / 'objects'
+        self.refs_dir = self.directory / 'refs'
+        self.tmp_dir = self.directory / 'tmp'
+        self.lock_path = self.directory / 'lock'
+        for path in (self.objects_dir, self.refs_dir, self.tmp_dir):
+            path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._flights = {}
+        # digest -> size, least recently used first, as of the last scan of objects/
+        self._objects = self._scan()
+        self._size = sum(self._objects.values())
+        self.stats = {'hits': 0, 'misses': 0, 'shared': 0, 'revalidated': 0, 'stale': 0, 'evicted': 0}
+
+    def _scan(self):
+        """Stored bodies, ``digest -> size``, least recently used (oldest mtime) first"""
+        found = []
+        for path in self.objects_dir.glob('*/*'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            found.append((stat.st_mtime, path.name, stat.st_size))
+        return OrderedDict((digest, size) for _mtime, digest, size in sorted(found))
+
+    @contextmanager
+    def _directory_lock(self):
+        """Hold the lock on the cache directory shared with other processes (and threads)"""
+        with open(self.lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _ref_path(self, reference):
+        return self.refs_dir / f"{hashlib.sha1(reference.encode('utf-8')).hexdigest()}.json"
+
+    def _object_path(self, digest):
+        return self.objects_dir / digest[:2] / digest
+
+    def lookup(self, reference, url):
+        """Return the CachedDocument for ``reference`` fetched from ``url``, or None"""
+        try:
+            with open(self._ref_path(reference), encoding='utf-8') as f:
+                entry = CachedDocument(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+        entry.path = self._object_path(entry.digest)
+        if entry.reference != reference or entry.url != url or not entry.path.exists():
+            return None
+        return entry
+
+    def _save_ref(self, entry):
+        path = self._ref_path(entry.reference)
+        tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry.to_json(), f)
+        os.replace(tmp_path, path)
+
+    def _touch(self, entry):
+        with self._lock:
+            if entry.digest in self._objects:
+                self._objects.move_to_end(entry.digest)
+        try:
+            # The mtime orders bodies for LRU after a restart
+            os.utime(entry.path)
+        except OSError:
+            pass
+
+    def _commit(self, reference, url, tmp_path, digest, size, headers):
+        """Move a fully written body into the store and record it for ``reference``"""
+        path = self._object_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        os.replace(tmp_path, path)
+        entry = CachedDocument(
+            reference, url, digest, size,
+            content_type=headers.get('Content-Type'),
+            etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'),
+            checked_at=time.time(),
+            path=path,
+        )
+        self._save_ref(entry)
+        # Rescans objects/, this body included
+        self._evict()
+        return entry
+
+    def _evict(self):
+        """Evict the least recently used bodies of every process sharing the directory past ``max_bytes``"""
+        with self._directory_lock():
+            objects = self._scan()
+            size = sum(objects.values())
+            evicted = 0
+            # Never evict the most recently used body
+            while size > self.max_bytes and len(objects) > 1:
+                digest, object_size = objects.popitem(last=False)
+                size -= object_size
+                evicted += 1
+                # Responses sending it hold it open and keep reading
+                _unlink(self._object_path(digest))
+        with self._lock:
+            self._objects = objects
+            self._size = size
+            self.stats['evicted'] += evicted
+
+    def _join(self, reference):
+        """Return ``(flight, is_leader)`` for a fetch of ``reference``"""
+        with self._lock:
+            flight = self._flights.get(reference)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[reference] = _Flight()
+            return flight, True
+
+    def _land(self, reference, flight, entry=None):
+        if flight.done.is_set():
+            return
+        with self._lock:
+            if self._flights.get(reference) is flight:
+                del self._flights[reference]
+        flight.entry = entry
+        flight.done.set()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def fetch(self, reference, url, proxy, request_headers):
+        """Return what to serve for ``reference``.
+
+        That is a CachedDocument to send from its open ``file``, a
+        ProxiedDocument whose body streams the upstream response (or the cache
+        file it is being downloaded into), or an upstream error status as an
+        int.  Raises requests.RequestException when the upstream is
+        unreachable and nothing is cached.
+        """
+        entry = self.lookup(reference, url)
+        if entry is not None and time.time() - entry.checked_at < self.revalidate_after:
+            try:
+                document = entry.opened()
+            except OSError:
+                # Evicted since the lookup: fetch it again
+                entry = None
+            else:
+                self._count('hits')
+                self._touch(entry)
+                return document
+
+        document = self._fetch(reference, url, proxy, request_headers, entry)
+        if isinstance(document, CachedDocument):
+            try:
+                return document.opened()
+            except OSError:
+                return proxy.fetch(reference, url, request_headers)
+        return document
+
+    def _fetch(self, reference, url, proxy, request_headers, entry):
+        flight, leader = self._join(reference)
+        if not leader:
+            return self._follow_flight(reference, url, proxy, request_headers, entry, flight)
+
+        try:
+            return self._fetch_upstream(reference, url, proxy, request_headers, entry, flight)
+        except BaseException:
+            if flight.fill is None:
+                self._land(reference, flight)
+            raise
+
+    def _follow_flight(self, reference, url, proxy, request_headers, entry, flight):
+        """Serve a reference another request is fetching, without waiting for it"""
+        if flight.done.is_set():
+            entry = flight.entry or self.lookup(reference, url)
+        if entry is not None:
+            # Finished, or stale while the other request revalidates it
+            self._count('hits')
+            return entry
+        fill = flight.fill
+        if fill is not None and not request_headers.get('Range'):
+            body = fill.reader()
+            if body is not None:
+                self._count('shared')
+                return ProxiedDocument(200, dict(fill.headers), body)
+        return proxy.fetch(reference, url, request_headers)
+
+    def _fetch_upstream(self, reference, url, proxy, request_headers, entry, flight):
+        # Ask for the identity encoding so the stored bytes can be served as-is
+        headers = {'Accept-Encoding': 'identity'}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            upstream = proxy.open(url, headers)
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            logger.warning("Serving stale document %s: %s", reference, e)
+            self._count('stale')
+            self._land(reference, flight, entry)
+            return entry
+
+        status = upstream.status_code
+        if status == 304 and entry is not None:
+            upstream.close()
+            entry.checked_at = time.time()
+            self._save_ref(entry)
+            self._touch(entry)
+            self._count('revalidated')
+            self._land(reference, flight, entry)
+            return entry
+        if status != 200:
+            upstream.close()
+            self._land(reference, flight, entry if status >= 500 else None)
+            if entry is not None and status >= 500:
+                self._count('stale')
+                return entry
+            return status
+
+        self._count('misses')
+        length = upstream.headers.get('Content-Length')
+        if 'Content-Encoding' in upstream.headers or (length and int(length) > self.max_bytes):
+            # Not storable as-is; proxy it without caching
+            self._land(reference, flight)
+            return proxy.respond(reference, upstream, request_headers)
+
+        document = proxy.respond(reference, upstream, {})
+        fill = flight.fill = _CacheFill(self, reference, url, flight, upstream, document.body, document.headers)
+        fill.start()
+        if request_headers.get('Range'):
+            # Pass the range through rather than waiting for the whole body
+            return proxy.fetch(reference, url, request_headers)
+        body = fill.reader()
+        if body is None:
+            return proxy.fetch(reference, url, request_headers)
+        return ProxiedDocument(200, dict(fill.headers), body)
+
+    def get_stats(self):
+        """Return hit/miss counters and the current size of the cache"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['documents'] = len(self._objects)
+            stats['bytes'] = self._size
+        stats['max_bytes'] = self.max_bytes
+        return stats
@@ -0,0 +1,202 @@
+"""Compact in-memory representation of a loaded entity.
+
+The fields that list, search and facet views touch on every request live in
+``__slots__`` with repeated values (risk levels, dataset lists, countries)
+interned, so every worker holds one small object per entity instead of a nest
+of dicts and lists.  The bulky detail payload (notes, documents, addresses,
+businesses) is only normalized when a detail page, the document proxy or a
+full API record asks for it (see details.py): it is read back from the feed
+line, or decoded from a zlib-compressed JSON blob, and memoized in a bounded
+LRU.
+"""
+import json
+import sys
+import zlib
+
+from details import DOCUMENT_SOURCES, FeedLine, detail_cache
+
+# Fields kept decoded on every entity, in API output order
+LIST_FIELDS = (
+    'name', 'reference', 'fullname', 'slug', 'datasets', 'risk_level', 'aliases',
+    'insolvent', 'media', 'financialRegulator',
+)
+# Fields stored in the compressed detail blob
+DETAIL_FIELDS = ('notes', 'documents', 'addresses', 'businesses')
+ENTITY_FIELDS = LIST_FIELDS + DETAIL_FIELDS
+
+_interned_tuples = {}
+_EMPTY_DETAIL = {field: () for field in DETAIL_FIELDS}
+
+
+def intern_tuple(values):
+    """Return a shared tuple equal to ``values``"""
+    values = tuple(sys.intern(value) if isinstance(value, str) else value for value in values)
+    return _interned_tuples.setdefault(values, values)
+
+
+def encode_detail(detail):
+    """Compress a detail dict, or return None when every list is empty"""
+    if not any(detail.get(field) for field in DETAIL_FIELDS + (DOCUMENT_SOURCES,)):
+        return None
+    return zlib.compress(json.dumps(detail, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_detail(blob):
+    """Inverse of encode_detail; always returns a fresh dict"""
+    if blob is None:
+        return {field: [] for field in DETAIL_FIELDS}
+    return json.loads(zlib.decompress(blob))
+
+
+def _references(detail):
+    return tuple(document['reference'] for document in detail['documents'] if document.get('reference'))
+
+
+class Entity:
+    """Read-only entity record.
+
+    Supports ``entity[field]`` and ``entity.get(field)`` for every field in
+    ENTITY_FIELDS so code written against the old entity dicts keeps working;
+    detail fields go through the detail cache on each access, so callers
+    needing several of them should use ``detail()`` or ``to_dict()`` once.
+
+    ``detail`` is a blob from encode_detail, a details.FeedLine, or None.
+    """
+
+    __slots__ = LIST_FIELDS + ('countries', 'oid', 'version', 'links', '_detail', '_references')
+
+    def __init__(self, name, reference, fullname, slug, datasets, risk_level, aliases,
+                 insolvent, media, financialRegulator, countries=(), detail=None,
+                 oid=None, version=None, references=None, links=()):
+        self.name = name
+        self.reference = reference
+        # Most records repeat the name as fullname; share the string
+        self.fullname = name if fullname == name else fullname
+        self.slug = slug
+        self.datasets = intern_tuple(datasets)
+        self.risk_level = sys.intern(risk_level)
+        self.aliases = tuple(aliases)
+        self.insolvent = insolvent
+        self.media = media
+        self.financialRegulator = financialRegulator
+        self.countries = intern_tuple(countries)
+        # Feed record id (``_id.$oid``) and ``raw.version``, used by delta updates
+        self.oid = oid
+        self.version = version
+        # Linked businesses and persons, as graph.feed_links tuples
+        self.links = tuple((sys.intern(reference), sys.intern(kind), name, relationship, intern_tuple(datasets))
+                           for reference, kind, name, relationship, datasets in links)
+        self._detail = detail
+        # Document references (for the document index); None derives them from the detail
+        self._references = intern_tuple(references) if references is not None else None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build an entity from a normalized entity dict"""
+        countries = sorted({address['country'] for address in data.get('addresses', [])
+                            if address.get('country')})
+        detail = {field: data.get(field, []) for field in DETAIL_FIELDS}
+        if data.get(DOCUMENT_SOURCES):
+            detail[DOCUMENT_SOURCES] = data[DOCUMENT_SOURCES]
+        return cls(
+            data['name'], data['reference'], data['fullname'], data['slug'],
+            data['datasets'], data['risk_level'], data['aliases'],
+            data['insolvent'], data['media'], data['financialRegulator'],
+            countries=countries,
+            detail=encode_detail(detail),
+            oid=data.get('oid'),
+            version=data.get('version'),
+            references=_references(detail),
+        )
+
+    def detail(self):
+        """Return the notes, documents, addresses and businesses.
+
+        The dict (and its lists) may be shared with other callers through the
+        detail cache: do not modify it.
+        """
+        source = self._detail
+        if source is None:
+            return _EMPTY_DETAIL
+        detail = detail_cache.get(source)
+        if detail is None:
+            if isinstance(source, FeedLine):
+                detail = source.load(self.oid)
+                if detail is None:
+                    return _EMPTY_DETAIL
+            else:
+                detail = decode_detail(source)
+            detail_cache.put(source, detail)
+        return detail
+
+    def attach_source(self, source, offset=0):
+        """Turn the ``(offset, length)`` detail given by a parse worker into a FeedLine of ``source``"""
+        line_offset, length = self._detail
+        self._detail = FeedLine(source, offset + line_offset, length)
+
+    def detail_blob(self):
+        """The detail as an encode_detail blob (or None), e.g. for a compiled snapshot"""
+        if self._detail is None or isinstance(self._detail, bytes):
+            return self._detail
+        if isinstance(self._detail, FeedLine):
+            return encode_detail(self.detail())
+        return bytes(self._detail)
+
+    @property
+    def references(self):
+        """References of the entity's documents, in order"""
+        if self._references is not None:
+            return self._references
+        return _references(self.detail())
+
+    def copy(self):
+        """Return a shallow copy (e.g. to re-slug an entity another snapshot holds)"""
+        clone = Entity.__new__(Entity)
+        for slot in Entity.__slots__:
+            setattr(clone, slot, getattr(self, slot))
+        return clone
+
+    def document_source(self, reference):
+        """Return ``(document, upstream_url)`` for a document reference, or None"""
+        detail = self.detail()
+        for document in detail['documents']:
+            if document.get('reference') == reference:
+                url = detail.get(DOCUMENT_SOURCES, {}).get(reference) or document.get('url')
+                return document, url
+        return None
+
+    @property
+    def notes(self):
+        return self.detail()['notes']
+
+    @property
+    def documents(self):
+        return self.detail()['documents']
+
+    @property
+    def addresses(self):
+        return self.detail()['addresses']
+
+    @property
+    def businesses(self):
+        return self.detail()['businesses']
+
+    def __getitem__(self, key):
+        if key in ENTITY_FIELDS or key == 'countries':
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self, fields=ENTITY_FIELDS):
+        """Return the given fields (all by default) as a plain dict"""
+        detail = self.detail() if any(field in DETAIL_FIELDS for field in fields) else None
+        return {field: detail[field] if field in DETAIL_FIELDS else getattr(self, field)
+                for field in fields}
+
+    def __repr__(self):
+        return f"<Entity {self.reference} {self.name!r}>"
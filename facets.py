@@ -0,0 +1,120 @@
+"""Bitmap indexes for the faceted filters of /api/entities.
+
+Every facet value maps to a bitset (a Python int with bit ``i`` set when
+entity ``i`` has that value).  Combining filters is a handful of big-int
+ANDs/ORs and facet counts are ``int.bit_count()`` calls, so slicing the data
+never walks the entity dicts.
+"""
+import re
+
+DIMENSIONS = ('risk_level', 'dataset', 'country', 'insolvent', 'media', 'financialRegulator')
+BOOLEAN_DIMENSIONS = ('insolvent', 'media', 'financialRegulator')
+
+_NONZERO_BYTE_RE = re.compile(rb'[^\x00]')
+# Bit positions set in each possible byte value
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+
+def ids_to_bits(ids, size):
+    """Build a bitset from entity ids smaller than ``size``"""
+    data = bytearray((size + 7) // 8)
+    for i in ids:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+
+def iter_bits(bits, start=0):
+    """Yield the ids set in ``bits`` that are >= ``start``, ascending"""
+    if start:
+        bits &= ~((1 << start) - 1)
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for match in _NONZERO_BYTE_RE.finditer(data, start >> 3):
+        offset = match.start() << 3
+        for bit in _BYTE_BITS[data[match.start()]]:
+            yield offset + bit
+
+
+def facet_values(entity):
+    """Yield ``(dimension, value)`` pairs for an entity"""
+    yield 'risk_level', entity['risk_level']
+    for dataset in entity['datasets']:
+        yield 'dataset', dataset
+    for country in entity['countries']:
+        yield 'country', country
+    for dimension in BOOLEAN_DIMENSIONS:
+        yield dimension, 'true' if entity.get(dimension) else 'false'
+
+
+class FacetIndex:
+    """Per-dimension, per-value bitsets over a sequence of entities"""
+
+    def __init__(self, entities):
+        self.size = len(entities)
+        self.all = (1 << self.size) - 1
+        ids = {dimension: {} for dimension in DIMENSIONS}
+        for entity_id, entity in enumerate(entities):
+            for dimension, value in facet_values(entity):
+                ids[dimension].setdefault(value, []).append(entity_id)
+        self.bitsets = {
+            dimension: {value: ids_to_bits(value_ids, self.size) for value, value_ids in values.items()}
+            for dimension, values in ids.items()
+        }
+
+    @classmethod
+    def from_bitsets(cls, size, bitsets):
+        """Wrap prebuilt ``{dimension: {value: bitset}}`` bitsets"""
+        index = cls.__new__(cls)
+        index.size = size
+        index.all = (1 << size) - 1
+        index.bitsets = {dimension: dict(bitsets.get(dimension, {})) for dimension in DIMENSIONS}
+        return index
+
+    def extended(self, entities, start, live):
+        """Return a new index that also covers ``entities``, with ids from ``start``.
+
+        ``live`` is the bitset of ids still in use; tombstoned ids keep
+        their bits in the value bitsets but drop out of every result.
+        """
+        index = FacetIndex.__new__(FacetIndex)
+        index.size = start + len(entities)
+        index.all = live
+        index.bitsets = {dimension: dict(values) for dimension, values in self.bitsets.items()}
+        added = {}
+        for entity_id, entity in enumerate(entities, start=start):
+            for dimension, value in facet_values(entity):
+                added.setdefault((dimension, value), []).append(entity_id)
+        for (dimension, value), ids in added.items():
+            values = index.bitsets[dimension]
+            values[value] = values.get(value, 0) | ids_to_bits(ids, index.size)
+        return index
+
+    def filter_bits(self, filters, exclude=None):
+        """Bitset of entities matching ``filters``.
+
+        ``filters`` maps a dimension to the list of accepted values: values
+        within a dimension are ORed, dimensions are ANDed.  ``exclude`` skips
+        one dimension, which is what its own facet counts are computed over.
+        """
+        bits = self.all
+        for dimension, values in filters.items():
+            if dimension == exclude or not values:
+                continue
+            bitsets = self.bitsets[dimension]
+            accepted = 0
+            for value in values:
+                accepted |= bitsets.get(value, 0)
+            bits &= accepted
+        return bits
+
+    def counts(self, base, filters):
+        """Facet counts per dimension and value within ``base``.
+
+        Each dimension is counted with every filter applied except its own,
+        so selecting a value does not hide the alternatives.
+        """
+        result = {}
+        for dimension, values in self.bitsets.items():
+            bits = base & self.filter_bits(filters, exclude=dimension)
+            counts = {value: (bits & value_bits).bit_count() for value, value_bits in values.items()}
+            result[dimension] = {value: count for value, count in sorted(counts.items()) if count}
+        return result
@@ -1,26 +1,77 @@
-from flask import Flask, Response
+from flask import Response
+from urllib.parse import urlsplit
+import io
 import sys
 import os
 
 # Add the root directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app import app as flask_app
+from app import app as flask_app, get_entities_snapshot
+
+# The app (and the entity snapshot it loads) lives as long as this module, so
+# it is loaded once per isolate, not per request
+get_entities_snapshot()
+
+# Headers that map to un-prefixed WSGI environ keys
+_CGI_HEADERS = {'content-type': 'CONTENT_TYPE', 'content-length': 'CONTENT_LENGTH'}
+
+
+def build_environ(request):
+    """Build the WSGI environ for an incoming Pages request"""
+    if hasattr(request, 'environ'):
+        # Already a WSGI request: hand its environ over as is
+        return request.environ
+
+    url = urlsplit(getattr(request, 'url', '') or '')
+    path = getattr(request, 'path', None) or url.path or '/'
+    query = getattr(request, 'query_string', None)
+    if query is None:
+        query = url.query
+    if isinstance(query, bytes):
+        query = query.decode('latin-1')
+    body = request.get_data() or b''
+    headers = dict(request.headers)
+    host = headers.get('Host') or headers.get('host') or url.netloc or 'localhost'
+    scheme = url.scheme or headers.get('X-Forwarded-Proto') or 'https'
+    server_name, _, port = host.partition(':')
+
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': port or ('443' if scheme == 'https' else '80'),
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': headers.get('CF-Connecting-IP', ''),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers.items():
+        key = _CGI_HEADERS.get(name.lower()) or 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = value
+    if body and 'CONTENT_LENGTH' not in environ:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
 
 def onRequest(context):
-    """Handle the incoming request using the Flask app."""
-    with flask_app.test_client() as client:
-        # Forward the request to Flask
-        response = client.open(
-            path=context.request.path or '/',  # Default to / if path is empty
-            method=context.request.method,
-            headers=dict(context.request.headers),
-            data=context.request.get_data()
-        )
-        
-        # Convert Flask response to Pages response
-        return Response(
-            response.get_data(),
-            status=response.status_code,
-            headers=dict(response.headers)
-        )
+    """Handle the incoming request by dispatching it to the Flask WSGI app."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = status
+        started['headers'] = headers
+
+    body = flask_app(build_environ(context.request), start_response)
+
+    # The app's iterable is passed through (and closed with the response), so
+    # streamed responses (NDJSON, documents, sitemaps) are not buffered here
+    return Response(body, status=started['status'], headers=started['headers'],
+                    direct_passthrough=True)
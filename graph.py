@@ -0,0 +1,356 @@
+"""Relationship graph of the entities and the businesses and persons they link to.
+
+Feed records list linked businesses (``businesses`` and ``raw.businessLinks``)
+and persons (``persons`` and ``raw.individualLinks``) by reference.  Every
+reference, whether it is an entity of the dataset or only a link target, is
+a node with a compact integer id; links are undirected edges kept as CSR
+arrays (per-node offsets into one array of neighbour ids), so the whole graph
+costs a few machine words per edge and neighbourhoods are read without
+touching the entity records.
+
+Link targets outside the dataset carry the datasets the link reports for
+them (``SAN-CURRENT``, ``PEP-CURRENT``, ...), so risk propagates through
+them too.  For each risk dataset, ``exposure`` finds every node's distance to
+the nearest *other* node in that dataset with a multi-source breadth-first
+search, computed once per snapshot and dataset (``propagate`` computes them
+all, e.g. before the snapshot is served).
+"""
+import copy
+import sys
+import threading
+import time
+from array import array
+
+from facets import ids_to_bits
+
+# Datasets that propagate along links, as entities report them
+RISK_DATASETS = ('sanctions', 'pep', 'insolvency', 'adverse_media', 'disqualified')
+_RISK_BITS = {dataset: 1 << position for position, dataset in enumerate(RISK_DATASETS)}
+# Dataset codes of the feed's link records; former and "linked to" listings do not count
+LINK_DATASETS = {
+    'SAN': 'sanctions', 'SAN-CURRENT': 'sanctions',
+    'POI': 'pep', 'PEP-CURRENT': 'pep',
+    'INS': 'insolvency', 'INS-CURRENT': 'insolvency',
+    'RRE': 'adverse_media',
+    'REL': 'disqualified',
+}
+DEFAULT_MAX_HOPS = 3
+DEFAULT_MAX_NODES = 500
+DEFAULT_MAX_EDGES = 2000
+DEFAULT_TIMEOUT = 0.25
+# Distance of nodes no risky node was found for within the hop limit
+UNREACHED = 255
+# Neighbourhood traversals check the clock once per this many expanded nodes
+_CLOCK_INTERVAL = 64
+
+
+def _person_name(link):
+    return ' '.join(part for part in (link.get(field) for field in ('firstName', 'middleName', 'lastName'))
+                    if part)
+
+
+def feed_links(data):
+    """Links of a raw feed record as ``(reference, kind, name, relationship, datasets)`` tuples.
+
+    The ``businesses``/``persons`` lists and the ``raw`` link lists describe
+    the same links; they are merged by reference, keeping the first name and
+    relationship given and every dataset either reports.
+    """
+    raw = data.get('raw') or {}
+    own_reference = str(data.get('reference') or '')
+    merged = {}
+
+    def add(kind, reference, name, relationship, codes=()):
+        if not reference or str(reference) == own_reference:
+            return
+        link = merged.setdefault(str(reference), [kind, '', '', set()])
+        link[1] = link[1] or name or ''
+        link[2] = link[2] or relationship or ''
+        link[3].update(LINK_DATASETS[code] for code in codes or () if code in LINK_DATASETS)
+
+    lists = (
+        ('business', data.get('businesses'), lambda item: (item.get('reference'), item.get('name'), item.get('position'), ())),
+        ('person', data.get('persons'), lambda item: (item.get('reference'), item.get('name'), item.get('relation'), ())),
+        ('business', raw.get('businessLinks'), lambda item: (item.get('qrCode'), item.get('name'),
+                                                              item.get('relationship'), item.get('datasets'))),
+        ('person', raw.get('individualLinks'), lambda item: (item.get('qrCode'), _person_name(item),
+                                                              item.get('relationship'), item.get('datasets'))),
+    )
+    for kind, items, fields in lists:
+        for item in items or ():
+            if isinstance(item, dict):
+                add(kind, *fields(item))
+    return [(reference, kind, name, relationship, tuple(sorted(datasets)))
+            for reference, (kind, name, relationship, datasets) in merged.items()]
+
+
+def risk_bits(datasets):
+    """Bitmask of the RISK_DATASETS among ``datasets``"""
+    bits = 0
+    for dataset in datasets:
+        bits |= _RISK_BITS.get(dataset, 0)
+    return bits
+
+
+class RelationshipGraph:
+    """Undirected link graph over the references of a snapshot's live entities"""
+
+    def __init__(self, entities, dead=frozenset(), max_hops=DEFAULT_MAX_HOPS):
+        if not 0 < max_hops < UNREACHED:
+            raise ValueError(f"max_hops must be between 1 and {UNREACHED - 1}")
+        self.entities = entities
+        self.max_hops = max_hops
+        # Reference -> node id, and per node: its reference, entity id (-1 for
+        # link targets outside the dataset) and risk dataset bits
+        self.node_ids = {}
+        self.references = []
+        self.entity_ids = array('i')
+        self.risk = bytearray()
+        # Kind and name of link targets, from the first link naming them
+        self.targets = {}
+        self.labels = []
+        self._exposure = {}
+        self._exposed_bits = {}
+        self._lock = threading.Lock()
+
+        label_ids = {}
+        edge_sources = array('I')
+        edge_targets = array('I')
+        edge_labels = array('I')
+        for entity_id, entity in enumerate(entities):
+            if entity_id in dead or not entity.reference:
+                continue
+            node = self._node(entity.reference)
+            if self.entity_ids[node] < 0:
+                self.entity_ids[node] = entity_id
+            self.risk[node] |= risk_bits(entity.datasets)
+            for reference, kind, name, relationship, datasets in entity.links:
+                target = self._node(reference)
+                self.risk[target] |= risk_bits(datasets)
+                if target not in self.targets:
+                    self.targets[target] = (kind, name)
+                label = label_ids.get(relationship)
+                if label is None:
+                    label = label_ids[relationship] = len(self.labels)
+                    self.labels.append(relationship)
+                edge_sources.append(node)
+                edge_targets.append(target)
+                edge_labels.append(label)
+
+        # CSR adjacency: both directions of every link, the low label bit
+        # telling whether the neighbour is the linking side
+        count = len(self.references)
+        offsets = array('I', bytes(4 * (count + 1)))
+        for node in edge_sources:
+            offsets[node + 1] += 1
+        for node in edge_targets:
+            offsets[node + 1] += 1
+        for node in range(count):
+            offsets[node + 1] += offsets[node]
+        fill = offsets[:-1]
+        neighbours = array('I', bytes(4 * 2 * len(edge_sources)))
+        labels = array('I', neighbours)
+        for source, target, label in zip(edge_sources, edge_targets, edge_labels):
+            neighbours[fill[source]] = target
+            labels[fill[source]] = label << 1
+            fill[source] += 1
+            neighbours[fill[target]] = source
+            labels[fill[target]] = label << 1 | 1
+            fill[target] += 1
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.edge_labels = labels
+
+    def carried(self, entities, removed, added):
+        """This graph for ``entities`` (a later snapshot's), or None if it has to be rebuilt.
+
+        The entities ``added`` (ids) must replace the ``removed`` ones with the
+        same references, risk datasets and links, as a delta renaming or
+        re-describing entities does; the nodes, links and computed exposure
+        are then shared and only the node -> entity id map is patched.
+        """
+        def graph_keys(entity_ids):
+            return sorted((entities[entity_id].reference, risk_bits(entities[entity_id].datasets),
+                           entities[entity_id].links) for entity_id in entity_ids if entities[entity_id].reference)
+
+        if graph_keys(removed) != graph_keys(added):
+            return None
+        graph = copy.copy(self)
+        graph.entities = entities
+        graph.entity_ids = array('i', self.entity_ids)
+        graph._exposed_bits = {}
+        for entity_id in sorted(added):
+            reference = entities[entity_id].reference
+            if reference:
+                node = self.node_ids[reference]
+                if graph.entity_ids[node] in removed:
+                    graph.entity_ids[node] = entity_id
+        return graph
+
+    def _node(self, reference):
+        node = self.node_ids.get(reference)
+        if node is None:
+            node = self.node_ids[sys.intern(reference)] = len(self.references)
+            self.references.append(reference)
+            self.entity_ids.append(-1)
+            self.risk.append(0)
+        return node
+
+    def __len__(self):
+        return len(self.references)
+
+    @property
+    def edge_count(self):
+        return len(self.neighbours) // 2
+
+    def datasets(self, node):
+        """Risk datasets of a node, from its entity record and the links naming it"""
+        bits = self.risk[node]
+        return [dataset for dataset in RISK_DATASETS if bits & _RISK_BITS[dataset]]
+
+    def entity(self, node):
+        """The entity of a node, or None for link targets outside the dataset"""
+        entity_id = self.entity_ids[node]
+        return self.entities[entity_id] if entity_id >= 0 else None
+
+    def describe(self, node):
+        """Reference, kind, name and risk datasets of a node"""
+        entity = self.entity(node)
+        if entity is not None:
+            kind, name = 'entity', entity.name
+        else:
+            kind, name = self.targets.get(node, ('', ''))
+        return {'reference': self.references[node], 'kind': kind, 'name': name,
+                'datasets': self.datasets(node)}
+
+    def exposure(self, dataset):
+        """``(distances, via)``: per node, the hops to the nearest other node in ``dataset`` and that node.
+
+        Distances past ``max_hops`` are UNREACHED (and ``via`` is -1).  Each
+        node keeps the two nearest distinct sources reaching it, so nodes in
+        the dataset themselves get the distance to the next one.
+        """
+        result = self._exposure.get(dataset)
+        if result is None:
+            with self._lock:
+                result = self._exposure.get(dataset)
+                if result is None:
+                    result = self._exposure[dataset] = self._propagate(_RISK_BITS[dataset])
+        return result
+
+    def propagate(self):
+        """Compute the exposure to every risk dataset ahead of the queries that need it"""
+        for dataset in RISK_DATASETS:
+            self.exposure(dataset)
+
+    def _propagate(self, bit):
+        count = len(self.references)
+        offsets = self.offsets
+        neighbours = self.neighbours
+        first = array('i', [-1]) * count
+        second = array('i', [-1]) * count
+        first_hops = bytearray(b'\xff') * count
+        second_hops = bytearray(b'\xff') * count
+        frontier = []
+        for node in range(count):
+            if self.risk[node] & bit:
+                first[node] = node
+                first_hops[node] = 0
+                frontier.append((node, node))
+        hops = 0
+        while frontier and hops < self.max_hops:
+            hops += 1
+            next_frontier = []
+            for node, source in frontier:
+                for position in range(offsets[node], offsets[node + 1]):
+                    neighbour = neighbours[position]
+                    if first[neighbour] < 0:
+                        first[neighbour] = source
+                        first_hops[neighbour] = hops
+                    elif second[neighbour] < 0 and first[neighbour] != source:
+                        second[neighbour] = source
+                        second_hops[neighbour] = hops
+                    else:
+                        continue
+                    next_frontier.append((neighbour, source))
+            frontier = next_frontier
+
+        distances = bytearray(b'\xff') * count
+        via = array('i', [-1]) * count
+        for node in range(count):
+            if first[node] == node:
+                distances[node], via[node] = second_hops[node], second[node]
+            else:
+                distances[node], via[node] = first_hops[node], first[node]
+        return distances, via
+
+    def exposed_bits(self, dataset, hops):
+        """Bitset of the entity ids linked to another node in ``dataset`` within ``hops``"""
+        key = (dataset, hops)
+        bits = self._exposed_bits.get(key)
+        if bits is None:
+            distances, _via = self.exposure(dataset)
+            entity_ids = self.entity_ids
+            bits = ids_to_bits(sorted(entity_ids[node] for node in range(len(distances))
+                                      if distances[node] <= hops and entity_ids[node] >= 0),
+                               len(self.entities))
+            self._exposed_bits[key] = bits
+        return bits
+
+    def risk_summary(self, node, hops):
+        """``{dataset: {"hops", "via"}}`` for the risk datasets linked to ``node`` within ``hops``"""
+        summary = {}
+        for dataset in RISK_DATASETS:
+            distances, via = self.exposure(dataset)
+            if distances[node] <= hops:
+                summary[dataset] = {'hops': distances[node], 'via': self.references[via[node]]}
+        return summary
+
+    def neighbourhood(self, node, hops, max_nodes=DEFAULT_MAX_NODES, max_edges=DEFAULT_MAX_EDGES,
+                      timeout=DEFAULT_TIMEOUT):
+        """Breadth-first neighbourhood of ``node`` up to ``hops`` away.
+
+        Returns ``(depths, edges, truncated)``: node id -> hops from ``node``,
+        ``(source, target, relationship)`` links between the nodes reached
+        (``source`` is the linking side), and whether the node, edge or time
+        budget cut the traversal short.
+        """
+        deadline = time.monotonic() + timeout
+        offsets = self.offsets
+        neighbours = self.neighbours
+        edge_labels = self.edge_labels
+        depths = {node: 0}
+        edges = []
+        seen_edges = set()
+        truncated = False
+        frontier = [node]
+        expanded = 0
+        for hop in range(1, hops + 1):
+            next_frontier = []
+            for current in frontier:
+                expanded += 1
+                if not expanded % _CLOCK_INTERVAL and time.monotonic() > deadline:
+                    truncated = True
+                    break
+                for position in range(offsets[current], offsets[current + 1]):
+                    neighbour = neighbours[position]
+                    if neighbour not in depths:
+                        if len(depths) >= max_nodes:
+                            truncated = True
+                            continue
+                        depths[neighbour] = hop
+                        next_frontier.append(neighbour)
+                    label = edge_labels[position]
+                    source, target = (neighbour, current) if label & 1 else (current, neighbour)
+                    key = (source, target, label >> 1)
+                    if key in seen_edges:
+                        continue
+                    if len(edges) >= max_edges:
+                        truncated = True
+                        continue
+                    seen_edges.add(key)
+                    edges.append((source, target, self.labels[label >> 1]))
+            if truncated:
+                break
+            frontier = next_frontier
+        return depths, edges, truncated
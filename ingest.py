@@ -0,0 +1,111 @@
+"""Parallel, chunked parsing of the entities.csv feed.
+
+The raw feed is cut into byte ranges that end on line boundaries and each
+range is parsed by a forked worker process, which inherits the feed bytes
+copy-on-write.  Parsed entities come back in feed order while later chunks
+are still being parsed, so callers can consume (and index) them as a stream.
+What a worker logs for a chunk (e.g. per-line parse errors) is collected
+and handled in the parent in chunk order, so the log reads the same as a
+serial load.
+"""
+import logging
+import logging.handlers
+import multiprocessing
+import threading
+
+CHUNK_BYTES = 4 * 1024 * 1024
+
+# Inherited by forked pool workers; set right before the pool is created
+_feed_data = None
+_feed_parse = None
+_feed_offsets = False
+_feed_lock = threading.Lock()
+
+
+def chunk_ranges(data, chunk_bytes=CHUNK_BYTES, first_line=1):
+    """Yield ``(start, end, first_line_number)`` for line-aligned chunks of ``data``"""
+    start = 0
+    line = first_line
+    size = len(data)
+    while start < size:
+        end = data.find(b'\n', min(start + chunk_bytes, size) - 1)
+        end = size if end == -1 else end + 1
+        yield start, end, line
+        line += data.count(b'\n', start, end)
+        start = end
+
+
+def split_lines(data, start=0, end=None):
+    """Split ``data[start:end]`` into lines (bytes, without newlines)"""
+    chunk = data[start:end]
+    if chunk.endswith(b'\n'):
+        chunk = chunk[:-1]
+    return chunk.split(b'\n') if chunk else []
+
+
+def _parse_lines(parse, data, start, end, first_line, offsets):
+    lines = split_lines(data, start, end)
+    return parse(lines, first_line, offset=start) if offsets else parse(lines, first_line)
+
+
+class _RecordBuffer(logging.handlers.QueueHandler):
+    """Keeps the records logged in a worker, formatted and picklable, for the parent to handle"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.records = []
+
+    def enqueue(self, record):
+        self.records.append(record)
+
+
+def _parse_chunk(task):
+    start, end, first_line = task
+    # Workers inherit the parent's handlers; route their records back to it instead
+    root = logging.getLogger()
+    buffer = _RecordBuffer()
+    handlers, root.handlers = root.handlers, [buffer]
+    try:
+        entities = list(_parse_lines(_feed_parse, _feed_data, start, end, first_line, _feed_offsets))
+    finally:
+        root.handlers = handlers
+    return entities, buffer.records
+
+
+def iter_feed(data, parse, processes=1, chunk_bytes=CHUNK_BYTES, first_line=1, offsets=False):
+    """Yield the entities parsed from the raw feed ``data``, in feed order.
+
+    ``parse(lines, first_line_number)`` turns one chunk's lines (bytes) into
+    an iterable of entities; with ``offsets`` it is also given the byte
+    offset of the chunk in ``data`` as ``offset``.  With ``processes > 1``
+    (and ``fork`` available) chunks are parsed on a process pool created for
+    this call; otherwise, or when the feed fits in one chunk, they are parsed
+    here.  Lines are numbered from ``first_line``.
+    """
+    global _feed_data, _feed_parse, _feed_offsets
+    ranges = list(chunk_ranges(data, chunk_bytes, first_line))
+    if (processes <= 1 or len(ranges) <= 1
+            or 'fork' not in multiprocessing.get_all_start_methods()):
+        for start, end, first_line in ranges:
+            yield from _parse_lines(parse, data, start, end, first_line, offsets)
+        return
+
+    # The globals only need to hold while the pool forks
+    with _feed_lock:
+        _feed_data = data
+        _feed_parse = parse
+        _feed_offsets = offsets
+        try:
+            pool = multiprocessing.get_context('fork').Pool(min(processes, len(ranges)))
+        finally:
+            _feed_data = _feed_parse = None
+    try:
+        # imap keeps chunk order while the workers run ahead
+        for entities, records in pool.imap(_parse_chunk, ranges):
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            yield from entities
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,179 @@
+"""Logging setup and performance instrumentation.
+
+Modules log through ``logging.getLogger(__name__)``; ``configure_logging``
+sets those loggers' level and sends the records to stderr, as text or as one
+JSON object per line, unless the host (e.g. gunicorn) already set up logging.
+
+``metrics`` collects timings of named phases (``with metrics.timer('filter'):``)
+and counters (``metrics.incr('slug_index.miss')``) for the metrics endpoint.
+Phases timed while a request is being handled (between ``start_request`` and
+``finish_request``) are also collected for that request, to be sent back in
+its Server-Timing header.
+"""
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Recent samples kept per timing for its percentiles
+SAMPLES = 1024
+
+# Phases timed during the current request: [(name, seconds, description)]
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message and any ``extra`` fields"""
+
+    _reserved = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update((key, value) for key, value in vars(record).items() if key not in self._reserved)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def configure_logging(loggers, level='INFO', fmt='text'):
+    """Log the application's ``loggers`` (names) at ``level`` to stderr, as ``text`` or ``json`` lines.
+
+    Only those loggers' levels are set; the root logger, and its handlers
+    when logging was already configured (e.g. by the WSGI server), are left
+    to the host.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(handlers=[handler])
+    for name in loggers:
+        logging.getLogger(name).setLevel(level)
+
+
+class Timing:
+    """Count, total and maximum of a timed phase, and its recent samples"""
+
+    __slots__ = ('count', 'total', 'max', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.samples.append(seconds)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.total / self.count * 1000, 3) if self.count else None,
+            'p50_ms': round(samples[len(samples) // 2] * 1000, 3) if samples else None,
+            'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3) if samples else None,
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class Metrics:
+    """Process-wide phase timings and counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+        self.started = time.time()
+
+    def incr(self, name, count=1):
+        """Add ``count`` to counter ``name``"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def observe(self, name, seconds, description=None):
+        """Record that phase ``name`` took ``seconds`` (in the current request too)"""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = Timing()
+            timing.add(seconds)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, seconds, description))
+
+    @contextmanager
+    def timer(self, name):
+        """Time the enclosed block as phase ``name``"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def get_stats(self):
+        """Return the counters and a summary of every timing"""
+        with self._lock:
+            timings = {name: timing.summary() for name, timing in sorted(self._timings.items())}
+            counters = dict(sorted(self._counters.items()))
+        return {'uptime_s': round(time.time() - self.started, 1), 'counters': counters, 'timings': timings}
+
+
+def start_request():
+    """Start collecting the current request's timings; pass the token to ``finish_request``"""
+    return _request_timings.set([])
+
+
+def finish_request(token):
+    """Stop collecting and return the current request's ``(name, seconds, description)`` timings"""
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    return timings
+
+
+def note(name, description):
+    """Add a description-only entry (e.g. a cache hit) to the current request's timings"""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, None, description))
+
+
+def server_timing(timings, total=None):
+    """Format timings as a Server-Timing header value (repeated phases are summed)"""
+    durations = {}
+    descriptions = {}
+    for name, seconds, description in timings:
+        if seconds is not None:
+            durations[name] = durations.get(name, 0.0) + seconds
+        else:
+            durations.setdefault(name, None)
+        if description:
+            descriptions[name] = description
+    if total is not None:
+        durations['total'] = total
+    parts = []
+    for name, seconds in durations.items():
+        part = name
+        if name in descriptions:
+            part += f';desc="{descriptions[name]}"'
+        if seconds is not None:
+            part += f';dur={seconds * 1000:.2f}'
+        parts.append(part)
+    return ', '.join(parts)
+
+
+metrics = Metrics()
@@ -0,0 +1,78 @@
+"""Bounded cache of rendered pages.
+
+Pages are cached under a key made of everything their output depends on
+(route, slug, locale, snapshot version, date, host and path) and evicted least recently
+used once the cache holds ``max_bytes``.  Every cached page carries a strong
+ETag (a hash of its body), so browsers and the CDN can revalidate with
+If-None-Match and get a 304 instead of the page.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class CachedPage:
+    """A rendered page body (bytes) and its strong ETag"""
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+
+    @property
+    def size(self):
+        return len(self.body)
+
+
+class PageCache:
+    """LRU of rendered pages, capped at ``max_bytes``.
+
+    Keys should include the snapshot version, so a new snapshot simply stops
+    hitting the old entries, which then age out.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def _entry(self, body):
+        return CachedPage(body)
+
+    def get(self, key):
+        """Return the cached page for ``key``, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, key, body):
+        """Cache ``body`` (str or bytes) under ``key`` and return its entry"""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        entry = self._entry(body)
+        if entry.size > self.max_bytes:
+            return entry
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous.size
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                _key, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+                self.stats['evicted'] += 1
+        return entry
+
+    def get_stats(self):
+        """Return hit/miss/eviction counters and the cache size"""
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._size)
@@ -0,0 +1,135 @@
+"""Pre-encoded JSON for the /api/entities responses.
+
+Serializing entity records is most of the cost of a large result page, and a
+record's JSON never changes within a snapshot, so the list records
+(LIST_FIELDS) of recently served entities are kept encoded with the snapshot,
+least recently used first out, and carried over to the snapshots deltas
+derive from it for the entities they leave unchanged; responses are put
+together by joining those fragments.  Full records need the entity's details
+loaded and are encoded per request.  orjson is used when it is installed.
+
+Whole responses to common queries (everything, or a single dataset) are also
+kept in a PayloadCache with gzip- (and, when the brotli package is installed,
+brotli-) compressed copies, so they are served without any encoding work.
+"""
+import gzip
+import json
+import threading
+from collections import OrderedDict
+
+from entities import ENTITY_FIELDS, LIST_FIELDS
+from page_cache import CachedPage, PageCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# List records kept encoded per snapshot; the least recently used past it are encoded again
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+_LIST_VIEW = frozenset(LIST_FIELDS)
+
+
+def dumps(value):
+    """Encode ``value`` as compact JSON bytes with sorted keys (like jsonify)"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def encode_object(members):
+    """Join ``{key: encoded JSON bytes}`` into a JSON object, keys sorted"""
+    return b'{' + b','.join(dumps(key) + b':' + members[key] for key in sorted(members)) + b'}'
+
+
+class EncodedEntities:
+    """LRU of the encoded list records of a snapshot's entities, by entity id"""
+
+    def __init__(self, entities, max_entries=DEFAULT_MAX_ENTRIES):
+        self.entities = entities
+        self.max_entries = max_entries
+        self.size = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def carried(self, entities, dead=frozenset()):
+        """A cache for ``entities`` (a later snapshot's) holding the records of the live entities both share"""
+        encoded = EncodedEntities(entities, self.max_entries)
+        previous = self.entities
+        with self._lock:
+            records = list(self._records.items())
+        for entity_id, record in records:
+            if entity_id not in dead and entities[entity_id] is previous[entity_id]:
+                encoded._records[entity_id] = record
+                encoded.size += len(record)
+        return encoded
+
+    def encode(self, entity_id, fields=ENTITY_FIELDS):
+        """Return the JSON record of entity ``entity_id`` with ``fields``"""
+        return self.encode_page([entity_id], fields)[1:-1]
+
+    def encode_page(self, entity_ids, fields=ENTITY_FIELDS):
+        """Return the JSON array of the records of ``entity_ids``"""
+        entities = self.entities
+        if frozenset(fields) != _LIST_VIEW:
+            return b'[' + b','.join(dumps(entities[entity_id].to_dict(fields)) for entity_id in entity_ids) + b']'
+        cached = self._records
+        with self._lock:
+            records = [cached.get(entity_id) for entity_id in entity_ids]
+            for entity_id, record in zip(entity_ids, records):
+                if record is not None:
+                    cached.move_to_end(entity_id)
+        missing = {}
+        for position, record in enumerate(records):
+            if record is None:
+                entity_id = entity_ids[position]
+                record = records[position] = missing[entity_id] = dumps(entities[entity_id].to_dict(fields))
+        with self._lock:
+            self.stats['hits'] += len(records) - len(missing)
+            self.stats['misses'] += len(missing)
+            if self.max_entries > 0:
+                for entity_id, record in missing.items():
+                    if entity_id not in cached:
+                        self.size += len(record)
+                    cached[entity_id] = record
+                while len(cached) > self.max_entries:
+                    _entity_id, record = cached.popitem(last=False)
+                    self.size -= len(record)
+                    self.stats['evicted'] += 1
+        return b'[' + b','.join(records) + b']'
+
+    def get_stats(self):
+        """Return hit/miss/eviction counters and the number and bytes of cached records"""
+        with self._lock:
+            return dict(self.stats, entries=len(self._records), max_entries=self.max_entries,
+                        bytes=self.size)
+
+
+class EncodedPayload(CachedPage):
+    """A JSON response body and its gzip and brotli (or None) compressed copies"""
+
+    def __init__(self, body):
+        super().__init__(body)
+        self.gzipped = gzip.compress(body, mtime=0)
+        self.brotli = brotli.compress(body) if brotli is not None else None
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzipped) + len(self.brotli or b'')
+
+
+class PayloadCache(PageCache):
+    """PageCache of whole JSON responses, stored with compressed copies"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        super().__init__(max_bytes)
+
+    def _entry(self, body):
+        return EncodedPayload(body)
@@ -0,0 +1,193 @@
+"""Static pre-rendering of the site for the Pages deployment.
+
+``export_site`` requests every entity page (once per locale), the entity
+directory and the XML sitemaps through the Flask test client and writes them
+under an output directory as static files, next to a compact search index
+(``search-index.json``) and a ``_routes.json`` that keeps those paths away
+from the Python function.
+
+The default locale is written at the site path (``entity/<slug>.html`` is
+served as ``/entity/<slug>``); other locales under a locale prefix
+(``fr/entity/<slug>.html`` is ``/fr/entity/<slug>``), which is also where the
+site links to them: Pages ignores query strings when serving static files, so
+a ``?lang=`` variant would get the default locale's page.  Entity pages are
+rendered in parallel by forked workers, and incrementally: a manifest in the output directory remembers a
+hash of what each page was rendered from (the entity's content plus a
+fingerprint of templates, translations and settings), so only new and changed
+entities are rendered again and pages of removed entities are deleted.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from itertools import islice
+from pathlib import Path
+
+MANIFEST_NAME = '.prerender.json'
+MANIFEST_VERSION = 1
+SEARCH_INDEX_NAME = 'search-index.json'
+SEARCH_INDEX_FIELDS = ('name', 'reference', 'slug', 'datasets', 'risk_level', 'aliases')
+CHUNK_SIZE = 200
+
+# Inherited by forked pool workers; set right before the pool is created
+_export_app = None
+_export_output = None
+_export_base_url = None
+
+
+def page_file(path, locale, default_locale):
+    """Output file (relative) for a site path in ``locale``, e.g. ``fr/entity/acme.html``"""
+    prefix = '' if locale == default_locale else f"{locale}/"
+    return f"{prefix}{path.strip('/')}.html"
+
+
+def page_url(path, locale, default_locale):
+    """URL of a site path in ``locale``: the path its ``page_file`` is served at"""
+    return path if locale == default_locale else f"/{locale}{path}"
+
+
+def fingerprint(paths, *settings):
+    """Hash of the files under ``paths`` and ``settings``: what every page depends on"""
+    digest = hashlib.sha1(json.dumps([MANIFEST_VERSION, settings], default=str).encode('utf-8'))
+    for root in paths:
+        root = Path(root)
+        files = sorted(root.rglob('*')) if root.is_dir() else [root]
+        for path in files:
+            if path.is_file() and '__pycache__' not in path.parts:
+                digest.update(str(path.relative_to(root.parent)).encode('utf-8'))
+                digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def entity_hash(entity, site_fingerprint):
+    """Hash of everything an entity page is rendered from"""
+    data = json.dumps(entity.to_dict(), sort_keys=True, default=str)
+    return hashlib.sha1(f"{site_fingerprint}:{data}".encode('utf-8')).hexdigest()
+
+
+def write_file(output, name, data):
+    """Write ``data`` to ``output/name`` atomically, creating directories"""
+    path = Path(output) / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp{os.getpid()}")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def _render(client, url, output, name, base_url):
+    """Render ``url`` into ``output/name``; return an error message or None"""
+    response = client.get(url, base_url=base_url)
+    if response.status_code != 200:
+        return f"{url}: HTTP {response.status_code}"
+    write_file(output, name, response.get_data())
+    return None
+
+
+def _render_chunk(pages):
+    client = _export_app.test_client()
+    failed = []
+    for url, name in pages:
+        error = _render(client, url, _export_output, name, _export_base_url)
+        if error:
+            failed.append((name, error))
+    return len(pages), failed
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _render_pages(app, pages, output, base_url, processes):
+    """Render ``(url, file)`` pages, on a fork pool when ``processes > 1``"""
+    global _export_app, _export_output, _export_base_url
+    _export_app, _export_output, _export_base_url = app, output, base_url
+    try:
+        chunks = list(_chunks(pages, CHUNK_SIZE))
+        if (processes <= 1 or len(chunks) <= 1
+                or 'fork' not in multiprocessing.get_all_start_methods()):
+            yield from map(_render_chunk, chunks)
+            return
+        with multiprocessing.get_context('fork').Pool(min(processes, len(chunks))) as pool:
+            yield from pool.imap_unordered(_render_chunk, chunks)
+    finally:
+        _export_app = _export_output = _export_base_url = None
+
+
+def search_index(snapshot):
+    """Compact JSON search index: field names and one row per entity"""
+    rows = [[list(value) if isinstance(value, (list, tuple)) else value
+             for value in (getattr(entity, field) for field in SEARCH_INDEX_FIELDS)]
+            for entity in snapshot]
+    return json.dumps({'version': snapshot.version, 'fields': SEARCH_INDEX_FIELDS, 'entities': rows},
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def export_site(app, snapshot, output, base_url, locales, default_locale='en',
+                site_fingerprint='', processes=1, force=False, static_files=(), static_routes=()):
+    """Pre-render the site for ``snapshot`` into ``output`` and return counters.
+
+    ``static_files`` are extra ``(url, file)`` pages rendered on every run
+    (they depend on the whole snapshot), served at ``static_routes`` (route
+    patterns); ``force`` ignores the manifest.
+    """
+    started = time.perf_counter()
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    manifest_path = output / MANIFEST_NAME
+    try:
+        manifest = json.loads(manifest_path.read_text('utf-8'))
+    except (OSError, ValueError):
+        manifest = {}
+    previous = manifest.get('pages', {}) if not force else {}
+
+    pages = {}
+    pending = []
+    for entity in snapshot:
+        content = entity_hash(entity, site_fingerprint)
+        for locale in locales:
+            name = page_file(f"/entity/{entity.slug}", locale, default_locale)
+            pages[name] = content
+            if previous.get(name) != content or not (output / name).exists():
+                pending.append((page_url(f"/entity/{entity.slug}", locale, default_locale), name))
+
+    stats = {'entities': len(snapshot), 'pages': len(pages), 'rendered': 0, 'unchanged': 0,
+             'removed': 0, 'errors': []}
+    for rendered, failed in _render_pages(app, pending, output, base_url, processes):
+        stats['rendered'] += rendered - len(failed)
+        for name, error in failed:
+            # Left out of the manifest (and removed) so the next run retries it
+            pages.pop(name, None)
+            stats['errors'].append(error)
+    stats['unchanged'] = len(pages) - stats['rendered']
+
+    client = app.test_client()
+    for url, name in static_files:
+        error = _render(client, url, output, name, base_url)
+        if error:
+            stats['errors'].append(error)
+    write_file(output, SEARCH_INDEX_NAME, search_index(snapshot))
+
+    # Pages serves the excluded paths as static files, without the function
+    excluded = ['/entity/*', f'/{SEARCH_INDEX_NAME}', *static_routes]
+    excluded += [f'/{locale}/*' for locale in locales if locale != default_locale]
+    routes = {'version': 1, 'include': ['/*'], 'exclude': excluded}
+    write_file(output, '_routes.json', json.dumps(routes, indent=2).encode('utf-8'))
+
+    for name in set(manifest.get('pages', {})) - set(pages):
+        try:
+            (output / name).unlink()
+            stats['removed'] += 1
+        except FileNotFoundError:
+            pass
+
+    manifest = {'format': MANIFEST_VERSION, 'version': snapshot.version, 'fingerprint': site_fingerprint,
+                'created': time.time(), 'pages': pages}
+    write_file(output, MANIFEST_NAME, json.dumps(manifest, separators=(',', ':')).encode('utf-8'))
+    stats['seconds'] = round(time.perf_counter() - started, 2)
+    return stats
@@ -0,0 +1,275 @@
+"""Fuzzy and phonetic name screening against the loaded entities.
+
+Every name of an entity (name, fullname and aliases) is tokenized and put in
+a blocking index keyed by a phonetic code plus the first and last three
+letters of each token.  A query only scores the names that share the most
+blocking keys with it, so the cost of a screen depends on the size of the
+matching buckets rather than on the size of the dataset.
+
+Candidates are scored with a token-set Jaro-Winkler similarity, which
+tolerates typos and reordered name parts; tokens with the same phonetic code
+count as near-matches to catch transliteration variants.
+"""
+import re
+from array import array
+from collections import Counter
+from functools import lru_cache
+
+from search import fold
+
+DEFAULT_THRESHOLD = 0.85
+DEFAULT_LIMIT = 20
+# Only the names sharing the most blocking keys with the query get scored
+MAX_CANDIDATES = 200
+# Blocking buckets larger than this are skipped when smaller ones exist
+MAX_BUCKET_SIZE = 5000
+# Similarity credited to two different tokens with the same phonetic code
+PHONETIC_MATCH_SCORE = 0.9
+
+NON_ALNUM_RE = re.compile(r'[^a-z0-9]+')
+
+# Legal forms and connectives that carry no identifying information
+STOP_TOKENS = frozenset({
+    'ltd', 'limited', 'inc', 'incorporated', 'plc', 'llc', 'llp', 'lp', 'co',
+    'corp', 'corporation', 'company', 'sa', 'ag', 'gmbh', 'bv', 'nv', 'srl',
+    'spa', 'sarl', 'bhd', 'sdn', 'pty', 'oy', 'ab', 'as', 'the', 'of', 'and',
+})
+
+# Spelling rules applied before coding, roughly ordered longest first
+PHONETIC_RULES = (
+    ('sch', 's'), ('tch', 'c'), ('ph', 'f'), ('ck', 'k'), ('sh', 's'),
+    ('ch', 'c'), ('kh', 'h'), ('gh', 'g'), ('th', 't'), ('dh', 'd'),
+    ('ou', 'u'), ('q', 'k'), ('x', 'ks'), ('w', 'v'), ('z', 's'),
+    ('y', 'i'), ('j', 'i'),
+)
+VOWELS = frozenset('aeiou')
+
+
+def tokenize(text):
+    """Fold ``text`` and split it into alphanumeric tokens"""
+    return NON_ALNUM_RE.sub(' ', fold(text)).split()
+
+
+def significant_tokens(tokens):
+    """Drop stop tokens unless nothing else is left"""
+    significant = [token for token in tokens if token not in STOP_TOKENS]
+    return significant or list(tokens)
+
+
+@lru_cache(maxsize=65536)
+def phonetic_key(token):
+    """Return a coarse phonetic code for a single folded token.
+
+    Vowels after the first letter are dropped and repeated letters collapsed,
+    so common transliterations (Mohammed/Muhammad, Aly/Ali) share a code.
+    """
+    if token.isdigit():
+        return token
+    for pattern, replacement in PHONETIC_RULES:
+        token = token.replace(pattern, replacement)
+    if token[:1] in VOWELS:
+        first, rest = 'a', token[1:]
+    else:
+        first, rest = token[:1], token[1:]
+    code = [first]
+    for char in rest:
+        if char in VOWELS or char == 'h':
+            continue
+        if char != code[-1]:
+            code.append(char)
+    return ''.join(code[:6])
+
+
+def jaro_winkler(left, right):
+    """Jaro-Winkler similarity of two strings, between 0.0 and 1.0"""
+    if left == right:
+        return 1.0
+    len_left, len_right = len(left), len(right)
+    if not len_left or not len_right:
+        return 0.0
+
+    window = max(max(len_left, len_right) // 2 - 1, 0)
+    left_matched = [False] * len_left
+    right_matched = [False] * len_right
+    matches = 0
+    for i, char in enumerate(left):
+        start = max(0, i - window)
+        end = min(i + window + 1, len_right)
+        for j in range(start, end):
+            if not right_matched[j] and right[j] == char:
+                left_matched[i] = right_matched[j] = True
+                matches += 1
+                break
+    if not matches:
+        return 0.0
+
+    transpositions = 0
+    j = 0
+    for i in range(len_left):
+        if left_matched[i]:
+            while not right_matched[j]:
+                j += 1
+            if left[i] != right[j]:
+                transpositions += 1
+            j += 1
+
+    jaro = (matches / len_left + matches / len_right
+            + (matches - transpositions / 2) / matches) / 3
+    prefix = 0
+    for a, b in zip(left[:4], right[:4]):
+        if a != b:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+@lru_cache(maxsize=262144)
+def token_similarity(left, right):
+    """Similarity of two tokens, crediting phonetic matches"""
+    score = jaro_winkler(left, right)
+    if score < PHONETIC_MATCH_SCORE and phonetic_key(left) == phonetic_key(right):
+        return PHONETIC_MATCH_SCORE
+    return score
+
+
+def _coverage(tokens, other):
+    """How well ``other`` covers ``tokens``, weighted by token length"""
+    total = 0.0
+    weight = 0
+    for token in tokens:
+        best = max(token_similarity(token, candidate) for candidate in other)
+        total += best * len(token)
+        weight += len(token)
+    return total / weight
+
+
+def name_similarity(query_tokens, name_tokens):
+    """Order-insensitive similarity of two token lists.
+
+    Coverage of the query by the name weighs more than the reverse, so extra
+    middle names on the listed entity only cost a little.
+    """
+    if not query_tokens or not name_tokens:
+        return 0.0
+    if query_tokens == name_tokens:
+        return 1.0
+    forward = _coverage(query_tokens, name_tokens)
+    backward = _coverage(name_tokens, query_tokens)
+    return 0.7 * forward + 0.3 * backward
+
+
+def blocking_keys(tokens):
+    """Return the blocking keys for a list of significant tokens"""
+    keys = set()
+    for token in tokens:
+        keys.add('#' + phonetic_key(token))
+        if len(token) > 3:
+            keys.add('<' + token[:3])
+            keys.add('>' + token[-3:])
+    return keys
+
+
+def match_summary(score, entity, matched_name):
+    """Format one screening hit for the JSON APIs"""
+    return {
+        'score': round(score, 4),
+        'matched_name': matched_name,
+        'name': entity['name'],
+        'reference': entity['reference'],
+        'slug': entity['slug'],
+        'datasets': entity['datasets'],
+        'risk_level': entity['risk_level'],
+    }
+
+
+def entity_names(entity):
+    """Return the distinct names an entity can be screened under"""
+    names = [entity.get('name'), entity.get('fullname'), *entity.get('aliases', [])]
+    seen = set()
+    result = []
+    for name in names:
+        if name and name not in seen:
+            seen.add(name)
+            result.append(name)
+    return result
+
+
+class ScreeningIndex:
+    """Blocking index and token cache over the names of a sequence of entities"""
+
+    def __init__(self, entities):
+        self.name_entity = array('I')
+        self.names = []
+        self.name_tokens = []
+        buckets = self._add_names(entities, 0)
+        self.buckets = {key: array('I', ids) for key, ids in buckets.items()}
+
+    def _add_names(self, entities, start):
+        buckets = {}
+        for entity_id, entity in enumerate(entities, start=start):
+            for name in entity_names(entity):
+                tokens = tuple(significant_tokens(tokenize(name)))
+                if not tokens:
+                    continue
+                name_id = len(self.names)
+                self.names.append(name)
+                self.name_tokens.append(tokens)
+                self.name_entity.append(entity_id)
+                for key in blocking_keys(tokens):
+                    buckets.setdefault(key, []).append(name_id)
+        return buckets
+
+    def extended(self, entities, start):
+        """Return a new index that also covers ``entities``, with ids from ``start``.
+
+        The name tables are copied and only the buckets the new names fall in
+        are rebuilt; this index is left untouched.
+        """
+        index = ScreeningIndex.__new__(ScreeningIndex)
+        index.name_entity = array('I', self.name_entity)
+        index.names = list(self.names)
+        index.name_tokens = list(self.name_tokens)
+        buckets = index._add_names(entities, start)
+        index.buckets = dict(self.buckets)
+        for key, ids in buckets.items():
+            index.buckets[key] = self.buckets.get(key, array('I')) + array('I', ids)
+        return index
+
+    def candidates(self, tokens, max_candidates=MAX_CANDIDATES):
+        """Return the ids of the names sharing the most blocking keys with ``tokens``"""
+        buckets = sorted((self.buckets[key] for key in blocking_keys(tokens)
+                          if key in self.buckets), key=len)
+        hits = Counter()
+        for position, bucket in enumerate(buckets):
+            # Huge buckets (very common names or prefixes) add little signal;
+            # the smallest bucket is always used so no query goes blind
+            if position and len(bucket) > MAX_BUCKET_SIZE:
+                break
+            hits.update(bucket)
+        return [name_id for name_id, _count in hits.most_common(max_candidates)]
+
+    def screen(self, query, threshold=DEFAULT_THRESHOLD, limit=DEFAULT_LIMIT, exclude=()):
+        """Return ``(score, entity_id, matched_name)`` tuples, best first.
+
+        Each entity appears at most once, under its best scoring name, and
+        only if that score is at least ``threshold``.  ``limit=None`` returns
+        every candidate above the threshold.  Entity ids in ``exclude``
+        (e.g. tombstones) are skipped.
+        """
+        tokens = tuple(significant_tokens(tokenize(query)))
+        if not tokens:
+            return []
+
+        best = {}
+        for name_id in self.candidates(tokens):
+            entity_id = self.name_entity[name_id]
+            if entity_id in exclude:
+                continue
+            score = name_similarity(tokens, self.name_tokens[name_id])
+            if score < threshold:
+                continue
+            if entity_id not in best or score > best[entity_id][0]:
+                best[entity_id] = (score, entity_id, self.names[name_id])
+
+        results = sorted(best.values(), key=lambda match: (-match[0], match[1]))
+        return results[:limit]
@@ -0,0 +1,189 @@
+"""Inverted n-gram index behind the ``q`` filter of /api/entities.
+
+Every searchable field (name, fullname, reference and aliases) is folded to
+lowercase ASCII with unidecode and split into character bigrams and trigrams.
+Each gram maps to a sorted array of entity ids, so a substring query is
+answered by intersecting the posting lists of its grams and verifying the few
+remaining candidates, instead of lowercasing every field of every entity.
+"""
+import re
+from array import array
+from bisect import bisect_left
+
+from unidecode import unidecode
+
+from delta import AppendedSequence, OverlayMapping
+
+GRAM_SIZES = (2, 3)
+# Separates the fields of an entity's haystack so matches never span fields
+FIELD_SEPARATOR = '\x00'
+TOKEN_RE = re.compile(r'\w+')
+
+
+def fold(text):
+    """Normalize text for searching: transliterate to ASCII and lowercase"""
+    if not text:
+        return ''
+    return unidecode(text).lower()
+
+
+def searchable_fields(entity):
+    """Return the raw values of an entity that the search box matches against"""
+    return [entity.get('name'), entity.get('fullname'), entity.get('reference'),
+            *entity.get('aliases', [])]
+
+
+def grams(text):
+    """Return the set of bigrams and trigrams of ``text``"""
+    result = set()
+    for size in GRAM_SIZES:
+        result.update(text[i:i + size] for i in range(len(text) - size + 1))
+    return result
+
+
+def intersect(left, right):
+    """Intersect two sorted id sequences, galloping through the longer one"""
+    if len(left) > len(right):
+        left, right = right, left
+    result = []
+    lo = 0
+    hi = len(right)
+    for item in left:
+        lo = bisect_left(right, item, lo, hi)
+        if lo == hi:
+            break
+        if right[lo] == item:
+            result.append(item)
+            lo += 1
+    return result
+
+
+def _index_entities(entities, start, haystacks):
+    """Append the haystacks of ``entities`` and return their gram and token id lists"""
+    postings = {}
+    token_postings = {}
+    for entity_id, entity in enumerate(entities, start=start):
+        fields = [folded for folded in map(fold, searchable_fields(entity)) if folded]
+        haystacks.append(FIELD_SEPARATOR.join(fields))
+
+        entity_grams = set()
+        entity_tokens = set()
+        for field in fields:
+            entity_grams.update(grams(field))
+            entity_tokens.update(TOKEN_RE.findall(field))
+        for gram in entity_grams:
+            postings.setdefault(gram, []).append(entity_id)
+        for token in entity_tokens:
+            token_postings.setdefault(token, []).append(entity_id)
+    return postings, token_postings
+
+
+class SearchIndex:
+    """Gram and token postings over a sequence of entities.
+
+    Entity ids are positions in the sequence the index was built from, and
+    every query returns them in ascending order (i.e. feed order).
+    """
+
+    def __init__(self, entities):
+        self.haystacks = []
+        postings, token_postings = _index_entities(entities, 0, self.haystacks)
+        self.postings = {gram: array('I', ids) for gram, ids in postings.items()}
+        self.token_postings = {token: array('I', ids) for token, ids in token_postings.items()}
+        self.tokens = sorted(self.token_postings)
+        self.extra_tokens = []
+
+    @classmethod
+    def from_parts(cls, haystacks, postings, token_postings, tokens):
+        """Wrap prebuilt (e.g. memory-mapped) haystacks and postings.
+
+        ``postings`` and ``token_postings`` need ``get``/``[]`` by key and
+        ``tokens`` must be sorted; posting lists are ascending id sequences.
+        """
+        index = cls.__new__(cls)
+        index.haystacks = haystacks
+        index.postings = postings
+        index.token_postings = token_postings
+        index.tokens = tokens
+        index.extra_tokens = []
+        return index
+
+    def extended(self, entities, start):
+        """Return a new index that also covers ``entities``, with ids from ``start``.
+
+        ``start`` must be the current number of ids.  This index is left
+        untouched: only the posting lists the new entities appear in are
+        copied, everything else is shared.
+        """
+        haystacks = []
+        postings, token_postings = _index_entities(entities, start, haystacks)
+        index = SearchIndex.__new__(SearchIndex)
+        index.haystacks = AppendedSequence(self.haystacks, haystacks)
+        index.postings = OverlayMapping(self.postings, {
+            gram: array('I', self.postings.get(gram, ())) + array('I', ids)
+            for gram, ids in postings.items()})
+        index.token_postings = OverlayMapping(self.token_postings, {
+            token: array('I', self.token_postings.get(token, ())) + array('I', ids)
+            for token, ids in token_postings.items()})
+        # New tokens are kept in a small sorted list next to the base tokens
+        index.tokens = self.tokens
+        new_tokens = [token for token in token_postings if token not in self.token_postings]
+        index.extra_tokens = sorted(self.extra_tokens + new_tokens)
+        return index
+
+    def __len__(self):
+        return len(self.haystacks)
+
+    def search(self, query):
+        """Return the ids of entities with a field containing ``query``"""
+        query = fold(query)
+        if not query:
+            return list(range(len(self.haystacks)))
+        if len(query) < min(GRAM_SIZES):
+            # Too short to have grams; the haystacks are already folded
+            return [i for i, haystack in enumerate(self.haystacks) if query in haystack]
+
+        if len(query) in GRAM_SIZES:
+            # The query is itself a gram, its posting list is the exact answer
+            return list(self.postings.get(query, ()))
+
+        lists = []
+        for gram in grams(query):
+            ids = self.postings.get(gram)
+            if ids is None:
+                return []
+            lists.append(ids)
+        lists.sort(key=len)
+
+        candidates = lists[0]
+        for ids in lists[1:]:
+            if len(candidates) * 16 > len(ids):
+                # Galloping only pays off against much longer lists; past
+                # this point verifying the candidates directly is cheaper
+                break
+            candidates = intersect(candidates, ids)
+            if not candidates:
+                return []
+
+        # Co-occurring grams do not guarantee a contiguous match
+        haystacks = self.haystacks
+        return [i for i in candidates if query in haystacks[i]]
+
+    def prefix(self, query):
+        """Return the ids of entities with a word starting with each word of ``query``"""
+        words = TOKEN_RE.findall(fold(query))
+        if not words:
+            return list(range(len(self.haystacks)))
+
+        result = None
+        for word in sorted(set(words), key=len, reverse=True):
+            matches = set()
+            for tokens in (self.tokens, self.extra_tokens):
+                position = bisect_left(tokens, word)
+                while position < len(tokens) and tokens[position].startswith(word):
+                    matches.update(self.token_postings[tokens[position]])
+                    position += 1
+            result = matches if result is None else result & matches
+            if not result:
+                return []
+        return sorted(result)
@@ -0,0 +1,170 @@
+"""Sharded XML sitemaps.
+
+The sitemap protocol caps a file at 50,000 URLs, so /sitemap.xml is a sitemap
+index pointing at numbered shards.  Shards are rendered as a stream and the
+result (plus, optionally, a gzip-compressed copy) is kept in a PageCache
+keyed by the snapshot version, so crawlers re-fetching the sitemap do not
+re-render anything until the data changes.  ``lastmod`` comes from the
+entities' feed versions, which are epoch milliseconds.
+
+A shard only touches its own entities: the live entity ids at its positions
+are found by bisecting the sorted tombstones, so rendering (or dating) shard
+``k`` costs the same for every ``k``, and a memory-mapped snapshot only
+materializes the entities of that shard.
+"""
+import gzip
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from page_cache import CachedPage, PageCache
+
+SHARD_SIZE = 50000
+# Rendered pieces are sent in chunks of about this many bytes
+CHUNK_SIZE = 64 * 1024
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+_DAY_MS = 24 * 60 * 60 * 1000
+
+
+@lru_cache(maxsize=4096)
+def _day_date(day):
+    try:
+        return datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y-%m-%d')
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
+def lastmod(version, default=None):
+    """Return the W3C date of a feed version (epoch milliseconds), or ``default``"""
+    if isinstance(version, int) and not isinstance(version, bool) and version > 0:
+        return _day_date(version // _DAY_MS) or default
+    return default
+
+
+def snapshot_lastmod(snapshot):
+    """Return the W3C date the snapshot's source file was modified, or None"""
+    if not snapshot.mtime:
+        return None
+    return datetime.fromtimestamp(snapshot.mtime, timezone.utc).strftime('%Y-%m-%d')
+
+
+def shard_count(snapshot, pages=(), shard_size=SHARD_SIZE):
+    """Number of shards needed for ``pages`` plus every live entity (at least one)"""
+    total = len(pages) + len(snapshot)
+    return max(1, -(-total // shard_size))
+
+
+def live_ids(snapshot, start, stop):
+    """Ids of the live entities at positions ``start:stop`` of the snapshot's iteration order"""
+    stop = min(stop, len(snapshot))
+    if start >= stop:
+        return range(0)
+    if not snapshot.dead:
+        return range(start, stop)
+    dead = sorted(snapshot.dead)
+    # The first live id with ``start`` live ids before it
+    low, high = start, start + len(dead)
+    while low < high:
+        middle = (low + high) // 2
+        if middle + 1 - bisect_right(dead, middle) > start:
+            high = middle
+        else:
+            low = middle + 1
+    ids = []
+    entity_id = low
+    skip = bisect_left(dead, entity_id)
+    while len(ids) < stop - start:
+        if skip < len(dead) and dead[skip] == entity_id:
+            skip += 1
+        else:
+            ids.append(entity_id)
+        entity_id += 1
+    return ids
+
+
+def _shard_bounds(shard, pages, shard_size):
+    """Positions of shard ``shard`` among ``pages``, then among the live entities"""
+    start = (shard - 1) * shard_size
+    stop = start + shard_size
+    return pages[start:stop], max(start - len(pages), 0), max(stop - len(pages), 0)
+
+
+def shard_urls(snapshot, base_url, shard, pages=(), shard_size=SHARD_SIZE):
+    """Yield the ``<url>`` entries of shard number ``shard`` (from 1): ``pages`` first, then entities"""
+    shard_pages, start, stop = _shard_bounds(shard, list(pages), shard_size)
+    yield from shard_pages
+    default = snapshot_lastmod(snapshot)
+    entities = snapshot.entities
+    for entity_id in live_ids(snapshot, start, stop):
+        entity = entities[entity_id]
+        yield {
+            'loc': f"{base_url}/entity/{entity.slug}",
+            'lastmod': lastmod(entity.version, default),
+            'changefreq': 'daily',
+            'priority': 0.6,
+        }
+
+
+def shard_lastmod(snapshot, shard, pages=(), shard_size=SHARD_SIZE):
+    """Return the latest ``lastmod`` of shard number ``shard``, or None"""
+    return max((page['lastmod'] for page in shard_urls(snapshot, '', shard, pages, shard_size)
+                if page.get('lastmod')), default=None)
+
+
+def shard_lastmods(snapshot, pages=(), shard_size=SHARD_SIZE):
+    """Return the latest ``lastmod`` of each shard, in shard order"""
+    return [shard_lastmod(snapshot, shard, pages, shard_size)
+            for shard in range(1, shard_count(snapshot, pages, shard_size) + 1)]
+
+
+def iter_chunks(pieces, chunk_size=CHUNK_SIZE):
+    """Join rendered template pieces into UTF-8 chunks of about ``chunk_size`` bytes"""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+class RenderedSitemap(CachedPage):
+    """A rendered sitemap document and its gzip-compressed copy (or None)"""
+
+    def __init__(self, body, gzipped=None):
+        super().__init__(body)
+        self.gzipped = gzipped
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzipped or b'')
+
+
+class SitemapCache(PageCache):
+    """PageCache of rendered sitemaps, optionally storing gzipped copies too"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, compress=False):
+        super().__init__(max_bytes)
+        self.compress = compress
+
+    def _entry(self, body):
+        return RenderedSitemap(body, gzip.compress(body, mtime=0) if self.compress else None)
+
+    def render(self, key, chunks):
+        """Return the cached entry for ``key``, rendering ``chunks`` on a miss"""
+        entry = self.get(key)
+        if entry is None:
+            entry = self.put(key, b''.join(chunks))
+        return entry
+
+    def stream(self, key, chunks):
+        """Yield ``chunks`` and cache their concatenation once all were sent"""
+        rendered = []
+        for chunk in chunks:
+            rendered.append(chunk)
+            yield chunk
+        self.put(key, b''.join(rendered))
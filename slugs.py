@@ -0,0 +1,158 @@
+"""URL slugs for entity pages and the slug -> entity index."""
+import re
+from unidecode import unidecode
+
+
+def slugify(text):
+    """Convert text to URL-safe slug"""
+    # Convert to ASCII
+    text = unidecode(text)
+    # Convert to lowercase
+    text = text.lower()
+    # Replace spaces and special chars with hyphens
+    text = re.sub(r'[^\w\s-]', '', text)
+    text = re.sub(r'[-\s]+', '-', text)
+    # Strip leading/trailing hyphens
+    return text.strip('-')
+
+
+def base_slug(entity):
+    """Return the slug an entity's name gives it before collisions are resolved"""
+    return slugify(entity.name or '') or slugify(entity.reference or '') or 'entity'
+
+
+def build_slug_index(entities, collisions=None):
+    """Assign every entity a unique slug and return a slug -> entity id dict.
+
+    Entity ids are positions in ``entities``.
+
+    Entities whose names slugify to the same value are disambiguated by
+    appending their reference.  The entity with the lowest reference keeps the
+    bare slug, so the outcome does not depend on the order of the feed.  Every
+    entity in a collision group is also reachable as ``<slug>-<reference>``.
+    When a ``collisions`` dict is given it receives ``base slug -> ids`` for
+    every group of two or more entities.
+
+    The ``slug`` attribute of each entity is updated in place; this must
+    happen before the entities are published in a snapshot.
+    """
+    groups = {}
+    for position, entity in enumerate(entities):
+        base = entity.slug or slugify(entity.reference or '') or 'entity'
+        groups.setdefault(base, []).append((entity.reference or '', position, entity))
+
+    index = {}
+    collided = []
+    for base, members in groups.items():
+        members.sort(key=lambda member: member[:2])
+        first = members[0][2]
+        first.slug = base
+        index[base] = members[0][1]
+        if len(members) > 1:
+            collided.append((base, members))
+            if collisions is not None:
+                collisions[base] = tuple(member[1] for member in members)
+
+    # Suffix collisions only after every natural slug is taken, so a
+    # suffixed slug can never shadow another entity's natural slug.
+    for base, members in collided:
+        for reference, position, entity in members:
+            suffix = slugify(reference)
+            slug = f"{base}-{suffix}" if suffix else base
+            counter = 2
+            while slug in index and index[slug] != position:
+                slug = f"{base}-{suffix}-{counter}" if suffix else f"{base}-{counter}"
+                counter += 1
+            index[slug] = position
+            if entity is not members[0][2]:
+                entity.slug = slug
+    return index
+
+
+def update_slug_index(slugs, collisions, entities, dead, removed, added):
+    """Re-slug only the collision groups touched by a delta.
+
+    ``slugs`` and ``collisions`` are the current index and collision groups,
+    ``entities`` the id-addressable entities including the ``added`` ids,
+    ``dead`` the already tombstoned ids and ``removed`` the ids being
+    tombstoned now.  Returns ``(slug_changes, collision_changes, copies)``:
+    key changes to layer over the two mappings (None removes a key) and
+    re-slugged copies of unchanged entities whose slug moved, by id.
+
+    Returns None when a touched base slug is currently another group's
+    suffixed slug; the caller then rebuilds the whole index.
+    """
+    gone = set(dead) | set(removed)
+    bases = {}
+    for entity_id in removed:
+        bases.setdefault(base_slug(entities[entity_id]), set())
+    for entity_id in added:
+        bases.setdefault(base_slug(entities[entity_id]), set()).add(entity_id)
+
+    slug_changes = {}
+    collision_changes = {}
+    groups = []
+    for base, new_ids in bases.items():
+        group = collisions.get(base)
+        if group is not None:
+            old_ids = list(group)
+        else:
+            holder = slugs.get(base)
+            if holder is None or holder in dead:
+                old_ids = []
+            elif base_slug(entities[holder]) != base:
+                return None
+            else:
+                old_ids = [holder]
+
+        # Drop every key the old members were registered under
+        for entity_id in old_ids:
+            entity = entities[entity_id]
+            for key in (base, entity.slug, f"{base}-{slugify(entity.reference or '')}"):
+                if slugs.get(key) == entity_id:
+                    slug_changes[key] = None
+
+        members = sorted((entities[entity_id].reference or '', entity_id)
+                         for entity_id in set(old_ids) - gone | new_ids)
+        collision_changes[base] = (tuple(entity_id for _reference, entity_id in members)
+                                   if len(members) > 1 else None)
+        if members:
+            groups.append((base, members))
+
+    # As in build_slug_index: natural slugs first, then suffixes
+    assigned = {}
+    for base, members in groups:
+        slug_changes[base] = members[0][1]
+        assigned[members[0][1]] = base
+
+    def current(key):
+        if key in slug_changes:
+            return slug_changes[key]
+        entity_id = slugs.get(key)
+        return None if entity_id is None or entity_id in gone else entity_id
+
+    for base, members in groups:
+        if len(members) < 2:
+            continue
+        for reference, entity_id in members:
+            suffix = slugify(reference)
+            slug = f"{base}-{suffix}" if suffix else base
+            counter = 2
+            while current(slug) not in (None, entity_id):
+                slug = f"{base}-{suffix}-{counter}" if suffix else f"{base}-{counter}"
+                counter += 1
+            slug_changes[slug] = entity_id
+            assigned.setdefault(entity_id, slug)
+
+    copies = {}
+    added = set(added)
+    for entity_id, slug in assigned.items():
+        entity = entities[entity_id]
+        if entity.slug == slug:
+            continue
+        if entity_id in added:
+            entity.slug = slug
+        else:
+            copies[entity_id] = entity = entity.copy()
+            entity.slug = slug
+    return slug_changes, collision_changes, copies
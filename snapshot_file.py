@@ -0,0 +1,435 @@
+"""Compiled, memory-mappable entity snapshots.
+
+``write_snapshot`` serializes an in-memory EntitySnapshot (entities, slug,
+record id and document indexes, search postings and facet bitsets) into one
+binary file, and
+``load_snapshot`` memory-maps such a file back into an EntitySnapshot without
+parsing the feed.  Strings, entity records and posting lists are read
+straight out of the mapping on access, so every worker shares the same pages
+through the OS page cache and cold start does not depend on the feed size.
+
+Layout: an 8-byte magic, a little-endian ``uint32`` header length, the JSON
+header, then 8-byte aligned sections.  The header lists every section as
+``[offset, length]`` (offsets relative to the first 8-byte boundary after the
+header) along with the format version, byte order, entity count and the
+content hash, size and mtime of the source feed (see read_file_header).
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+
+from delta import Deletion
+from entities import Entity
+from facets import FacetIndex
+from search import SearchIndex
+
+MAGIC = b'EVSNAP\x00\x00'
+FORMAT_VERSION = 5
+_HEADER_LENGTH = struct.Struct('<I')
+
+# uint32 columns of the entity record table, in order
+RECORD_COLUMNS = (
+    'name', 'reference', 'fullname', 'slug', 'datasets', 'risk_level', 'countries',
+    'alias_start', 'alias_count', 'flags', 'haystack', 'oid', 'version', 'links',
+)
+RECORD_WIDTH = len(RECORD_COLUMNS)
+_COLUMN = {column: position for position, column in enumerate(RECORD_COLUMNS)}
+
+# Two bits per tri-state flag: 0 = None, 1 = False, 2 = True
+FLAG_FIELDS = ('insolvent', 'media', 'financialRegulator')
+_FLAG_CODES = {None: 0, False: 1, True: 2}
+_FLAG_VALUES = (None, False, True)
+
+
+class SnapshotFormatError(Exception):
+    """Raised when a snapshot file is missing, truncated or incompatible"""
+
+
+def _encode_flags(entity):
+    flags = 0
+    for position, field in enumerate(FLAG_FIELDS):
+        value = getattr(entity, field)
+        flags |= _FLAG_CODES.get(value if value is None else bool(value), 0) << (2 * position)
+    return flags
+
+
+def _decode_flag(flags, position):
+    return _FLAG_VALUES[(flags >> (2 * position)) & 3]
+
+
+class _StringPoolBuilder:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, text):
+        text = text or ''
+        string_id = self.ids.get(text)
+        if string_id is None:
+            string_id = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+    def sections(self):
+        offsets = array('Q', [0])
+        data = bytearray()
+        for text in self.strings:
+            data += text.encode('utf-8')
+            offsets.append(len(data))
+        return offsets, data
+
+
+def _postings_sections(pool, postings):
+    """Sorted key ids, posting offsets and concatenated postings of a mapping"""
+    keys = array('I')
+    offsets = array('Q', [0])
+    values = array('I')
+    for key in sorted(postings):
+        keys.append(pool.add(key))
+        values.extend(postings[key])
+        offsets.append(len(values))
+    return keys, offsets, values
+
+
+def _data_start(header_length):
+    start = len(MAGIC) + _HEADER_LENGTH.size + header_length
+    return start + (-start % 8)
+
+
+def write_snapshot(snapshot, path, source_stat=None):
+    """Compile an in-memory EntitySnapshot into ``path`` (replaced atomically).
+
+    ``source_stat``, the ``os.stat`` of the feed the snapshot was read from,
+    is recorded so readers can tell whether the feed changed since.
+    """
+    if snapshot.dead:
+        # Tombstones are not stored; compile the live entities under new ids
+        snapshot = snapshot.compacted()
+    entities = snapshot.entities
+    search_index = snapshot.search_index
+    pool = _StringPoolBuilder()
+    records = array('I')
+    alias_ids = array('I')
+    detail_offsets = array('Q', [0])
+    detail_data = bytearray()
+
+    for entity_id, entity in enumerate(entities):
+        aliases = [pool.add(alias) for alias in entity.aliases]
+        records.extend((
+            pool.add(entity.name),
+            pool.add(entity.reference),
+            pool.add(entity.fullname),
+            pool.add(entity.slug),
+            pool.add(json.dumps(list(entity.datasets))),
+            pool.add(entity.risk_level),
+            pool.add(json.dumps(list(entity.countries))),
+            len(alias_ids),
+            len(aliases),
+            _encode_flags(entity),
+            pool.add(search_index.haystacks[entity_id]),
+            pool.add(entity.oid),
+            pool.add(json.dumps(entity.version)),
+            pool.add(json.dumps(entity.links) if entity.links else ''),
+        ))
+        alias_ids.extend(aliases)
+        detail_data += entity.detail_blob() or b''
+        detail_offsets.append(len(detail_data))
+
+    slug_items = sorted(snapshot.slugs.items())
+    slug_keys = array('I', (pool.add(slug) for slug, _entity_id in slug_items))
+    slug_targets = array('I', (entity_id for _slug, entity_id in slug_items))
+    oid_items = sorted(snapshot.oids.items())
+    oid_keys = array('I', (pool.add(oid) for oid, _entity_id in oid_items))
+    oid_targets = array('I', (entity_id for _oid, entity_id in oid_items))
+    collision_keys, collision_offsets, collision_ids = _postings_sections(pool, snapshot.slug_collisions)
+    shared_keys, shared_offsets, shared_ids = _postings_sections(pool, snapshot.shared_documents)
+    deletion_items = sorted(snapshot.deletions.items())
+    deletion_keys = array('I', (pool.add(oid) for oid, _deletion in deletion_items))
+    deletion_versions = array('I', (pool.add(json.dumps(deletion.version))
+                                    for _oid, deletion in deletion_items))
+    document_items = sorted(snapshot.documents.items())
+    document_keys = array('I', (pool.add(reference) for reference, _entity_id in document_items))
+    document_targets = array('I', (entity_id for _reference, entity_id in document_items))
+    gram_keys, gram_offsets, gram_postings = _postings_sections(pool, search_index.postings)
+    token_keys, token_offsets, token_postings = _postings_sections(pool, search_index.token_postings)
+    string_offsets, string_data = pool.sections()
+
+    sections = {
+        'string_offsets': string_offsets, 'string_data': string_data,
+        'records': records, 'alias_ids': alias_ids,
+        'detail_offsets': detail_offsets, 'detail_data': detail_data,
+        'slug_keys': slug_keys, 'slug_targets': slug_targets,
+        'slug_collision_keys': collision_keys, 'slug_collision_offsets': collision_offsets,
+        'slug_collision_ids': collision_ids,
+        'oid_keys': oid_keys, 'oid_targets': oid_targets,
+        'deletion_keys': deletion_keys, 'deletion_versions': deletion_versions,
+        'document_keys': document_keys, 'document_targets': document_targets,
+        'shared_document_keys': shared_keys, 'shared_document_offsets': shared_offsets,
+        'shared_document_ids': shared_ids,
+        'gram_keys': gram_keys, 'gram_offsets': gram_offsets, 'gram_postings': gram_postings,
+        'token_keys': token_keys, 'token_offsets': token_offsets, 'token_postings': token_postings,
+    }
+    facet_bytes = (len(entities) + 7) // 8
+    facets = {}
+    for dimension, values in snapshot.facets.bitsets.items():
+        for value, bits in values.items():
+            name = f'facet:{dimension}:{value}'
+            sections[name] = bits.to_bytes(facet_bytes, 'little')
+            facets.setdefault(dimension, []).append([value, name])
+
+    # Lay the sections out before writing so the header can point at them
+    layout = {}
+    position = 0
+    for name, data in sections.items():
+        length = len(memoryview(data).cast('B'))
+        layout[name] = [position, length]
+        position += length + (-length % 8)
+    header = json.dumps({
+        'format': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'version': snapshot.version,
+        'source_mtime': snapshot.mtime,
+        'source_size': source_stat.st_size if source_stat else None,
+        'source_mtime_ns': source_stat.st_mtime_ns if source_stat else None,
+        'created': time.time(),
+        'count': len(entities),
+        'record_columns': RECORD_COLUMNS,
+        'facets': facets,
+        'sections': layout,
+    }).encode('utf-8')
+    data_start = _data_start(len(header))
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        for name, data in sections.items():
+            f.seek(data_start + layout[name][0])
+            f.write(memoryview(data).cast('B'))
+        f.truncate(data_start + position)
+    os.replace(tmp_path, path)
+
+
+class StringTable(Sequence):
+    """Strings of the pool, decoded from the mapping on access"""
+
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, string_id):
+        return str(self._data[self._offsets[string_id]:self._offsets[string_id + 1]], 'utf-8')
+
+
+class KeyView(Sequence):
+    """A sequence of strings given as ids into a StringTable"""
+
+    def __init__(self, strings, ids):
+        self._strings = strings
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, position):
+        return self._strings[self._ids[position]]
+
+
+class MappedPostings:
+    """Read-only ``key -> ascending id sequence`` mapping over sorted keys"""
+
+    def __init__(self, keys, offsets, values):
+        self._keys = keys
+        self._offsets = offsets
+        self._values = values
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _position(self, key):
+        position = bisect_left(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            return position
+        return None
+
+    def get(self, key, default=None):
+        position = self._position(key)
+        if position is None:
+            return default
+        return self._values[self._offsets[position]:self._offsets[position + 1]]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+
+class MappedKeyIndex:
+    """Read-only ``key -> entity id`` mapping over sorted keys (slugs, record ids, document references)"""
+
+    def __init__(self, keys, targets):
+        self._keys = keys
+        self._targets = targets
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, key, default=None):
+        position = bisect_left(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            return self._targets[position]
+        return default
+
+    def items(self):
+        return ((self._keys[i], self._targets[i]) for i in range(len(self._keys)))
+
+
+class MappedEntities(Sequence):
+    """Entities materialized from the record table on access"""
+
+    def __init__(self, strings, records, alias_ids, detail_offsets, detail_data):
+        self._strings = strings
+        self._records = records
+        self._alias_ids = alias_ids
+        self._detail_offsets = detail_offsets
+        self._detail_data = detail_data
+
+    def __len__(self):
+        return len(self._records) // RECORD_WIDTH
+
+    def column(self, column):
+        """Sequence of one string column, e.g. the search haystacks"""
+        offset = _COLUMN[column]
+        return KeyView(self._strings, self._records[offset::RECORD_WIDTH])
+
+    def __getitem__(self, entity_id):
+        if isinstance(entity_id, slice):
+            return [self[i] for i in range(*entity_id.indices(len(self)))]
+        if entity_id < 0:
+            entity_id += len(self)
+        if not 0 <= entity_id < len(self):
+            raise IndexError(entity_id)
+        strings = self._strings
+        start = entity_id * RECORD_WIDTH
+        record = self._records[start:start + RECORD_WIDTH]
+        alias_start = record[_COLUMN['alias_start']]
+        alias_ids = self._alias_ids[alias_start:alias_start + record[_COLUMN['alias_count']]]
+        detail = self._detail_data[self._detail_offsets[entity_id]:self._detail_offsets[entity_id + 1]]
+        flags = record[_COLUMN['flags']]
+        return Entity(
+            strings[record[_COLUMN['name']]],
+            strings[record[_COLUMN['reference']]],
+            strings[record[_COLUMN['fullname']]],
+            strings[record[_COLUMN['slug']]],
+            json.loads(strings[record[_COLUMN['datasets']]]),
+            strings[record[_COLUMN['risk_level']]],
+            [strings[alias_id] for alias_id in alias_ids],
+            _decode_flag(flags, 0),
+            _decode_flag(flags, 1),
+            _decode_flag(flags, 2),
+            countries=json.loads(strings[record[_COLUMN['countries']]]),
+            detail=detail if len(detail) else None,
+            oid=strings[record[_COLUMN['oid']]] or None,
+            version=json.loads(strings[record[_COLUMN['version']]]),
+            links=json.loads(strings[record[_COLUMN['links']]] or '[]'),
+        )
+
+
+def read_header(buffer):
+    """Parse and validate the header at the start of a snapshot buffer.
+
+    Section offsets in the returned header are made absolute.
+    """
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise SnapshotFormatError("Not an entity snapshot")
+    start = len(MAGIC) + _HEADER_LENGTH.size
+    (length,) = _HEADER_LENGTH.unpack(buffer[len(MAGIC):start])
+    header = json.loads(bytes(buffer[start:start + length]))
+    if header.get('format') != FORMAT_VERSION:
+        raise SnapshotFormatError(f"Unsupported snapshot format {header.get('format')}")
+    if header.get('byteorder') != sys.byteorder:
+        raise SnapshotFormatError("Snapshot was compiled on a machine with a different byte order")
+    if tuple(header.get('record_columns', ())) != RECORD_COLUMNS:
+        raise SnapshotFormatError("Snapshot record layout does not match this version")
+    data_start = _data_start(length)
+    header['sections'] = {name: [data_start + offset, section_length]
+                          for name, (offset, section_length) in header['sections'].items()}
+    return header
+
+
+def read_file_header(path):
+    """Read and validate the header of the snapshot file at ``path``, without mapping it"""
+    with open(path, 'rb') as f:
+        start = f.read(len(MAGIC) + _HEADER_LENGTH.size)
+        if start[:len(MAGIC)] != MAGIC or len(start) < len(MAGIC) + _HEADER_LENGTH.size:
+            raise SnapshotFormatError("Not an entity snapshot")
+        (length,) = _HEADER_LENGTH.unpack(start[len(MAGIC):])
+        return read_header(start + f.read(length))
+
+
+def load_snapshot(path, snapshot_class):
+    """Memory-map a compiled snapshot file into a ``snapshot_class`` instance"""
+    with open(path, 'rb') as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            raise SnapshotFormatError(f"Empty snapshot file: {e}")
+    buffer = memoryview(mapping)
+    header = read_header(buffer)
+    layout = header['sections']
+    if any(offset + length > len(buffer) for offset, length in layout.values()):
+        raise SnapshotFormatError("Snapshot file is truncated")
+
+    def section(name, typecode=None):
+        offset, length = layout[name]
+        view = buffer[offset:offset + length]
+        return view.cast(typecode) if typecode else view
+
+    strings = StringTable(section('string_offsets', 'Q'), section('string_data'))
+    entities = MappedEntities(strings, section('records', 'I'), section('alias_ids', 'I'),
+                              section('detail_offsets', 'Q'), section('detail_data'))
+    slugs = MappedKeyIndex(KeyView(strings, section('slug_keys', 'I')), section('slug_targets', 'I'))
+    slug_collisions = MappedPostings(KeyView(strings, section('slug_collision_keys', 'I')),
+                                     section('slug_collision_offsets', 'Q'),
+                                     section('slug_collision_ids', 'I'))
+    oids = MappedKeyIndex(KeyView(strings, section('oid_keys', 'I')), section('oid_targets', 'I'))
+    # Deleted record ids are only kept to reject stale upserts; there are few
+    deletions = {oid: Deletion(oid, json.loads(version)) for oid, version in zip(
+        KeyView(strings, section('deletion_keys', 'I')), KeyView(strings, section('deletion_versions', 'I')))}
+    documents = MappedKeyIndex(KeyView(strings, section('document_keys', 'I')),
+                               section('document_targets', 'I'))
+    shared_documents = MappedPostings(KeyView(strings, section('shared_document_keys', 'I')),
+                                      section('shared_document_offsets', 'Q'),
+                                      section('shared_document_ids', 'I'))
+    search_index = SearchIndex.from_parts(
+        haystacks=entities.column('haystack'),
+        postings=MappedPostings(KeyView(strings, section('gram_keys', 'I')),
+                                section('gram_offsets', 'Q'), section('gram_postings', 'I')),
+        token_postings=MappedPostings(KeyView(strings, section('token_keys', 'I')),
+                                      section('token_offsets', 'Q'), section('token_postings', 'I')),
+        tokens=KeyView(strings, section('token_keys', 'I')),
+    )
+    # Facet bitsets are small (one bit per entity per value); copy them into ints
+    facets = FacetIndex.from_bitsets(header['count'], {
+        dimension: {value: int.from_bytes(section(name), 'little') for value, name in values}
+        for dimension, values in header['facets'].items()
+    })
+    return snapshot_class(entities, version=header['version'], mtime=header.get('source_mtime'),
+                          indexes={'slugs': slugs, 'slug_collisions': slug_collisions,
+                                   'search_index': search_index, 'facets': facets,
+                                   'documents': documents, 'shared_documents': shared_documents, 'oids': oids, 'deletions': deletions,
+                                   'dead': frozenset()})
@@ -53,7 +53,7 @@ document.addEventListener('DOMContentLoaded', function() {
         actions.className = 'entity-actions';
         
         const viewButton = document.createElement('a');
-        viewButton.href = `/entity/${entity.slug || slugify(entity.name)}`;
+        viewButton.href = `${LOCALE_PREFIX}/entity/${entity.slug || slugify(entity.name)}`;
         viewButton.className = 'view-details-btn';
         viewButton.innerHTML = 'View Details <i class="fas fa-arrow-right"></i>';
         actions.appendChild(viewButton);
@@ -111,7 +111,7 @@ document.addEventListener('DOMContentLoaded', function() {
         showLoading();
 
         try {
-            const response = await fetch(`/api/entities?q=${encodeURIComponent(query)}&dataset=${encodeURIComponent(dataset)}`);
+            const response = await fetch(`/api/entities?q=${encodeURIComponent(query)}&dataset=${encodeURIComponent(dataset)}&fields=name,reference,slug,datasets,risk_level`);
             if (!response.ok) throw new Error('Network response was not ok');
             
             const data = await response.json();
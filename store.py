@@ -0,0 +1,588 @@
+"""Process-wide entity store.
+
+The store parses ``entities.csv`` (or memory-maps its compiled snapshot) once
+per worker and hands out immutable snapshots.  When the file changes on disk (new mtime/size *and* a different
+content hash) a fresh snapshot is built and swapped in atomically; requests
+that already hold the previous snapshot keep using it until they finish.
+
+Changes can also arrive incrementally, either as records appended to
+``entities.csv`` or as delta files (same format) dropped into a delta
+directory.  Those are applied on top of the current snapshot by
+``EntitySnapshot.apply_changes``, which only indexes the changed entities.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from functools import cached_property
+from pathlib import Path
+
+from details import FeedSource, detail_cache
+from delta import Deletion, OverlayMapping, PatchedSequence, resolve_changes, supersedes
+from documents import build_document_index, update_document_index
+from facets import FacetIndex, ids_to_bits
+from graph import DEFAULT_MAX_HOPS, RelationshipGraph
+from instrumentation import metrics
+from payloads import EncodedEntities
+from screening import ScreeningIndex
+from search import SearchIndex
+from slugs import base_slug, build_slug_index, update_slug_index
+from snapshot_file import SnapshotFormatError, load_snapshot, read_file_header
+
+# Tombstoned share of the ids above which a patched snapshot is rebuilt
+COMPACT_RATIO = 0.2
+DELTA_SUFFIXES = ('.csv', '.jsonl')
+
+logger = logging.getLogger(__name__)
+
+
+class EntitySnapshot:
+    """Read-only view of the entities parsed from one version of the feed.
+
+    Snapshots are shared between concurrent requests, so neither the snapshot
+    nor the entity dicts it holds may be mutated by callers.
+
+    Entity ids are positions in ``entities``.  Snapshots made by
+    ``apply_changes`` keep the replaced and deleted entities in place as
+    tombstones (their ids are in ``dead``); ``len()``, iteration and every
+    lookup and index query skip them.
+    """
+
+    # Hops risk is propagated along the relationship graph; EntityStore sets
+    # its own on the snapshots it loads, and changed snapshots inherit it
+    graph_max_hops = DEFAULT_MAX_HOPS
+
+    def __init__(self, entities, version=None, mtime=None, indexes=None):
+        self.dead = frozenset()
+        # Latest Deletion per feed record id, so older upserts stay deleted
+        self.deletions = {}
+        if indexes is None:
+            # ``entities`` may be a stream still being parsed: the search
+            # index is built while it is consumed
+            collected = []
+            replay = []
+            self.search_index = SearchIndex(_collect(entities, collected, replay))
+            if replay:
+                # Deletions or repeated ids: settle them, then index the result
+                collected = resolve_changes(collected, self.deletions)
+                self.search_index = SearchIndex(collected)
+            self.entities = tuple(collected)
+            self.slug_collisions = {}
+            self.slugs = build_slug_index(self.entities, self.slug_collisions)
+            self.facets = FacetIndex(self.entities)
+            self.shared_documents = {}
+            self.documents = build_document_index(self.entities, self.shared_documents)
+        else:
+            # Prebuilt (e.g. memory-mapped or patched) entities and indexes
+            self.entities = entities
+            for name, index in indexes.items():
+                setattr(self, name, index)
+        self.version = version
+        self.mtime = mtime
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.entities) - len(self.dead)
+
+    def __iter__(self):
+        if not self.dead:
+            return iter(self.entities)
+        dead = self.dead
+        return (entity for entity_id, entity in enumerate(self.entities) if entity_id not in dead)
+
+    @cached_property
+    def oids(self):
+        """Feed record id -> entity id of the live entities, built on first use"""
+        dead = self.dead
+        return {entity.oid: entity_id for entity_id, entity in enumerate(self.entities)
+                if entity.oid and entity_id not in dead}
+
+    def get_by_slug(self, slug):
+        """Return the entity for ``slug`` (case-insensitive) or None"""
+        entity_id = self.slugs.get(slug)
+        if entity_id is None:
+            entity_id = self.slugs.get(slug.lower())
+        if entity_id is None or entity_id in self.dead:
+            return None
+        return self.entities[entity_id]
+
+    def get_document(self, reference):
+        """Return ``(document, upstream_url)`` for a document reference, or None"""
+        entity_id = self.documents.get(reference)
+        if entity_id is None:
+            return None
+        return self.entities[entity_id].document_source(reference)
+
+    def search_ids(self, query, prefix=False):
+        """Return the ids (positions) of the entities matching ``query``, ascending"""
+        if prefix:
+            ids = self.search_index.prefix(query)
+        else:
+            ids = self.search_index.search(query)
+        if self.dead:
+            dead = self.dead
+            ids = [entity_id for entity_id in ids if entity_id not in dead]
+        return ids
+
+    def search(self, query, prefix=False):
+        """Return the entities matching ``query``, in feed order"""
+        entities = self.entities
+        return [entities[i] for i in self.search_ids(query, prefix=prefix)]
+
+    @cached_property
+    def encoded(self):
+        """Encoded JSON list records of recently served entities"""
+        return EncodedEntities(self.entities)
+
+    @cached_property
+    def screening_index(self):
+        """Blocking index for fuzzy name screening, built on first use"""
+        return ScreeningIndex(self.entities)
+
+    @cached_property
+    def graph(self):
+        """Relationship graph of the live entities and their links, built on first use"""
+        return RelationshipGraph(self.entities, self.dead, max_hops=self.graph_max_hops)
+
+    def screen(self, name, threshold, limit):
+        """Return ``(score, entity, matched_name)`` tuples for ``name``, best first"""
+        entities = self.entities
+        return [(score, entities[entity_id], matched_name)
+                for score, entity_id, matched_name
+                in self.screening_index.screen(name, threshold=threshold, limit=limit,
+                                               exclude=self.dead)]
+
+    def apply_changes(self, records, version=None, mtime=None):
+        """Return a new snapshot with the upserts and Deletions in ``records`` applied.
+
+        Records are matched to entities by ``oid`` and only applied when
+        their version is at least the current one.  New versions are
+        appended under fresh ids and the ids they replace become tombstones,
+        so only the changed entities are indexed; everything else is shared
+        with this snapshot, which stays valid.  Returns this snapshot when
+        no record applies.
+        """
+        entities = self.entities
+        oids = self.oids
+        deletions = self.deletions
+        pending = {}
+        for position, record in enumerate(records):
+            key = record.oid if record.oid else ('', position)
+            if key in pending:
+                current = pending[key]
+            else:
+                entity_id = oids.get(record.oid) if record.oid else None
+                current = None if entity_id is None else entities[entity_id]
+                if current is None and record.oid:
+                    current = deletions.get(record.oid)
+            if current is not None and not supersedes(record, current):
+                continue
+            pending.pop(key, None)
+            pending[key] = record
+
+        start = len(entities)
+        removed = []
+        added = []
+        oid_changes = {}
+        deletion_changes = {}
+        for record in pending.values():
+            entity_id = oids.get(record.oid) if record.oid else None
+            if entity_id is not None:
+                removed.append(entity_id)
+                oid_changes[record.oid] = None
+            if isinstance(record, Deletion):
+                if record.oid:
+                    deletion_changes[record.oid] = record
+            else:
+                if record.oid:
+                    oid_changes[record.oid] = start + len(added)
+                    if record.oid in deletions:
+                        deletion_changes[record.oid] = None
+                added.append(record)
+        if not removed and not added and not deletion_changes:
+            return self
+
+        added_ids = range(start, start + len(added))
+        dead = self.dead | frozenset(removed)
+        size = start + len(added)
+        live = (self.facets.all & ~ids_to_bits(removed, size)) | ids_to_bits(added_ids, size)
+        appended = PatchedSequence(entities, added)
+
+        document_changes, shared_changes = update_document_index(
+            self.documents, self.shared_documents, appended, dead, removed, added_ids)
+        slug_update = update_slug_index(self.slugs, self.slug_collisions,
+                                        appended, self.dead, removed, added_ids)
+        if slug_update is None:
+            # A new natural slug is held as another group's suffixed slug;
+            # re-slug every live entity (copies, this snapshot keeps its own)
+            entities = [entity if entity_id in dead else _unslugged(entity)
+                        for entity_id, entity in enumerate(appended)]
+            slug_collisions = {}
+            live_ids = [entity_id for entity_id in range(size) if entity_id not in dead]
+            slugs = {slug: live_ids[position] for slug, position
+                     in build_slug_index([entities[i] for i in live_ids], slug_collisions).items()}
+            slug_collisions = {base: tuple(live_ids[position] for position in positions)
+                               for base, positions in slug_collisions.items()}
+            entities = tuple(entities)
+        else:
+            slug_changes, collision_changes, copies = slug_update
+            slugs = OverlayMapping(self.slugs, slug_changes)
+            slug_collisions = OverlayMapping(self.slug_collisions, collision_changes)
+            entities = PatchedSequence(entities, added, copies)
+
+        snapshot = EntitySnapshot(entities, version=version, mtime=mtime, indexes={
+            'dead': dead,
+            'slugs': slugs,
+            'slug_collisions': slug_collisions,
+            'search_index': self.search_index.extended(added, start),
+            'facets': self.facets.extended(added, start, live),
+            'documents': OverlayMapping(self.documents, document_changes),
+            'shared_documents': OverlayMapping(self.shared_documents, shared_changes),
+            'oids': OverlayMapping(oids, oid_changes),
+            'deletions': OverlayMapping(deletions, deletion_changes),
+        })
+        if 'screening_index' in self.__dict__:
+            # Only carry the screening index forward if it was already built
+            snapshot.screening_index = self.screening_index.extended(added, start)
+        if 'encoded' in self.__dict__:
+            # Unchanged entities keep their encoded records
+            snapshot.encoded = self.encoded.carried(entities, dead)
+        snapshot.graph_max_hops = self.graph_max_hops
+        if 'graph' in self.__dict__:
+            # Changes that leave every link and risk dataset alone keep the graph
+            graph = self.graph.carried(entities, frozenset(removed), added_ids)
+            if graph is not None:
+                snapshot.graph = graph
+        return snapshot
+
+    def needs_compaction(self):
+        """Whether enough ids are tombstones that a full re-index pays off"""
+        return len(self.dead) > COMPACT_RATIO * len(self.entities)
+
+    def compacted(self):
+        """Return an equivalent snapshot without tombstones, every index rebuilt"""
+        snapshot = EntitySnapshot([_unslugged(entity) for entity in self], version=self.version, mtime=self.mtime)
+        snapshot.deletions = dict(self.deletions.items())
+        snapshot.graph_max_hops = self.graph_max_hops
+        return snapshot
+
+
+def _unslugged(entity):
+    """Copy ``entity`` with the slug its name gives it, ready to be re-slugged"""
+    entity = entity.copy()
+    entity.slug = base_slug(entity)
+    return entity
+
+
+def _collect(records, collected, replay):
+    """Collect ``records``, yielding entities until a Deletion or repeated id shows up"""
+    seen = set()
+    for record in records:
+        collected.append(record)
+        if replay:
+            continue
+        if isinstance(record, Deletion) or record.oid in seen:
+            replay.append(record)
+            continue
+        if record.oid:
+            seen.add(record.oid)
+        yield record
+
+
+EMPTY_SNAPSHOT = EntitySnapshot([])
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def read_csv_snapshot(path, parse):
+    """Read, hash and parse the feed at ``path`` into a new EntitySnapshot"""
+    data = Path(path).read_bytes()
+    mtime = os.stat(path).st_mtime
+    version = hashlib.sha1(data).hexdigest()
+    return EntitySnapshot(parse(data), version=version, mtime=mtime)
+
+
+class EntityStore:
+    """Lazily loads and hot-reloads the entity feed at ``path``.
+
+    ``parse(data, first_line=1, source=None, offset=0)`` receives raw feed
+    bytes and returns an iterable of entities and Deletions, which may be a
+    generator still parsing.  For the feed itself it is also given the
+    details.FeedSource the bytes were read from (and their offset in it), so
+    entities can read their detail fields back later; those sources are
+    closed, and their cached details dropped, once a full reload has replaced
+    the snapshot reading from them.  The file is only stat'ed every
+    ``check_interval`` seconds and only re-read when its mtime or size changed; it is only re-parsed when
+    the content hash differs from the current snapshot.  When the file only
+    grew and its old content is unchanged, just the appended records are
+    parsed and applied as changes.
+
+    When ``compiled_path`` points at a compiled snapshot (see snapshot_file)
+    built from the feed as it is now, it is memory-mapped instead and the
+    feed is not parsed at all; a stale, missing or unreadable compiled
+    snapshot falls back to the feed.  The feed size and mtime recorded in the
+    snapshot header decide this; when only the mtime differs (a copy that did
+    not preserve it) the feed is hashed once and compared with the snapshot's
+    version.
+
+    Files in ``delta_dir`` (``*.csv``/``*.jsonl``, applied in name order)
+    are layered on top of the feed as changes.  Write them under another
+    name and rename them into place so a half-written file is never read;
+    removing or rewriting an applied delta re-applies all of them to the
+    feed.
+
+    ``prepare(snapshot)``, when given, is called with every new snapshot
+    before it is served, by the thread that built it, to build indexes (e.g.
+    the relationship graph) ahead of the requests that need them.  Risk is
+    propagated ``graph_max_hops`` along the relationship graph of the
+    snapshots served.
+    """
+
+    def __init__(self, path, parse, check_interval=1.0, compiled_path=None, delta_dir=None, prepare=None,
+                 graph_max_hops=DEFAULT_MAX_HOPS):
+        self.path = Path(path)
+        self.compiled_path = Path(compiled_path) if compiled_path else None
+        self.delta_dir = Path(delta_dir) if delta_dir else None
+        self.check_interval = check_interval
+        self._parse = parse
+        self._prepare = prepare
+        self.graph_max_hops = graph_max_hops
+        self._snapshot = None
+        self._stat_key = None
+        # (compiled and feed stat, whether the compiled snapshot matches the feed)
+        self._compiled_check = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # Snapshot of the feed alone, the bytes it was built from, and the
+        # delta files applied on top of it to give self._snapshot
+        self._base = None
+        self._base_size = None
+        self._delta_keys = None
+        # Feed files the base snapshot reads details from (the latest last),
+        # and those a new base replaced, closed once it is served
+        self._feed_sources = []
+        self._retired_sources = []
+
+    def _source(self):
+        """Return ``(kind, stat)`` of the file to serve from, or None"""
+        csv_stat = _stat(self.path)
+        compiled_stat = _stat(self.compiled_path) if self.compiled_path else None
+        if compiled_stat and (csv_stat is None or self._compiled_matches(compiled_stat, csv_stat)):
+            return 'compiled', compiled_stat
+        if csv_stat:
+            return 'csv', csv_stat
+        return None
+
+    def _compiled_matches(self, compiled_stat, csv_stat):
+        """Whether the compiled snapshot was built from the feed as it is now"""
+        key = (compiled_stat.st_mtime_ns, compiled_stat.st_size, csv_stat.st_mtime_ns, csv_stat.st_size)
+        if self._compiled_check is not None and self._compiled_check[0] == key:
+            return self._compiled_check[1]
+        try:
+            header = read_file_header(self.compiled_path)
+        except (OSError, ValueError, SnapshotFormatError) as e:
+            logger.error("Error reading compiled snapshot %s: %s", self.compiled_path, e)
+            matches = False
+        else:
+            matches = header.get('source_size') == csv_stat.st_size
+            if matches and header.get('source_mtime_ns') != csv_stat.st_mtime_ns:
+                try:
+                    matches = hashlib.sha1(self.path.read_bytes()).hexdigest() == header['version']
+                except OSError:
+                    matches = False
+            if not matches:
+                logger.info("Compiled snapshot %s is stale, reading %s", self.compiled_path, self.path)
+        self._compiled_check = (key, matches)
+        return matches
+
+    def _delta_files(self):
+        """Return ``(name, mtime_ns, size)`` of every delta file, in name order"""
+        if self.delta_dir is None:
+            return ()
+        try:
+            entries = [entry for entry in os.scandir(self.delta_dir)
+                       if entry.name.endswith(DELTA_SUFFIXES) and entry.is_file()]
+        except OSError:
+            return ()
+        return tuple(sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                            for entry in entries))
+
+    def snapshot(self):
+        """Return the current snapshot, reloading it first if the file changed"""
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            return snapshot
+        self._checked_at = now
+
+        source = self._source()
+        if source is None:
+            return snapshot or EMPTY_SNAPSHOT
+
+        kind, stat = source
+        stat_key = (kind, stat.st_mtime_ns, stat.st_size)
+        delta_keys = self._delta_files()
+        if snapshot is not None and stat_key == self._stat_key and delta_keys == self._delta_keys:
+            return snapshot
+
+        # Only one thread rebuilds; the others keep serving the old snapshot
+        # instead of queueing up behind the reload.
+        if not self._lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            previous = self._snapshot
+            started = time.perf_counter()
+            with metrics.timer('reload'):
+                if self._stat_key != stat_key or self._base is None:
+                    if kind == 'compiled':
+                        self._load_compiled(stat_key)
+                    else:
+                        self._reload(stat_key, stat.st_mtime)
+                if self._base is None:
+                    return self._snapshot or EMPTY_SNAPSHOT
+                snapshot = self._apply_deltas(delta_keys)
+            self._close_retired_sources()
+            if snapshot is not previous:
+                logger.info("Loaded %d entities (%s) in %.2fs", len(snapshot), snapshot.version,
+                            time.perf_counter() - started,
+                            extra={'entities': len(snapshot), 'snapshot_version': snapshot.version})
+            return snapshot
+        finally:
+            self._lock.release()
+
+    def _replace_sources(self, sources):
+        """Read details from ``sources`` from now on; the previous ones are closed after the swap"""
+        self._retired_sources += [source for source in self._feed_sources if source not in sources]
+        self._feed_sources = sources
+
+    def _close_retired_sources(self):
+        for source in self._retired_sources:
+            source.close()
+            detail_cache.discard_source(source)
+        self._retired_sources = []
+
+    def _set_base(self, base, size=None):
+        if base is not self._base:
+            base.graph_max_hops = self.graph_max_hops
+            self._base = base
+            # Every delta has to be re-applied to the new base
+            self._delta_keys = None
+        self._base_size = size
+
+    def _load_compiled(self, stat_key):
+        try:
+            snapshot = load_snapshot(self.compiled_path, EntitySnapshot)
+        except (OSError, ValueError, KeyError, SnapshotFormatError) as e:
+            logger.error("Error loading compiled snapshot %s: %s", self.compiled_path, e)
+            csv_stat = _stat(self.path)
+            if csv_stat is None:
+                return
+            # Remember the broken file so it is not retried on every check
+            self._stat_key = stat_key
+            self._reload(stat_key, csv_stat.st_mtime)
+            return
+        self._set_base(snapshot)
+        self._replace_sources([])
+        self._stat_key = stat_key
+
+    def _reload(self, stat_key, mtime):
+        current = self._base
+        try:
+            source = FeedSource(self.path)
+            data = source.read_all()
+        except OSError as e:
+            logger.error("Error reading %s: %s", self.path, e)
+            return
+
+        version = hashlib.sha1(data).hexdigest()
+        if current is not None and current.version == version:
+            # Touched but unchanged: remember the new stat so we stop re-hashing
+            source.close()
+            self._stat_key = stat_key
+            return
+
+        size = self._base_size
+        if (current is not None and size and len(data) > size and data[size - 1:size] == b'\n'
+                and hashlib.sha1(data[:size]).hexdigest() == current.version):
+            # Records were appended: apply just those as changes
+            sources = self._feed_sources
+            if sources and sources[-1].same_file(source):
+                source.close()
+                source = sources[-1]
+            try:
+                first_line = data.count(b'\n', 0, size) + 1
+                snapshot = current.apply_changes(self._parse(data[size:], first_line, source=source, offset=size),
+                                                 version=version, mtime=mtime)
+                if snapshot.needs_compaction():
+                    snapshot = snapshot.compacted()
+            except Exception as e:
+                logger.warning("Error applying appended records, reloading: %s", e)
+            else:
+                logger.info("Applied %d appended bytes of %s", len(data) - size, self.path)
+                self._set_base(snapshot, len(data))
+                # The records parsed before still read from the sources they came from
+                if source not in sources:
+                    self._replace_sources(sources + [source])
+                self._stat_key = stat_key
+                return
+
+        try:
+            snapshot = EntitySnapshot(self._parse(data, source=source), version=version, mtime=mtime)
+        except Exception:
+            logger.exception("Error loading %s", self.path)
+            if source not in self._feed_sources:
+                source.close()
+            return
+
+        self._set_base(snapshot, len(data))
+        self._replace_sources([source])
+        self._stat_key = stat_key
+
+    def _apply_deltas(self, delta_keys):
+        """Return the base snapshot with every file in ``delta_keys`` applied"""
+        applied = self._delta_keys
+        if applied is not None and delta_keys[:len(applied)] == applied:
+            snapshot = self._snapshot
+            pending = delta_keys[len(applied):]
+        else:
+            snapshot = self._base
+            applied = ()
+            pending = delta_keys
+
+        for key in pending:
+            path = self.delta_dir / key[0]
+            try:
+                data = path.read_bytes()
+                delta_version = hashlib.sha1(f"{snapshot.version}:".encode('utf-8') + data).hexdigest()
+                snapshot = snapshot.apply_changes(self._parse(data), version=delta_version,
+                                                  mtime=snapshot.mtime)
+            except Exception as e:
+                # Retried at the next check, after the deltas applied so far
+                logger.error("Error applying delta %s: %s", path, e)
+                break
+            applied += (key,)
+            logger.info("Applied delta %s (%d tombstoned ids)", path, len(snapshot.dead))
+
+        if snapshot.needs_compaction():
+            snapshot = snapshot.compacted()
+        if snapshot is not self._snapshot and self._prepare is not None:
+            try:
+                with metrics.timer('prepare'):
+                    self._prepare(snapshot)
+            except Exception:
+                # Served anyway: whatever is missing is built on first use
+                logger.exception("Error preparing snapshot %s", snapshot.version)
+        self._snapshot = snapshot
+        self._delta_keys = applied
+        return snapshot
+
+    def invalidate(self):
+        """Force the next ``snapshot()`` call to re-check the files"""
+        self._checked_at = 0.0
+        self._stat_key = None
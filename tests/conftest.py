@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as entity_app  # noqa: E402
+
+CODES = {'sanctions': 'SAN', 'pep': 'POI', 'insolvency': 'INS', 'adverse_media': 'RRE',
+         'disqualified': 'REL'}
+
+
+def record(oid, name, version=1, datasets=(), deleted=False, documents=(), links=(), aliases=(),
+           addresses=()):
+    """A raw feed record as it appears in entities.csv"""
+    return {
+        '_id': {'$oid': oid},
+        'name': name,
+        'fullname': name,
+        'reference': f'ref-{oid}',
+        'aliases': [{'name': alias} for alias in aliases],
+        'documents': [{'reference': reference, 'url': f'https://example.org/{reference}.pdf'}
+                      for reference in documents],
+        'persons': [{'name': f'Person {reference}', 'relation': 'Director', 'reference': reference}
+                    for reference in links],
+        'raw': {'version': version, 'datasets': [CODES[dataset] for dataset in datasets],
+                'isDeleted': deleted, 'addresses': list(addresses)},
+    }
+
+
+def feed(records):
+    """Encode raw records as entities.csv lines"""
+    return ''.join('"' + json.dumps(data) + '"\n' for data in records).encode('utf-8')
+
+
+@pytest.fixture
+def app():
+    return entity_app
+
+
+@pytest.fixture
+def parse():
+    def parse_records(records):
+        return list(entity_app.parse_feed(feed(records)))
+    return parse_records
+
+
+def _live_index(snapshot, index):
+    return {key: snapshot.entities[entity_id].oid for key, entity_id in index.items()
+            if entity_id not in snapshot.dead}
+
+
+def snapshot_state(snapshot):
+    """Everything a reader can observe of a snapshot, by record id"""
+    live = list(snapshot)
+    return {
+        'entities': [(entity.oid, entity.name, entity.slug, entity.version, entity.datasets)
+                     for entity in live],
+        # As served: empty details are shared tuples, loaded ones lists
+        'records': {entity.oid: json.loads(json.dumps(entity.to_dict())) for entity in live},
+        'slugs': _live_index(snapshot, snapshot.slugs),
+        'documents': _live_index(snapshot, snapshot.documents),
+        'oids': _live_index(snapshot, snapshot.oids),
+        'search': {query: [entity.oid for entity in snapshot.search(query)]
+                   for query in ('acme', 'holdings', 'renamed', 'ltd')},
+        'facets': snapshot.facets.counts(snapshot.facets.all, {}),
+    }
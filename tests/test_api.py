@@ -0,0 +1,76 @@
+import pytest
+
+from conftest import record
+from store import EntitySnapshot
+
+
+@pytest.fixture
+def snapshots(app, parse, monkeypatch):
+    records = [record(f'{number:02d}', f'Company {number}', datasets=['pep'] if number % 3 else [])
+               for number in range(20)]
+    current = [EntitySnapshot(parse(records), version='api-test').apply_changes(
+        parse([record('04', 'Company 4', version=2, deleted=True)]), version='api-test-2')]
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: current[0])
+    return current
+
+
+@pytest.fixture
+def client(app, snapshots):
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize('entity_id, reference', [(0, 'ref-00'), (63, 'a:b'), (2 ** 40, ''), (1, 'Zürich')])
+def test_cursor_round_trip(app, entity_id, reference):
+    cursor = app.encode_cursor(entity_id, reference)
+    assert '=' not in cursor
+    assert app.decode_cursor(cursor) == (entity_id, reference)
+
+
+@pytest.mark.parametrize('cursor', ['!!', 'abc', '', 'MTI', 'eDpyZWY'])
+def test_malformed_cursor(app, cursor):
+    with pytest.raises(ValueError):
+        app.decode_cursor(cursor)
+
+
+def fetch_all(client, query):
+    names = []
+    cursor = None
+    while True:
+        url = f'/api/entities?{query}&facets=false' + (f'&cursor={cursor}' if cursor else '')
+        result = client.get(url).get_json()
+        names += [entity['name'] for entity in result['entities']]
+        cursor = result['next_cursor']
+        if cursor is None:
+            return names, result['total']
+
+
+@pytest.mark.parametrize('limit', [1, 3, 19, 100])
+@pytest.mark.parametrize('query', ['', 'dataset=pep', 'q=company 1'])
+def test_cursor_pages_cover_every_match_once(client, query, limit):
+    everything = client.get(f'/api/entities?{query}&limit=1000').get_json()
+    names, total = fetch_all(client, f'{query}&limit={limit}')
+    assert names == [entity['name'] for entity in everything['entities']]
+    assert len(names) == total == everything['total']
+    assert 'Company 4' not in names
+
+
+def test_invalid_cursor_is_rejected(client):
+    response = client.get('/api/entities?cursor=!!')
+    assert response.status_code == 400
+
+
+def test_cursor_survives_deltas(client, snapshots, parse):
+    first = client.get('/api/entities?limit=5&facets=false').get_json()
+    # Deltas append new ids and leave the paged ones where they were
+    snapshots[0] = snapshots[0].apply_changes(parse([record('20', 'Company 20')]), version='api-test-3')
+    rest = client.get(f"/api/entities?limit=100&facets=false&cursor={first['next_cursor']}").get_json()
+    assert [entity['name'] for entity in first['entities'] + rest['entities']] == [
+        f'Company {number}' for number in range(21) if number != 4]
+
+
+def test_cursor_expires_when_ids_are_renumbered(client, snapshots):
+    first = client.get('/api/entities?limit=5&facets=false').get_json()
+    snapshots[0] = snapshots[0].compacted()
+    response = client.get(f"/api/entities?limit=5&cursor={first['next_cursor']}")
+    assert response.status_code == 400
+    assert 'restart' in response.get_json()['error']
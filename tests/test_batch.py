@@ -0,0 +1,83 @@
+import io
+
+import pytest
+
+from batch import BatchScreener, ScreeningTarget, iter_rows
+from conftest import record
+from countries import get_country_code
+from store import EntitySnapshot
+
+
+@pytest.fixture
+def snapshot(parse):
+    records = [record(f'{number:03d}', f'Vladimir Petrov {number}',
+                      datasets=['sanctions'] if number % 3 == 0 else ['pep'],
+                      addresses=[{'line1': '1 High Street', 'countryIsoCode': 'GB' if number % 2 else 'RU'}])
+               for number in range(40)]
+    return EntitySnapshot(parse(records)).apply_changes(
+        parse([record('001', 'Vladimir Petrov 1', version=2, deleted=True)]), version='v2')
+
+
+def rows(count):
+    countries = ['', 'Russia', 'gb', 'France']
+    for number in range(count):
+        row = {'name': 'Vladimir Petrov', 'country': countries[number % 4]}
+        if number % 5 == 0:
+            row['dataset'] = 'sanctions'
+        yield number + 1, row
+    yield count + 1, {'name': ''}
+    yield count + 2, {'error': 'Invalid JSON'}
+
+
+def screen(screener, snapshot, count):
+    return list(screener.screen(snapshot, rows(count), 0.8, 5))
+
+
+def test_pool_results_match_screening_in_process(snapshot, parse, tmp_path, monkeypatch):
+    monkeypatch.setattr('tempfile.tempdir', str(tmp_path))
+    serial = screen(BatchScreener(1, country_resolver=get_country_code), snapshot, 600)
+    screener = BatchScreener(2, country_resolver=get_country_code)
+    pooled = screen(screener, snapshot, 600)
+    assert [result for result in pooled if 'summary' not in result] == [
+        result for result in serial if 'summary' not in result]
+    assert pooled[-1]['summary']['names'] == 600
+    assert pooled[-1]['summary']['errors'] == 2
+    # The pool is kept for the next batch on the same snapshot, its target file with it
+    [first] = tmp_path.glob('batch-screening-*')
+    assert screener._pool is not None
+
+    screener._release_pool(screener._acquire_pool(
+        snapshot.apply_changes(parse([record('100', 'Vladimir Petrov 100')]), version='v3')), abandoned=False)
+    # Replacing the pool stops the retired one and removes its file
+    [second] = tmp_path.glob('batch-screening-*')
+    assert second != first
+    screener._stop_pool(screener._pool)
+    assert not list(tmp_path.glob('batch-screening-*'))
+
+
+def test_results_filter_on_dataset_and_country(snapshot):
+    results = screen(BatchScreener(1, country_resolver=get_country_code), snapshot, 8)
+    by_line = {result['line']: result for result in results if 'line' in result}
+    assert all('sanctions' in match['datasets'] for match in by_line[1]['matches'])
+    # Russia resolves to RU: only even-numbered entities have a Russian address
+    assert by_line[2]['matches'] and all(int(match['reference'][-3:]) % 2 == 0 for match in by_line[2]['matches'])
+    assert by_line[3]['matches'] and all(int(match['reference'][-3:]) % 2 == 1 for match in by_line[3]['matches'])
+    assert by_line[4]['matches'] == []
+    assert 'ref-001' not in [match['reference'] for result in by_line.values() for match in result.get('matches', ())]
+    assert by_line[9] == {'line': 9, 'error': 'Missing name'}
+
+
+def test_target_screens_like_the_snapshot(snapshot):
+    target = ScreeningTarget(snapshot)
+    for name in ('Vladimir Petrov 3', 'Petrov'):
+        assert [(score, entity['reference'], matched) for score, entity, matched in target.screen(name, 0.7, 10)] == [
+            (score, entity.reference, matched) for score, entity, matched in snapshot.screen(name, 0.7, 10)]
+
+
+def test_iter_rows():
+    jsonl = io.BytesIO(b'{"name": "Acme"}\n\n"Globex"\nnot json\n[1]\n')
+    assert [(line, sorted(row)) for line, row in iter_rows(jsonl, 'jsonl')] == [
+        (1, ['name']), (3, ['name']), (4, ['error']), (5, ['error'])]
+    csv = io.BytesIO(b'Name, Country\nAcme,GB\n"Globex, Inc",FR\n')
+    assert list(iter_rows(csv, 'csv')) == [(2, {'name': 'Acme', 'country': 'GB'}),
+                                           (3, {'name': 'Globex, Inc', 'country': 'FR'})]
@@ -0,0 +1,62 @@
+import pytest
+
+from countries import CODE_TABLE, COUNTRY_TABLE, CountryResolver, normalize
+from details import address_countries
+
+
+@pytest.mark.parametrize('name, code', [
+    ('United Kingdom', 'GB'),
+    ('  united   KINGDOM ', 'GB'),
+    ("Côte d'Ivoire", 'CI'),
+    ("COTE D'IVOIRE", 'CI'),
+    ('Iran, Islamic Republic of', 'IR'),
+    ('Islamic Republic of Iran', 'IR'),
+    ('Bolivia', 'BO'),
+    # COUNTRY_ALTERNATIVES
+    ('Russia', 'RU'),
+    ('south korea', 'KR'),
+    ('UK', 'GB'),
+    ('USA', 'US'),
+    # Codes: alpha-2, alpha-3 and numeric
+    ('GB', 'GB'),
+    ('GBR', 'GB'),
+    ('826', 'GB'),
+    (' MT ', 'MT'),
+])
+def test_table_lookup(name, code):
+    assert CountryResolver().lookup(name) == code
+
+
+@pytest.mark.parametrize('text', ['gb', 'gbr', 'mt', 'uk', 'and', 'can', 'per', 'Can'])
+def test_codes_are_only_taken_in_upper_case(text):
+    # Lower-case codes would let common words in free text resolve to countries
+    resolver = CountryResolver()
+    assert resolver.lookup(text) is None and resolver.resolve(text) is None
+    assert resolver.get_stats()['top_unresolved'] == [(text, 1)]
+
+
+def test_tables_fold_every_name_and_code():
+    assert all(normalize(name) == name for name in COUNTRY_TABLE)
+    assert all(code.isupper() or code.isdigit() for code in CODE_TABLE)
+    # Every name resolves to an alpha-2 code the code table knows
+    assert set(COUNTRY_TABLE.values()) <= set(CODE_TABLE.values())
+
+
+def test_fuzzy_fallback_is_counted_and_memoized():
+    resolver = CountryResolver()
+    assert resolver.resolve('England') == 'GB'
+    before = resolver.get_stats()['fuzzy_cache']
+    assert resolver.resolve('England') == 'GB'
+    assert resolver.resolve('Nowhereland') is None
+    stats = resolver.get_stats()
+    assert stats['fuzzy_cache']['hits'] == before['hits'] + 1
+    assert {key: stats[key] for key in ('lookups', 'table_hits', 'fuzzy_lookups', 'unresolved')} == {
+        'lookups': 3, 'table_hits': 0, 'fuzzy_lookups': 2, 'unresolved': 1}
+    assert stats['top_unresolved'] == [('Nowhereland', 1)]
+
+
+def test_address_countries_keep_lower_case_codes():
+    # The feed's codes resolve through the table; lower-case ones are kept as typed
+    assert address_countries([{'line1': 'x', 'countryIsoCode': 'MT'}, {'line1': 'y', 'countryIsoCode': 'gb'},
+                              {'line1': 'z', 'country': 'United Kingdom'}, {'country': 'Nowhereland'}]) == [
+        'gb', 'mt', 'nowhereland']
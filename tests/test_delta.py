@@ -0,0 +1,185 @@
+import os
+import random
+
+import pytest
+
+from app import parse_feed
+from conftest import feed, record, snapshot_state
+from delta import Deletion, resolve_changes, supersedes
+from details import detail_cache
+from store import EntitySnapshot, EntityStore
+
+
+def base_records():
+    return [
+        record('a', 'Acme Ltd', datasets=['sanctions'], documents=['doc-a']),
+        record('b', 'Acme Ltd', datasets=['pep'], documents=['doc-shared']),
+        record('c', 'Northwind Holdings', documents=['doc-shared']),
+        record('d', 'Contoso', datasets=['insolvency'], aliases=['Contoso Ltd']),
+        record('e', 'Fabrikam Holdings', datasets=['adverse_media']),
+    ]
+
+
+def full(parse, records):
+    return EntitySnapshot(parse(records))
+
+
+def test_supersedes_orders_by_version():
+    current = Deletion('a', 3)
+    assert supersedes(Deletion('a', 3), current)
+    assert supersedes(Deletion('a', 4), current)
+    assert not supersedes(Deletion('a', 2), current)
+    # Records without a version always apply
+    assert supersedes(Deletion('a'), current)
+    assert supersedes(current, Deletion('a'))
+
+
+def test_older_version_is_ignored(parse):
+    snapshot = full(parse, base_records())
+    stale = snapshot.apply_changes(parse([record('a', 'Stale Name', version=0)]))
+    assert stale is snapshot
+    assert snapshot.get_by_slug('stale-name') is None
+
+
+def test_equal_or_newer_version_applies(parse):
+    snapshot = full(parse, base_records())
+    updated = snapshot.apply_changes(parse([record('d', 'Contoso Renamed', version=1)]))
+    assert updated.get_by_slug('contoso-renamed').oid == 'd'
+    assert updated.get_by_slug('contoso') is None
+    assert len(updated) == len(snapshot)
+    # The previous snapshot is unchanged
+    assert snapshot.get_by_slug('contoso').name == 'Contoso'
+
+
+def test_deletion_takes_precedence_over_older_upserts(parse):
+    snapshot = full(parse, base_records())
+    deleted = snapshot.apply_changes(parse([record('e', 'Fabrikam Holdings', version=3, deleted=True)]))
+    assert len(deleted) == len(snapshot) - 1
+    assert deleted.get_by_slug('fabrikam-holdings') is None
+    assert [entity.oid for entity in deleted.search('fabrikam')] == []
+
+    # A later delta replaying an older upsert does not bring it back
+    replayed = deleted.apply_changes(parse([record('e', 'Fabrikam Holdings', version=2)]))
+    assert replayed is deleted
+    # A newer one does
+    restored = deleted.apply_changes(parse([record('e', 'Fabrikam Holdings', version=4)]))
+    assert restored.get_by_slug('fabrikam-holdings').version == 4
+    assert 'e' not in dict(restored.deletions.items())
+
+
+def test_changes_within_one_delta_apply_in_order(parse):
+    snapshot = full(parse, base_records())
+    changed = snapshot.apply_changes(parse([
+        record('a', 'Acme Ltd', version=2),
+        record('a', 'Acme Ltd', version=2, deleted=True),
+        record('b', 'Acme Ltd', version=5, deleted=True),
+        record('b', 'Acme Ltd Renamed', version=4),
+    ]))
+    assert {entity.oid for entity in changed} == {'c', 'd', 'e'}
+    assert resolve_changes(parse([
+        record('b', 'Acme Ltd', version=5, deleted=True),
+        record('b', 'Acme Ltd Renamed', version=4),
+    ])) == []
+
+
+def test_rename_reassigns_collided_slugs(parse):
+    records = base_records()
+    snapshot = full(parse, records)
+    # a and b share a name: the lower reference keeps the bare slug
+    assert snapshot.get_by_slug('acme-ltd').oid == 'a'
+    assert snapshot.get_by_slug('acme-ltd-ref-b').oid == 'b'
+
+    renamed = snapshot.apply_changes(parse([record('a', 'Acme Renamed', version=2)]))
+    assert renamed.get_by_slug('acme-renamed').oid == 'a'
+    assert renamed.get_by_slug('acme-ltd').oid == 'b'
+    expected = full(parse, records + [record('a', 'Acme Renamed', version=2)])
+    assert snapshot_state(renamed) == snapshot_state(expected)
+    # The old snapshot keeps its own slugs
+    assert snapshot.get_by_slug('acme-ltd').oid == 'a'
+
+
+def test_new_name_taking_a_suffixed_slug(parse):
+    records = base_records()
+    snapshot = full(parse, records)
+    change = [record('f', 'Acme Ltd Ref B')]
+    updated = snapshot.apply_changes(parse(change))
+    assert snapshot_state(updated) == snapshot_state(full(parse, records + change))
+
+
+def random_delta(rng, oids, names, version):
+    delta = []
+    for oid in rng.sample(oids, 3):
+        delta.append(record(oid, rng.choice(names), version=version, datasets=rng.sample(
+            ['sanctions', 'pep', 'insolvency'], rng.randint(0, 2)), documents=[f'doc-{oid}']))
+    for oid in rng.sample(oids, 2):
+        delta.append(record(oid, 'Deleted', version=version + rng.choice([-2, 1]), deleted=True))
+    delta.append(record(rng.choice(oids), 'Stale Renamed', version=version - 5))
+    delta.append(record(f'new{version}', rng.choice(names), version=1))
+    return delta
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_incremental_updates_match_a_full_reload(parse, seed):
+    rng = random.Random(seed)
+    names = ['Acme Ltd', 'Acme Renamed', 'Northwind Holdings', 'Contoso', 'Globex Ltd']
+    records = base_records()
+    snapshot = full(parse, records)
+    oids = [data['_id']['$oid'] for data in records]
+    for version in range(2, 8):
+        delta = random_delta(rng, oids, names, version)
+        oids.append(f'new{version}')
+        records += delta
+        snapshot = snapshot.apply_changes(parse(delta))
+        expected = full(parse, records)
+        assert snapshot_state(snapshot) == snapshot_state(expected)
+    assert snapshot_state(snapshot.compacted()) == snapshot_state(expected)
+
+
+def test_store_applies_delta_files_and_appends(parse, tmp_path):
+    path = tmp_path / 'entities.csv'
+    delta_dir = tmp_path / 'deltas'
+    delta_dir.mkdir()
+    records = base_records()
+    path.write_bytes(feed(records))
+    store = EntityStore(path, parse_feed, check_interval=0, delta_dir=delta_dir)
+    assert len(store.snapshot()) == 5
+
+    delta = [record('c', 'Northwind Renamed', version=2), record('d', 'Contoso', version=2, deleted=True)]
+    (delta_dir / '001.csv').write_bytes(feed(delta))
+    assert snapshot_state(store.snapshot()) == snapshot_state(full(parse, records + delta))
+
+    appended = [record('g', 'Globex Ltd')]
+    with open(path, 'ab') as f:
+        f.write(feed(appended))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    # The appended records are parsed on their own and the deltas re-applied
+    assert snapshot_state(store.snapshot()) == snapshot_state(full(parse, records + appended + delta))
+
+    (delta_dir / '001.csv').unlink()
+    assert snapshot_state(store.snapshot()) == snapshot_state(full(parse, records + appended))
+
+
+def test_full_reload_closes_the_previous_feed(parse, tmp_path):
+    path = tmp_path / 'entities.csv'
+    path.write_bytes(feed(base_records()))
+    store = EntityStore(path, parse_feed, check_interval=0)
+    entity = store.snapshot().get_by_slug('acme-ltd')
+    assert entity.to_dict()['documents'][0]['reference'] == 'doc-a'
+    assert detail_cache.get(entity._detail) is not None
+    old_source = entity._detail.source
+
+    # Appended records keep reading from the same open file
+    with open(path, 'ab') as f:
+        f.write(feed([record('g', 'Globex Ltd', documents=['doc-g'])]))
+    os.utime(path, ns=(0, path.stat().st_mtime_ns + 10 ** 9))
+    assert store.snapshot().get_by_slug('globex-ltd')._detail.source is old_source
+
+    tmp = tmp_path / 'entities.csv.tmp'
+    tmp.write_bytes(feed(base_records()[:3]))
+    os.replace(tmp, path)
+    snapshot = store.snapshot()
+    assert len(snapshot) == 3
+    assert old_source._file.closed
+    assert detail_cache.get(entity._detail) is None
+    assert snapshot.get_by_slug('acme-ltd').to_dict()['documents'][0]['reference'] == 'doc-a'
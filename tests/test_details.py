@@ -0,0 +1,36 @@
+from conftest import record
+from store import EntitySnapshot
+
+# Address shape of the real feed: address lines and an ISO country code, blanks included
+VALLETTA = {'city': 'Valletta', 'line1': '1 Merchants Street', 'line2': '', 'county': '', 'postcode': 'VLT 1171',
+            'addressType': 'Operating', 'countyAbbrev': '', 'countryIsoCode': 'MT'}
+
+
+def addresses(parse):
+    return EntitySnapshot(parse([
+        record('a', 'Acme Ltd', addresses=[VALLETTA]),
+        record('b', 'Globex Ltd', addresses=[{'line1': '', 'city': '', 'countryIsoCode': 'IR'},
+                                             {'line1': 'Via Roma 1', 'line3': 'Milano', 'country': 'Italy'}]),
+        record('c', 'Initech Ltd', addresses=[{'line1': '', 'city': '', 'countryIsoCode': ''}]),
+    ]))
+
+
+def test_feed_addresses_get_text_and_country(parse):
+    snapshot = addresses(parse)
+    acme, globex, initech = (snapshot.get_by_slug(slug) for slug in ('acme-ltd', 'globex-ltd', 'initech-ltd'))
+    assert acme.addresses == [{'text': '1 Merchants Street, Valletta, VLT 1171, MT', 'country': 'mt'}]
+    assert globex.addresses == [{'text': 'IR', 'country': 'ir'},
+                                {'text': 'Via Roma 1, Milano, Italy', 'country': 'it'}]
+    assert not initech.addresses
+    assert [entity.countries for entity in (acme, globex, initech)] == [('mt',), ('ir', 'it'), ()]
+
+
+def test_country_facet_and_filter(app, parse, monkeypatch):
+    snapshot = addresses(parse)
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    client = app.app.test_client()
+    result = client.get('/api/entities').get_json()
+    assert result['facets']['country'] == {'it': 1, 'ir': 1, 'mt': 1}
+    for country in ('mt', 'MT', 'Malta'):
+        matched = client.get(f'/api/entities?country={country}').get_json()
+        assert [entity['reference'] for entity in matched['entities']] == ['ref-a']
@@ -0,0 +1,229 @@
+import hashlib
+import os
+
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from conftest import record
+from documents import (CHUNK_SIZE as CHUNK, CachedDocument, DocumentCache, DocumentProxy, ProxiedDocument,
+                       parse_range)
+from store import EntitySnapshot
+
+
+class FakeUpstream:
+    """Streamed upstream response, as DocumentProxy.open returns it"""
+
+    def __init__(self, status, body=b'', headers=None):
+        self.status_code = status
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.body = body
+        self.raw = self
+        self.closed = False
+
+    def stream(self, size, decode_content=False):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeProxy(DocumentProxy):
+    """Serves ``documents`` (url -> body) with strong ETags, answering If-None-Match.
+
+    Ranges are ignored, like many upstreams do; an int stands for an error
+    status and an exception is raised.
+    """
+
+    def __init__(self, documents):
+        super().__init__()
+        self.documents = documents
+        self.requests = []
+
+    def open(self, url, headers=None):
+        headers = headers or {}
+        self.requests.append((url, headers))
+        body = self.documents[url]
+        if isinstance(body, Exception):
+            raise body
+        if isinstance(body, int):
+            return FakeUpstream(body)
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if headers.get('If-None-Match') == etag:
+            return FakeUpstream(304, headers={'ETag': etag})
+        return FakeUpstream(200, body, {'Content-Type': 'application/pdf', 'Content-Length': str(len(body)),
+                                        'ETag': etag})
+
+
+def body(size, fill):
+    return bytes([fill]) * size
+
+
+def read(document):
+    """The whole body of what DocumentCache.fetch returned"""
+    if isinstance(document, CachedDocument):
+        with document.file:
+            return document.file.read()
+    assert isinstance(document, ProxiedDocument)
+    return b''.join(document.body)
+
+
+def stored(cache):
+    return {path.name: path.stat().st_size for path in cache.objects_dir.glob('*/*')}
+
+
+def age(cache, data, mtime):
+    os.utime(cache._object_path(hashlib.sha256(data).hexdigest()), (mtime, mtime))
+
+
+def test_workers_share_the_size_cap(tmp_path):
+    documents = {f'https://example.org/{number}.pdf': body(100, number) for number in range(4)}
+    proxy = FakeProxy(documents)
+    # Two workers' caches on one directory
+    first, second = (DocumentCache(tmp_path, max_bytes=250) for _ in range(2))
+    for number, cache in enumerate((first, first, second, second)):
+        url = f'https://example.org/{number}.pdf'
+        assert read(cache.fetch(str(number), url, proxy, {})) == documents[url]
+        age(cache, documents[url], 1000 + number)
+        assert sum(stored(cache).values()) <= 250
+    # The least recently used bodies went, whichever worker stored them
+    assert sorted(stored(first)) == sorted(hashlib.sha256(documents[f'https://example.org/{number}.pdf']).hexdigest()
+                                           for number in (2, 3))
+    assert second.get_stats()['bytes'] == 200 and second.get_stats()['evicted'] == 2
+
+
+def test_evicting_a_body_does_not_cut_off_its_responses(tmp_path):
+    url, other = 'https://example.org/a.pdf', 'https://example.org/b.pdf'
+    proxy = FakeProxy({url: body(CHUNK, 1) + body(CHUNK, 2), other: body(2 * CHUNK, 3)})
+    cache, worker = DocumentCache(tmp_path, max_bytes=3 * CHUNK), DocumentCache(tmp_path, max_bytes=3 * CHUNK)
+    read(cache.fetch('a', url, proxy, {}))
+    hit = cache.fetch('a', url, proxy, {})
+    assert isinstance(hit, CachedDocument) and hit.file.read(CHUNK) == body(CHUNK, 1)
+    age(cache, proxy.documents[url], 1000)
+    # Another worker's download evicts the body being sent
+    read(worker.fetch('b', other, proxy, {}))
+    assert not hit.path.exists()
+    assert hit.file.read() == body(CHUNK, 2)
+    hit.file.close()
+    # The next request downloads it again
+    assert read(cache.fetch('a', url, proxy, {})) == proxy.documents[url]
+    assert [requested for requested, _headers in proxy.requests] == [url, other, url]
+
+
+
+@pytest.mark.parametrize('header, byte_range', [
+    ('bytes=0-9', (0, 9)),
+    ('bytes=90-', (90, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes = 5-500', (5, 99)),
+    ('bytes=0-1,5-6', None),
+    ('items=1-2', None),
+    ('bytes=-', None),
+])
+def test_parse_range(header, byte_range):
+    assert parse_range(header, 100) == byte_range
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=-0', 'bytes=9-5'])
+def test_unsatisfiable_range(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+DOCUMENT = bytes(range(256)) * 1024
+
+
+def respond(request_headers, status=200, body=DOCUMENT, **headers):
+    headers = {'Content-Type': 'application/pdf', 'Content-Length': str(len(body)), **headers}
+    upstream = FakeUpstream(status, body, headers)
+    return DocumentProxy().respond('doc', upstream, request_headers), upstream
+
+
+def test_ranges_are_cut_from_upstreams_that_ignore_them():
+    document, upstream = respond({'Range': f'bytes={CHUNK - 10}-{2 * CHUNK + 9}'}, ETag='"v1"')
+    assert document.status == 206
+    assert document.headers['Content-Range'] == f'bytes {CHUNK - 10}-{2 * CHUNK + 9}/{len(DOCUMENT)}'
+    assert document.headers['Content-Length'] == str(CHUNK + 20) and document.headers['Accept-Ranges'] == 'bytes'
+    assert b''.join(document.body) == DOCUMENT[CHUNK - 10:2 * CHUNK + 10]
+    # Streaming stops, and the upstream is released, once the range is sent
+    assert upstream.closed
+
+
+@pytest.mark.parametrize('if_range, status', [('"v1"', 206), ('"v0"', 200), ('Tue, 01 Mar 2022 00:00:00 GMT', 206)])
+def test_if_range_only_slices_the_matching_version(if_range, status):
+    document, _upstream = respond({'Range': 'bytes=0-9', 'If-Range': if_range}, ETag='"v1"',
+                                  **{'Last-Modified': 'Tue, 01 Mar 2022 00:00:00 GMT'})
+    assert document.status == status
+    assert b''.join(document.body) == (DOCUMENT[:10] if status == 206 else DOCUMENT)
+
+
+def test_weak_validators_never_satisfy_if_range():
+    document, _upstream = respond({}, **{'Last-Modified': 'Tue, 01 Mar 2022 00:00:00 GMT'})
+    etag = document.headers['ETag']
+    assert etag == f'W/"doc-{len(DOCUMENT)}-Tue, 01 Mar 2022 00:00:00 GMT"'
+    document, _upstream = respond({'Range': 'bytes=0-9', 'If-Range': etag})
+    assert document.status == 200
+
+
+def test_unsatisfiable_ranges_get_a_416():
+    document, upstream = respond({'Range': f'bytes={len(DOCUMENT)}-'})
+    assert (document.status, document.headers['Content-Range'], list(document.body)) == (
+        416, f'bytes */{len(DOCUMENT)}', [])
+    assert upstream.closed
+
+
+def test_upstream_ranges_and_encoded_bodies_pass_through():
+    partial = DOCUMENT[:10]
+    document, _upstream = respond({'Range': 'bytes=0-9'}, status=206, body=partial,
+                                  **{'Content-Range': f'bytes 0-9/{len(DOCUMENT)}'})
+    assert document.status == 206 and b''.join(document.body) == partial
+    # Encoded bodies cannot be sliced, so ranges are not advertised either
+    document, _upstream = respond({'Range': 'bytes=0-9'}, **{'Content-Encoding': 'gzip'})
+    assert document.status == 200 and 'Accept-Ranges' not in document.headers
+    assert b''.join(document.body) == DOCUMENT
+
+
+def test_not_modified_and_errors():
+    document, upstream = respond({'If-None-Match': '"v1"'}, status=304, body=b'', ETag='"v1"')
+    assert (document.status, document.headers['ETag'], list(document.body)) == (304, '"v1"', [])
+    assert upstream.closed
+    status, upstream = respond({}, status=404)
+    assert status == 404 and upstream.closed
+
+
+def test_only_conditional_and_range_headers_are_forwarded():
+    proxy = FakeProxy({'https://example.org/a.pdf': DOCUMENT})
+    proxy.fetch('a', 'https://example.org/a.pdf', {'Range': 'bytes=0-9', 'Cookie': 'session=1', 'If-Range': ''})
+    assert proxy.requests == [('https://example.org/a.pdf', {'Range': 'bytes=0-9'})]
+
+
+@pytest.fixture
+def proxied(app, parse, monkeypatch):
+    """The app serving ref-a's documents through a FakeProxy, uncached"""
+    data = record('a', 'Acme Ltd', documents=['doc-a', 'doc-missing', 'doc-down'])
+    for document in data['documents']:
+        document['url'] = f"https://secure.c6-intelligence.com/{document['reference']}.pdf"
+    snapshot = EntitySnapshot(parse([data]))
+    proxy = FakeProxy({'https://secure.c6-intelligence.com/doc-a.pdf': DOCUMENT,
+                       'https://secure.c6-intelligence.com/doc-missing.pdf': 404,
+                       'https://secure.c6-intelligence.com/doc-down.pdf': requests.ConnectionError('down')})
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    monkeypatch.setattr(app, 'document_proxy', proxy)
+    monkeypatch.setattr(app, 'document_cache', None)
+    return app.app.test_client()
+
+
+def test_proxy_route_streams_documents(proxied):
+    response = proxied.get('/proxy/document/doc-a')
+    assert response.status_code == 200 and response.is_streamed
+    assert response.headers['Content-Type'] == 'application/pdf'
+    assert response.headers['Content-Length'] == str(len(DOCUMENT)) and response.data == DOCUMENT
+    ranged = proxied.get('/proxy/document/doc-a', headers={'Range': 'bytes=10-19'})
+    assert ranged.status_code == 206 and ranged.data == DOCUMENT[10:20]
+
+
+def test_proxy_route_errors(proxied):
+    assert proxied.get('/proxy/document/doc-missing').status_code == 404
+    assert proxied.get('/proxy/document/doc-down').status_code == 502
+    assert proxied.get('/proxy/document/no-such-document').status_code == 404
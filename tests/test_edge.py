@@ -0,0 +1,109 @@
+import gzip
+import importlib
+import json
+from types import SimpleNamespace
+
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from conftest import record
+from sitemaps import SitemapCache
+from store import EntitySnapshot
+
+
+def pages_request(url, method='GET', headers=None, body=b'', **attributes):
+    """A Pages request: a URL, headers and a body, but no WSGI environ"""
+    return SimpleNamespace(url=url, method=method, headers=headers or {}, get_data=lambda: body, **attributes)
+
+
+@pytest.fixture
+def edge(app, parse, monkeypatch):
+    snapshot = EntitySnapshot(parse([record('a', 'Acme Ltd'), record('b', 'Vladimir Petrov'),
+                                     record('c', 'Acme Holdings')]), version='edge-test')
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    monkeypatch.setattr(app, 'sitemap_cache', SitemapCache(compress=True))
+    return importlib.import_module('functions.index')
+
+
+def call(edge, request):
+    response = edge.onRequest(SimpleNamespace(request=request))
+    try:
+        return response.status_code, response.headers, b''.join(response.response)
+    finally:
+        response.close()
+
+
+def test_query_strings_reach_the_app(edge):
+    status, headers, body = call(edge, pages_request('https://example.org/api/entities?q=acme&limit=1'))
+    assert status == 200 and headers['Content-Type'] == 'application/json'
+    result = json.loads(body)
+    assert [entity['reference'] for entity in result['entities']] == ['ref-a']
+    assert result['next_cursor']
+    # An explicit query string (str or bytes) wins over the URL's
+    request = pages_request('https://example.org/api/entities', path='/api/entities', query_string=b'q=petrov')
+    assert [entity['reference'] for entity in json.loads(call(edge, request)[2])['entities']] == ['ref-b']
+
+
+def test_bodies_and_their_headers_are_forwarded(edge):
+    body = json.dumps({'name': 'Vladimir Petrov', 'threshold': 0.99}).encode()
+    request = pages_request('https://example.org/api/screen', method='POST',
+                            headers={'Content-Type': 'application/json'}, body=body)
+    environ = edge.build_environ(request)
+    assert (environ['CONTENT_TYPE'], environ['CONTENT_LENGTH']) == ('application/json', str(len(body)))
+    assert 'HTTP_CONTENT_TYPE' not in environ
+    status, _headers, result = call(edge, request)
+    assert status == 200
+    assert [match['reference'] for match in json.loads(result)['matches']] == ['ref-b']
+
+
+@pytest.mark.parametrize('url, headers, expected', [
+    ('https://example.org/x', {}, ('example.org', '443', 'https')),
+    ('http://example.org:8080/x', {}, ('example.org', '8080', 'http')),
+    ('/x', {'Host': 'edge.example.org', 'X-Forwarded-Proto': 'http'}, ('edge.example.org', '80', 'http')),
+    ('/x', {}, ('localhost', '443', 'https')),
+])
+def test_host_and_scheme(edge, url, headers, expected):
+    environ = edge.build_environ(pages_request(url, headers=headers))
+    assert (environ['SERVER_NAME'], environ['SERVER_PORT'], environ['wsgi.url_scheme']) == expected
+    assert environ['PATH_INFO'] == '/x'
+
+
+def test_client_address_and_headers(edge):
+    environ = edge.build_environ(pages_request('https://example.org/', headers={
+        'CF-Connecting-IP': '203.0.113.7', 'Accept-Encoding': 'gzip'}))
+    assert environ['REMOTE_ADDR'] == '203.0.113.7'
+    assert environ['HTTP_ACCEPT_ENCODING'] == 'gzip'
+    assert environ['QUERY_STRING'] == ''
+    assert environ['wsgi.input'].read() == b''
+
+
+def test_wsgi_requests_keep_their_environ(edge):
+    request = Request(EnvironBuilder('/api/entities', query_string='q=holdings').get_environ())
+    assert edge.build_environ(request) is request.environ
+    status, _headers, body = call(edge, request)
+    assert status == 200
+    assert [entity['reference'] for entity in json.loads(body)['entities']] == ['ref-c']
+
+
+def test_streamed_responses_are_passed_through(app, edge):
+    response = edge.onRequest(SimpleNamespace(request=pages_request('https://example.org/sitemap-1.xml')))
+    assert response.direct_passthrough
+    # Nothing has been rendered (or cached) before the response is sent
+    assert app.sitemap_cache.get_stats()['entries'] == 0
+    xml = b''.join(response.response)
+    response.close()
+    assert b'<loc>https://example.org/entity/acme-ltd</loc>' in xml
+    assert app.sitemap_cache.get_stats()['entries'] == 1
+    status, headers, body = call(edge, pages_request('https://example.org/sitemap-1.xml.gz'))
+    assert status == 200 and headers['Content-Type'] == 'application/gzip'
+    assert gzip.decompress(body) == xml
+
+
+def test_status_and_conditional_requests(edge):
+    status, _headers, _body = call(edge, pages_request('https://example.org/sitemap-9.xml'))
+    assert status == 404
+    _status, headers, _body = call(edge, pages_request('https://example.org/sitemap.xml'))
+    status, _headers, body = call(edge, pages_request('https://example.org/sitemap.xml',
+                                                      headers={'If-None-Match': headers['ETag']}))
+    assert (status, body) == (304, b'')
@@ -0,0 +1,89 @@
+import pytest
+
+from app import parse_feed
+from conftest import feed, record
+from facets import iter_bits
+from graph import RISK_DATASETS, UNREACHED, RelationshipGraph
+from store import EntitySnapshot, EntityStore
+
+
+def chain(parse, length):
+    """Entities ref-0 .. ref-<length>, each linked to the next; only the last is sanctioned"""
+    return EntitySnapshot(parse([
+        record(f'{number}', f'Company {number}', links=[f'ref-{number + 1}'] if number < length else [],
+               datasets=['sanctions'] if number == length else [])
+        for number in range(length + 1)]))
+
+
+def test_exposure_reaches_max_hops(parse):
+    snapshot = chain(parse, 6)
+    snapshot.graph_max_hops = 5
+    graph = snapshot.graph
+    distances, via = graph.exposure('sanctions')
+    node = graph.node_ids
+    assert [distances[node[f'ref-{number}']] for number in range(7)] == [UNREACHED, 5, 4, 3, 2, 1, UNREACHED]
+    assert graph.references[via[node['ref-1']]] == 'ref-6'
+
+
+def test_max_hops_must_fit_the_distances():
+    with pytest.raises(ValueError):
+        RelationshipGraph([], max_hops=UNREACHED)
+
+
+def test_store_prepares_every_new_snapshot(tmp_path):
+    path = tmp_path / 'entities.csv'
+    delta_dir = tmp_path / 'deltas'
+    delta_dir.mkdir()
+    path.write_bytes(feed([record('a', 'Acme Ltd', links=['ref-b']), record('b', 'Globex', datasets=['pep'])]))
+    prepared = []
+
+    def prepare(snapshot):
+        snapshot.graph.propagate()
+        prepared.append(snapshot)
+
+    store = EntityStore(path, parse_feed, check_interval=0, delta_dir=delta_dir, prepare=prepare, graph_max_hops=2)
+    snapshot = store.snapshot()
+    assert snapshot.graph.max_hops == 2
+    assert prepared == [snapshot] and len(snapshot.graph._exposure) == 5
+    assert store.snapshot() is snapshot and len(prepared) == 1
+
+    (delta_dir / '001.csv').write_bytes(feed([record('b', 'Globex', version=2)]))
+    updated = store.snapshot()
+    assert prepared == [snapshot, updated]
+    assert 'graph' in updated.__dict__ and updated.graph.risk_summary(updated.graph.node_ids['ref-a'], 1) == {}
+    assert updated.graph.max_hops == 2 and updated.compacted().graph.max_hops == 2
+
+
+def graph_state(snapshot):
+    """Everything the graph answers, by reference"""
+    graph = snapshot.graph
+    return {
+        'nodes': {reference: graph.describe(node) for reference, node in graph.node_ids.items()},
+        'risk': {reference: graph.risk_summary(node, 3) for reference, node in graph.node_ids.items()},
+        'entities': {reference: graph.entity(node).name for reference, node in graph.node_ids.items()
+                     if graph.entity(node) is not None},
+        'exposed': {dataset: sorted(snapshot.entities[entity_id].reference
+                                    for entity_id in iter_bits(graph.exposed_bits(dataset, 3)))
+                    for dataset in RISK_DATASETS},
+    }
+
+
+@pytest.mark.parametrize('changes, carried', [
+    # Renaming an entity, its links unchanged, keeps the graph
+    ([record('1', 'Company One', version=2, links=['ref-2'])], True),
+    # New entities or links, dropped links, changed datasets and deletions rebuild it
+    ([record('9', 'Company 9')], False),
+    ([record('1', 'Company 1', version=2, links=['ref-2', 'ref-5'])], False),
+    ([record('1', 'Company 1', version=2)], False),
+    ([record('2', 'Company 2', version=2, datasets=['pep'], links=['ref-3'])], False),
+    ([record('3', 'Company 3', version=2, deleted=True)], False),
+])
+def test_graph_is_carried_only_when_links_and_datasets_are_unchanged(parse, changes, carried):
+    snapshot = chain(parse, 6)
+    snapshot.graph.propagate()
+    updated = snapshot.apply_changes(parse(changes))
+    assert ('graph' in updated.__dict__) == carried
+    # A carried graph keeps the risk already propagated
+    assert (updated.graph._exposure is snapshot.graph._exposure) == carried
+    assert graph_state(updated) == graph_state(updated.compacted())
+
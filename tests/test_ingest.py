@@ -0,0 +1,70 @@
+import logging
+
+import pytest
+
+from conftest import feed, record, snapshot_state
+from ingest import chunk_ranges, iter_feed, split_lines
+from store import EntitySnapshot
+
+
+def parse(lines, first_line):
+    for number, line in enumerate(lines, first_line):
+        if line.startswith(b'bad'):
+            logging.getLogger('details').warning("Bad line %d", number)
+        else:
+            yield int(line)
+
+
+@pytest.mark.parametrize('processes', [1, 4])
+def test_worker_records_are_logged_in_feed_order(caplog, processes):
+    data = b''.join(b'bad\n' if number % 5 == 0 else b'%d\n' % number for number in range(200))
+    with caplog.at_level(logging.WARNING, logger='details'):
+        parsed = list(iter_feed(data, parse, processes=processes, chunk_bytes=64))
+    assert parsed == [number for number in range(200) if number % 5]
+    assert [record.getMessage() for record in caplog.records] == [
+        f"Bad line {number + 1}" for number in range(0, 200, 5)]
+
+
+@pytest.mark.parametrize('data', [b'', b'one\n', b'one\ntwo\nthree', b'a\n' * 50, b'long line\nx\n\n\ny\n'])
+@pytest.mark.parametrize('chunk_bytes', [1, 3, 8, 1000])
+def test_chunks_end_on_line_boundaries(data, chunk_bytes):
+    ranges = list(chunk_ranges(data, chunk_bytes, first_line=10))
+    # Contiguous, covering everything, every chunk but the last ending a line
+    assert [start for start, _end, _line in ranges] == [0, *(end for _start, end, _line in ranges)][:len(ranges)]
+    assert (ranges[-1][1] if ranges else 0) == len(data)
+    assert all(data[end - 1:end] == b'\n' for _start, end, _line in ranges[:-1])
+    # Blank lines may be dropped (a chunk of just b'\n'), the others keep their numbers
+    lines = [(number, line) for start, end, first_line in ranges
+             for number, line in enumerate(split_lines(data, start, end), first_line) if line]
+    assert lines == [(number, line) for number, line in enumerate(split_lines(data), 10) if line]
+
+
+def test_chunks_are_parsed_with_their_offsets():
+    data = b'1\n22\n333\n'
+    seen = []
+
+    def parse_with_offsets(lines, first_line, offset):
+        seen.append((first_line, offset, lines))
+        return lines
+
+    assert list(iter_feed(data, parse_with_offsets, chunk_bytes=2, offsets=True)) == [b'1', b'22', b'333']
+    assert seen == [(1, 0, [b'1']), (2, 2, [b'22']), (3, 5, [b'333'])]
+
+
+def test_parallel_load_matches_a_serial_one(app, monkeypatch, caplog):
+    records = [record(f'{number:03d}', f'Company {number}', datasets=['pep'] if number % 2 else [],
+                      documents=[f'doc-{number}']) for number in range(120)]
+    lines = feed(records).split(b'\n')
+    lines[7] = b'"{not json"'
+    data = b'\n'.join(lines)
+    monkeypatch.setitem(app.app.config, 'INGEST_CHUNK_BYTES', 1024)
+    loads = {}
+    for processes in (1, 4):
+        monkeypatch.setitem(app.app.config, 'INGEST_PROCESSES', processes)
+        caplog.clear()
+        with caplog.at_level(logging.WARNING):
+            loads[processes] = (snapshot_state(EntitySnapshot(app.parse_feed(data))),
+                                [record.getMessage()[:40] for record in caplog.records])
+    assert loads[1] == loads[4]
+    assert len(loads[4][0]['entities']) == 119
+    assert loads[4][1] == ['Error parsing JSON on line 8: Expecting ']
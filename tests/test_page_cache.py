@@ -0,0 +1,53 @@
+import pytest
+
+from conftest import record
+from page_cache import PageCache
+from store import EntitySnapshot
+
+
+def test_pages_are_evicted_least_recently_used_by_size():
+    cache = PageCache(max_bytes=12)
+    first = cache.put('a', 'aaaa')
+    assert first.etag == cache.put('same', b'aaaa').etag != cache.put('b', 'bbbb').etag
+    assert cache.get('a') is first
+    cache.put('c', 'cccc')
+    # 'same' was used least recently
+    assert cache.get('same') is None and cache.get('a') is first
+    assert cache.put('big', 'x' * 13).body == b'x' * 13 and cache.get('big') is None
+    assert cache.get_stats() == {'hits': 2, 'misses': 2, 'evicted': 1, 'entries': 3, 'bytes': 12}
+
+
+@pytest.fixture
+def client(app, parse, monkeypatch):
+    snapshot = EntitySnapshot(parse([record('a', 'Acme Ltd')]), version='v1')
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    monkeypatch.setattr(app, 'page_cache', PageCache())
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize('path', ['/entity/acme-ltd', '/sitemap'])
+def test_pages_are_revalidated_with_their_etag(client, path):
+    response = client.get(path)
+    assert response.status_code == 200 and response.headers['ETag']
+    assert 'Accept-Language' in response.headers['Vary']
+    again = client.get(path, headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304 and not again.data
+    assert client.get(path, headers={'If-None-Match': '"other"'}).data == response.data
+
+
+def test_query_strings_do_not_multiply_cached_pages(app, client):
+    pages = {client.get(f'/entity/acme-ltd?utm_source={number}').data for number in range(5)}
+    assert len(pages) == 1 and app.page_cache.get_stats()['entries'] == 1
+    # The locale and host the page links with do make other pages
+    german = client.get('/entity/acme-ltd?lang=de').data
+    other_host = client.get('/entity/acme-ltd', base_url='https://mirror.example.org').data
+    assert b'https://mirror.example.org/' in other_host and german not in pages and other_host not in pages
+    assert app.page_cache.get_stats()['entries'] == 3
+
+
+def test_a_new_snapshot_misses_the_old_pages(app, client, parse, monkeypatch):
+    etag = client.get('/entity/acme-ltd').headers['ETag']
+    renamed = EntitySnapshot(parse([record('a', 'Acme Ltd', aliases=['Acme Limited'])]), version='v2')
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: renamed)
+    response = client.get('/entity/acme-ltd', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and b'Acme Limited' in response.data
@@ -0,0 +1,29 @@
+import json
+
+from conftest import record
+from entities import ENTITY_FIELDS, LIST_FIELDS
+from payloads import EncodedEntities
+from store import EntitySnapshot
+
+
+def test_encoded_pages_match_the_records(parse):
+    snapshot = EntitySnapshot(parse([record(f'{number}', f'Company {number}') for number in range(5)]))
+    encoded = EncodedEntities(snapshot.entities, max_entries=2)
+    for fields in (LIST_FIELDS, ENTITY_FIELDS, ('name',)):
+        for ids in ([0, 1, 2], [4, 0], [2]):
+            assert json.loads(encoded.encode_page(ids, fields)) == [
+                json.loads(json.dumps(snapshot.entities[entity_id].to_dict(fields))) for entity_id in ids]
+    # Only list records are kept, and at most max_entries of them
+    stats = encoded.get_stats()
+    assert stats['entries'] == 2 and stats['evicted'] == 4 and stats['hits'] == 0
+    assert stats['bytes'] == sum(len(encoded.encode(entity_id, LIST_FIELDS)) for entity_id in (0, 2))
+
+
+def test_unchanged_records_are_carried_across_deltas(parse):
+    snapshot = EntitySnapshot(parse([record('a', 'Acme Ltd'), record('b', 'Northwind'), record('c', 'Contoso')]))
+    snapshot.encoded.encode_page([0, 1, 2], LIST_FIELDS)
+    updated = snapshot.apply_changes(parse([record('b', 'Northwind Renamed', version=2)]))
+    assert updated.encoded.get_stats()['entries'] == 2
+    page = updated.encoded.encode_page([0, 2, 3], LIST_FIELDS)
+    assert [entity['name'] for entity in json.loads(page)] == ['Acme Ltd', 'Contoso', 'Northwind Renamed']
+    assert updated.encoded.get_stats()['hits'] == 2
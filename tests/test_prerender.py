@@ -0,0 +1,55 @@
+import json
+import re
+
+import pytest
+
+from conftest import record
+from prerender import export_site, page_file, page_url
+from store import EntitySnapshot
+
+LOCALES = ['en', 'fr', 'de']
+
+
+@pytest.fixture
+def exported(app, parse, monkeypatch, tmp_path):
+    snapshot = EntitySnapshot(parse([record('a', 'Acme Ltd'), record('b', 'Northwind Holdings')]),
+                              version='prerender-test')
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    static_files = [(page_url('/sitemap', locale, 'en'), page_file('/sitemap', locale, 'en')) for locale in LOCALES]
+    stats = export_site(app.app, snapshot, tmp_path, 'https://site.test', LOCALES,
+                        static_files=static_files, static_routes=['/sitemap'])
+    assert stats['errors'] == []
+    return tmp_path
+
+
+def links(html, pattern):
+    return re.findall(pattern, html)
+
+
+def test_pages_link_the_exported_locale_paths(app, exported):
+    html = (exported / 'fr/entity/acme-ltd.html').read_text('utf-8')
+    alternates = dict(links(html, r'hreflang="([\w-]+)" href="https://site.test([^"]*)"'))
+    expected = {locale: page_url('/entity/acme-ltd', locale, 'en') for locale in app.LANGUAGES}
+    assert alternates == {'x-default': '/', **expected}
+    assert links(html, r'<option value="https://site.test([^"]*)"') == list(expected.values())
+    # Pages serves <path>.html at <path>: every exported locale is linked at its file
+    for locale in LOCALES:
+        assert (exported / f"{expected[locale].strip('/')}.html").exists()
+    assert '?lang=' not in html
+
+    directory = (exported / 'de/sitemap.html').read_text('utf-8')
+    assert '/de/entity/acme-ltd' in links(directory, r'href="([^"]*)" class="entity-link"')
+    assert 'const LOCALE_PREFIX = "/de";' in directory
+
+
+def test_routes_keep_locale_paths_static(exported):
+    routes = json.loads((exported / '_routes.json').read_text('utf-8'))
+    assert {'/entity/*', '/sitemap', '/fr/*', '/de/*'} <= set(routes['exclude'])
+    assert (exported / 'entity/acme-ltd.html').exists() and (exported / 'de/sitemap.html').exists()
+
+
+def test_locale_prefixes_outside_the_export_are_not_found(app, exported):
+    client = app.app.test_client()
+    assert client.get('/en/entity/acme-ltd').status_code == 404
+    assert client.get('/xx/entity/acme-ltd').status_code == 404
+    assert client.get('/fr/entity/acme-ltd').status_code == 200
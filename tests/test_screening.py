@@ -0,0 +1,90 @@
+import pytest
+
+from conftest import record
+from screening import (ScreeningIndex, entity_names, jaro_winkler, name_similarity, phonetic_key,
+                       significant_tokens, tokenize)
+from store import EntitySnapshot
+
+
+@pytest.mark.parametrize('left, right, score', [
+    ('martha', 'marhta', 0.9611),
+    ('dwayne', 'duane', 0.84),
+    ('dixon', 'dicksonx', 0.8133),
+    ('same', 'same', 1.0),
+    ('abc', '', 0.0),
+    ('abc', 'xyz', 0.0),
+])
+def test_jaro_winkler(left, right, score):
+    assert jaro_winkler(left, right) == pytest.approx(score, abs=1e-4)
+    assert jaro_winkler(right, left) == pytest.approx(score, abs=1e-4)
+
+
+@pytest.mark.parametrize('left, right', [('mohammed', 'muhammad'), ('aly', 'ali'), ('schmidt', 'smidt'),
+                                         ('philips', 'filips')])
+def test_transliterations_share_a_phonetic_key(left, right):
+    assert phonetic_key(left) == phonetic_key(right)
+
+
+def test_stop_tokens_only_count_when_nothing_else_is_left():
+    assert significant_tokens(tokenize('The Acme Holdings Ltd.')) == ['acme', 'holdings']
+    assert significant_tokens(tokenize('Company Limited')) == ['company', 'limited']
+    assert name_similarity(('acme', 'holdings'), ('holdings', 'acme')) == pytest.approx(1.0)
+
+
+def names(parse):
+    return parse([
+        record('a', 'Mohammed Al Rashid', aliases=['Muhammad Al-Rashid']),
+        record('b', 'Vladimir Petrov'),
+        record('c', 'Acme Trading Ltd'),
+        record('d', 'Petrova Vladimira'),
+        record('e', 'Zürich Versicherung AG'),
+    ])
+
+
+def brute_force(parsed, query, threshold):
+    """Score every name of every entity, without the blocking index"""
+    tokens = tuple(significant_tokens(tokenize(query)))
+    best = {}
+    for entity_id, entity in enumerate(parsed):
+        for name in entity_names(entity):
+            score = name_similarity(tokens, tuple(significant_tokens(tokenize(name))))
+            if score >= threshold and score > best.get(entity_id, (0,))[0]:
+                best[entity_id] = (score, entity_id, name)
+    return sorted(best.values(), key=lambda match: (-match[0], match[1]))
+
+
+@pytest.mark.parametrize('query', ['Mohamed Rashid', 'Rashid Muhammad', 'Vladimir Petrov', 'petrov vladimir',
+                                   'ACME Trading', 'Zurich Versicherungs', 'Nobody Atall'])
+def test_blocking_finds_what_scoring_every_name_finds(parse, query):
+    parsed = names(parse)
+    assert ScreeningIndex(parsed).screen(query, threshold=0.8, limit=None) == brute_force(parsed, query, 0.8)
+
+
+def test_screen_ranks_and_reports_the_best_name(parse):
+    index = ScreeningIndex(names(parse))
+    results = index.screen('Muhammad Al Rashid', threshold=0.85)
+    assert results[0][1:] == (0, 'Muhammad Al-Rashid')
+    assert results[0][0] == pytest.approx(1.0)
+    assert [entity_id for _score, entity_id, _name in index.screen('Vladimir Petrov', threshold=0.7)][:2] == [1, 3]
+    assert index.screen('Vladimir Petrov', threshold=0.7, exclude={1})[0][1] == 3
+    assert index.screen('Vladimir Petrov', threshold=0.99, limit=1) == [(1.0, 1, 'Vladimir Petrov')]
+    assert index.screen('Ltd') == index.screen('') == []
+
+
+def test_extended_index_screens_like_a_rebuilt_one(parse):
+    parsed = names(parse)
+    extended = ScreeningIndex(parsed[:2]).extended(parsed[2:], 2)
+    for query in ['Petrov', 'Acme Trading', 'Mohamed Rashid']:
+        assert extended.screen(query, threshold=0.7) == ScreeningIndex(parsed).screen(query, threshold=0.7)
+
+
+def test_screen_endpoint(app, parse, monkeypatch):
+    snapshot = EntitySnapshot(names(parse))
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    client = app.app.test_client()
+    result = client.get('/api/screen?name=Mohamed%20Rashid').get_json()
+    assert result['matches'][0]['reference'] == 'ref-a'
+    posted = client.post('/api/screen', json={'name': 'Vladimir Petrov', 'threshold': 0.99}).get_json()
+    assert [match['reference'] for match in posted['matches']] == ['ref-b']
+    assert client.get('/api/screen').status_code == 400
+    assert client.get('/api/screen?name=x&threshold=2').status_code == 400
@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from conftest import record
+from search import SearchIndex, fold, intersect, searchable_fields
+
+NAMES = ['Acme Ltd', 'Zürich Versicherung', 'Acme Holdings', 'Northwind Traders', 'Ølberg AS',
+         'Globex Corporation', 'Initech', 'Acmeco', 'Hooli XYZ', 'Contoso']
+
+
+def entities(parse, count=60, seed=0):
+    rng = random.Random(seed)
+    return parse([record(f'{number:03d}', rng.choice(NAMES) + f' {number}',
+                         aliases=[rng.choice(NAMES)] if number % 4 == 0 else [])
+                  for number in range(count)])
+
+
+def substring_search(entities, query):
+    query = fold(query)
+    return [entity_id for entity_id, entity in enumerate(entities)
+            if any(query in fold(value) for value in searchable_fields(entity) if value)]
+
+
+@pytest.mark.parametrize('query', ['', 'a', 'ac', 'acm', 'acme', 'ACME LTD', 'zurich', 'Zür', 'ølberg',
+                                   'olb', 'ltd 1', 'ref-01', 'holdings 4', 'nothing', 'e h', '1'])
+def test_search_matches_a_substring_scan(parse, query):
+    parsed = entities(parse)
+    assert SearchIndex(parsed).search(query) == substring_search(parsed, query)
+
+
+def test_matches_do_not_span_fields(parse):
+    index = SearchIndex(parse([record('a', 'Acme', aliases=['Ltd'])]))
+    assert index.search('acme') == index.search('ltd') == [0]
+    assert index.search('acmeltd') == []
+
+
+def test_prefix_matches_the_start_of_every_word(parse):
+    index = SearchIndex(parse([record('a', 'Acme Holdings'), record('b', 'Acmeco'),
+                               record('c', 'Holdings Acme'), record('d', 'Northwind')]))
+    assert index.prefix('acm') == [0, 1, 2]
+    assert index.prefix('hold acme') == [0, 2]
+    assert index.prefix('cme') == []
+    assert index.prefix('') == [0, 1, 2, 3]
+
+
+def test_extended_index_matches_a_rebuilt_one(parse):
+    parsed = entities(parse, 80, seed=3)
+    extended = SearchIndex(parsed[:50]).extended(parsed[50:], 50)
+    rebuilt = SearchIndex(parsed)
+    for query in ['acme', 'zurich', 'ltd 7', 'xyz', 'init', 'o']:
+        assert extended.search(query) == rebuilt.search(query)
+    for query in ['acm', 'hooli x', 'contoso 7']:
+        assert extended.prefix(query) == rebuilt.prefix(query)
+
+
+def test_intersect():
+    assert intersect([1, 3, 5, 7], [0, 1, 2, 3, 4, 7, 9]) == [1, 3, 7]
+    assert intersect([2, 4], []) == []
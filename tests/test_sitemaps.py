@@ -0,0 +1,147 @@
+import gzip
+import random
+import re
+
+import pytest
+
+from conftest import record
+from sitemaps import SitemapCache, iter_chunks, lastmod, live_ids, shard_count, shard_lastmods, shard_urls
+from store import EntitySnapshot
+
+# 2023-11-14T22:13:20Z in epoch milliseconds
+NOVEMBER = 1700000000000
+
+
+@pytest.mark.parametrize('version, date', [
+    (NOVEMBER, '2023-11-14'),
+    (NOVEMBER + 86399999, '2023-11-15'),
+    (0, 'default'),
+    (-5, 'default'),
+    (True, 'default'),
+    ('v1', 'default'),
+    (None, 'default'),
+    (10 ** 30, 'default'),
+])
+def test_lastmod(version, date):
+    assert lastmod(version, 'default') == date
+
+
+def tombstoned(parse, count=40, seed=0, version=None):
+    """A snapshot of ``count`` entities with some renamed and some deleted"""
+    rng = random.Random(seed)
+    snapshot = EntitySnapshot(parse([record(f'{number:03d}', f'Company {number}', version=NOVEMBER + number)
+                                     for number in range(count)]))
+    changed = rng.sample(range(count), count // 2)
+    return snapshot.apply_changes(parse([
+        record(f'{number:03d}', f'Renamed {number}', version=NOVEMBER + 10 ** 9, deleted=number % 3 == 0)
+        for number in changed]), version=version)
+
+
+def test_live_ids_match_the_iteration_order(parse):
+    snapshot = tombstoned(parse)
+    assert snapshot.dead
+    order = [snapshot.oids[entity.oid] for entity in snapshot]
+    for start in range(0, len(order) + 2):
+        for stop in range(start, len(order) + 3):
+            assert list(live_ids(snapshot, start, stop)) == order[start:stop]
+
+
+@pytest.mark.parametrize('shard_size', [1, 3, 7, 100])
+def test_shards_list_the_pages_then_every_live_entity_once(parse, shard_size):
+    snapshot = tombstoned(parse)
+    pages = [{'loc': 'https://example.org', 'lastmod': None}, {'loc': 'https://example.org/sitemap'}]
+    shards = shard_count(snapshot, pages, shard_size)
+    urls = [url for shard in range(1, shards + 1)
+            for url in shard_urls(snapshot, 'https://example.org', shard, pages, shard_size)]
+    assert urls[:2] == pages
+    assert [url['loc'] for url in urls[2:]] == [f"https://example.org/entity/{entity.slug}" for entity in snapshot]
+    assert all(len(list(shard_urls(snapshot, '', shard, pages, shard_size))) == shard_size
+               for shard in range(1, shards))
+    assert list(shard_urls(snapshot, '', shards + 1, pages, shard_size)) == []
+    assert len(shard_lastmods(snapshot, pages, shard_size)) == shards
+
+
+def test_an_empty_snapshot_still_has_one_shard(parse):
+    assert shard_count(EntitySnapshot(parse([])), shard_size=10) == 1
+    assert shard_count(EntitySnapshot(parse([record('a', 'Acme')])), [{}] * 9, shard_size=10) == 1
+    assert shard_count(EntitySnapshot(parse([record('a', 'Acme'), record('b', 'Beta')])), [{}] * 9, 10) == 2
+
+
+def test_iter_chunks():
+    pieces = ['ab', 'c', 'défg', '', 'h']
+    assert list(iter_chunks(pieces, chunk_size=3)) == [b'abc', 'défg'.encode('utf-8'), b'h']
+    assert b''.join(iter_chunks(pieces, chunk_size=1000)) == ''.join(pieces).encode('utf-8')
+    assert list(iter_chunks([])) == []
+
+
+@pytest.fixture
+def client(app, parse, monkeypatch):
+    snapshot = tombstoned(parse, version='sitemap-test')
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    monkeypatch.setattr(app, 'sitemap_cache', SitemapCache(compress=True))
+    monkeypatch.setitem(app.app.config, 'SITEMAP_SHARD_SIZE', 10)
+    monkeypatch.setitem(app.app.config, 'SITEMAP_GZIP', True)
+    return app.app.test_client()
+
+
+def locs(xml):
+    return re.findall(r'<loc>([^<]*)</loc>', xml.decode('utf-8'))
+
+
+def test_index_points_at_every_gzipped_shard(app, client, monkeypatch):
+    snapshot = app.get_entities_snapshot()
+    shards = -(-(len(snapshot) + 2) // 10)
+    response = client.get('/sitemap.xml')
+    assert response.status_code == 200
+    assert locs(response.data) == [f"http://localhost/sitemap-{shard}.xml.gz" for shard in range(1, shards + 1)]
+    # The index is cached per snapshot version, so a fresh cache is needed to see the change
+    monkeypatch.setitem(app.app.config, 'SITEMAP_GZIP', False)
+    monkeypatch.setattr(app, 'sitemap_cache', SitemapCache())
+    assert locs(client.get('/sitemap.xml').data)[0] == 'http://localhost/sitemap-1.xml'
+
+
+def test_shards_stream_then_come_from_the_cache(app, client):
+    snapshot = app.get_entities_snapshot()
+    shards = shard_count(snapshot, [{}, {}], 10)
+    entities = []
+    for shard in range(1, shards + 1):
+        # A streamed shard is only cached once the response has been sent and closed
+        with client.get(f'/sitemap-{shard}.xml') as streamed:
+            assert streamed.status_code == 200
+            xml = streamed.data
+        assert app.sitemap_cache.get_stats()['entries'] == shard
+        cached = client.get(f'/sitemap-{shard}.xml')
+        assert cached.data == xml
+        assert client.get(f'/sitemap-{shard}.xml', headers={'If-None-Match': cached.headers['ETag']}).status_code == 304
+        entities.extend(locs(xml))
+    assert entities[:2] == ['http://localhost', 'http://localhost/sitemap']
+    assert entities[2:] == [f"http://localhost/entity/{entity.slug}" for entity in snapshot]
+    stats = app.sitemap_cache.get_stats()
+    assert (stats['misses'], stats['hits']) == (shards, 2 * shards)
+
+
+def test_gzipped_shards_hold_the_same_xml(app, client):
+    with client.get('/sitemap-2.xml') as streamed:
+        xml = streamed.data
+    compressed = client.get('/sitemap-2.xml.gz')
+    assert compressed.mimetype == 'application/gzip'
+    assert gzip.decompress(compressed.data) == xml
+    assert client.get('/sitemap-2.xml.gz', headers={'If-None-Match': compressed.headers['ETag']}).status_code == 304
+    # Clients accepting gzip get the stored compressed copy as a content encoding
+    encoded = client.get('/sitemap-2.xml', headers={'Accept-Encoding': 'gzip'})
+    assert encoded.headers['Content-Encoding'] == 'gzip'
+    assert encoded.data == compressed.data
+    assert 'Accept-Encoding' in encoded.headers['Vary']
+    # Rendering the .gz first caches the plain shard too
+    assert gzip.decompress(client.get('/sitemap-3.xml.gz').data) == client.get('/sitemap-3.xml').data
+
+
+@pytest.mark.parametrize('path', ['/sitemap-0.xml', '/sitemap-99.xml', '/sitemap-0.xml.gz', '/sitemap-99.xml.gz'])
+def test_shards_out_of_range_are_not_found(client, path):
+    assert client.get(path).status_code == 404
+
+
+def test_gzipped_shards_can_be_turned_off(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'SITEMAP_GZIP', False)
+    assert client.get('/sitemap-1.xml.gz').status_code == 404
+    assert client.get('/sitemap-1.xml').status_code == 200
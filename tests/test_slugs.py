@@ -0,0 +1,59 @@
+import pytest
+
+from conftest import record
+from slugs import slugify
+from store import EntitySnapshot
+
+
+@pytest.mark.parametrize('text, slug', [
+    ('Acme Ltd', 'acme-ltd'),
+    ('  Zürich   Versicherung AG ', 'zurich-versicherung-ag'),
+    ('A.B.C. (Holdings) -- Limited', 'abc-holdings-limited'),
+    ('***', ''),
+])
+def test_slugify(text, slug):
+    assert slugify(text) == slug
+
+
+def slugs(snapshot):
+    return {entity.oid: entity.slug for entity in snapshot}
+
+
+def test_collisions_go_to_the_lowest_reference_whatever_the_feed_order(parse):
+    records = [record('b', 'Acme Ltd'), record('c', 'ACME LTD.'), record('a', 'Acme  Ltd')]
+    forward = EntitySnapshot(parse(records))
+    backward = EntitySnapshot(parse(records[::-1]))
+    assert slugs(forward) == slugs(backward) == {'a': 'acme-ltd', 'b': 'acme-ltd-ref-b', 'c': 'acme-ltd-ref-c'}
+    # Every member of the group is also reachable with its reference appended
+    for oid in 'abc':
+        assert forward.get_by_slug(f'acme-ltd-ref-{oid}').oid == oid
+    assert forward.slug_collisions['acme-ltd'] == (
+        forward.oids['a'], forward.oids['b'], forward.oids['c'])
+
+
+def test_suffixed_slugs_never_shadow_a_natural_slug(parse):
+    snapshot = EntitySnapshot(parse([record('a', 'Acme Ltd'), record('b', 'Acme Ltd'),
+                                     record('z', 'Acme Ltd Ref B')]))
+    assert snapshot.get_by_slug('acme-ltd-ref-b').oid == 'z'
+    assert slugs(snapshot)['b'] == 'acme-ltd-ref-b-2'
+    assert snapshot.get_by_slug('acme-ltd-ref-b-2').oid == 'b'
+
+
+def test_nameless_entities_fall_back_to_their_reference(parse):
+    snapshot = EntitySnapshot(parse([record('a', '***')]))
+    assert slugs(snapshot)['a'] == 'ref-a'
+
+
+def test_lookup_is_case_insensitive(parse):
+    snapshot = EntitySnapshot(parse([record('a', 'Acme Ltd')]))
+    assert snapshot.get_by_slug('Acme-LTD').oid == 'a'
+    assert snapshot.get_by_slug('acme') is None
+
+
+def test_entity_page_by_slug(app, parse, monkeypatch):
+    snapshot = EntitySnapshot(parse([record('a', 'Acme Ltd'), record('b', 'Acme Ltd')]))
+    monkeypatch.setattr(app, 'get_entities_snapshot', lambda: snapshot)
+    client = app.app.test_client()
+    response = client.get('/entity/acme-ltd-ref-b')
+    assert response.status_code == 200 and b'ref-b' in response.data
+    assert client.get('/entity/no-such-entity').status_code == 404
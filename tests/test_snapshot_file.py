@@ -0,0 +1,120 @@
+import os
+import shutil
+
+import pytest
+
+from app import parse_feed
+from conftest import feed, record, snapshot_state
+from snapshot_file import (FORMAT_VERSION, MAGIC, SnapshotFormatError, load_snapshot, read_file_header,
+                           write_snapshot)
+from store import EntitySnapshot, EntityStore, read_csv_snapshot
+
+
+def records():
+    return [
+        record('a', 'Acme Ltd', datasets=['sanctions'], documents=['doc-a', 'doc-shared'],
+               links=['p1', 'p2'], aliases=['Acme Limited']),
+        record('b', 'Acme Ltd', datasets=['pep'], documents=['doc-shared'], links=['p1']),
+        record('c', 'Northwind Holdings', version=7),
+        record('d', 'Zürich Versicherung', datasets=['insolvency', 'adverse_media']),
+    ]
+
+
+@pytest.fixture
+def compiled(parse, tmp_path):
+    def compile_snapshot(snapshot):
+        path = tmp_path / 'entities.snap'
+        write_snapshot(snapshot, path)
+        return load_snapshot(path, EntitySnapshot)
+    return compile_snapshot
+
+
+def test_round_trip(parse, compiled):
+    snapshot = EntitySnapshot(parse(records()), version='v1', mtime=123.0)
+    loaded = compiled(snapshot)
+    assert snapshot_state(loaded) == snapshot_state(snapshot)
+    assert (loaded.version, loaded.mtime) == ('v1', 123.0)
+    assert [entity.oid for entity in loaded.search('zurich')] == ['d']
+    assert loaded.get_document('doc-shared')[0]['reference'] == 'doc-shared'
+    assert tuple(loaded.shared_documents.get('doc-shared')) == snapshot.shared_documents['doc-shared'] == (0, 1)
+    assert [entity.links for entity in loaded] == [entity.links for entity in snapshot]
+
+
+def test_round_trip_of_a_patched_snapshot(parse, compiled):
+    snapshot = EntitySnapshot(parse(records())).apply_changes(parse([
+        record('a', 'Acme Renamed', version=2),
+        record('c', 'Northwind Holdings', version=8, deleted=True),
+    ]))
+    loaded = compiled(snapshot)
+    # Tombstones are dropped, deletions kept to reject stale upserts
+    assert not loaded.dead
+    assert snapshot_state(loaded) == snapshot_state(snapshot)
+    assert loaded.apply_changes(parse([record('c', 'Northwind Holdings', version=7)])) is loaded
+
+
+def test_rejects_other_files(tmp_path, parse):
+    path = tmp_path / 'entities.snap'
+    path.write_bytes(b'not a snapshot')
+    with pytest.raises(SnapshotFormatError):
+        load_snapshot(path, EntitySnapshot)
+
+    write_snapshot(EntitySnapshot(parse(records())), path)
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+    with pytest.raises(SnapshotFormatError):
+        load_snapshot(path, EntitySnapshot)
+
+    header = data.replace(f'"format": {FORMAT_VERSION}'.encode(), f'"format": {FORMAT_VERSION + 1}'.encode(), 1)
+    assert header.startswith(MAGIC) and header != data
+    path.write_bytes(header)
+    with pytest.raises(SnapshotFormatError):
+        load_snapshot(path, EntitySnapshot)
+
+
+@pytest.fixture
+def deployed(tmp_path):
+    """A feed compiled into entities.snap, then copied elsewhere with or without its mtime"""
+    build, deploy = tmp_path / 'build', tmp_path / 'deploy'
+    build.mkdir()
+    source = build / 'entities.csv'
+    source.write_bytes(feed(records()))
+    os.utime(source, ns=(10 ** 18, 10 ** 18))
+    write_snapshot(read_csv_snapshot(source, parse_feed), build / 'entities.snap', source_stat=os.stat(source))
+
+    def deploy_copy(preserve_mtime):
+        shutil.copytree(build, deploy, copy_function=shutil.copy2 if preserve_mtime else shutil.copy)
+        return EntityStore(deploy / 'entities.csv', parse_feed, check_interval=0,
+                           compiled_path=deploy / 'entities.snap')
+    return deploy_copy
+
+
+def test_header_records_the_source_feed(deployed, tmp_path):
+    deployed(True)
+    header = read_file_header(tmp_path / 'deploy' / 'entities.snap')
+    source = tmp_path / 'deploy' / 'entities.csv'
+    assert (header['source_size'], header['source_mtime_ns']) == (source.stat().st_size, 10 ** 18)
+    with pytest.raises(SnapshotFormatError):
+        read_file_header(source)
+
+
+@pytest.mark.parametrize('preserve_mtime', [True, False])
+def test_compiled_snapshot_is_served_for_the_feed_it_was_built_from(deployed, preserve_mtime):
+    store = deployed(preserve_mtime)
+    # Without the feed's mtime the copy is newer than the snapshot; its content still matches
+    assert store._source()[0] == 'compiled'
+    assert len(store.snapshot()) == 4 and store._stat_key[0] == 'compiled'
+
+
+def test_changed_feed_is_read_instead_of_the_compiled_snapshot(deployed, tmp_path):
+    store = deployed(True)
+    assert len(store.snapshot()) == 4
+    source = tmp_path / 'deploy' / 'entities.csv'
+    # Same size as when compiled, other content: only the hash can tell
+    source.write_bytes(source.read_bytes().replace(b'Northwind', b'Southwind'))
+    os.utime(source, ns=(10 ** 18 + 1, 10 ** 18 + 1))
+    assert store._source()[0] == 'csv'
+    assert [entity.name for entity in store.snapshot().search('southwind')] == ['Southwind Holdings']
+
+    with source.open('ab') as f:
+        f.write(feed([record('e', 'Contoso')]))
+    assert store._source()[0] == 'csv' and len(store.snapshot()) == 5